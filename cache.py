@@ -0,0 +1,136 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# ======================
+# کش TTL برای مدیران و اعضای گروه
+# ======================
+ADMINS_TTL = 300    # ثانیه
+MEMBER_TTL = 600
+
+
+class _LeaderCancelled(Exception):
+    """درخواست اصلی (leader) لغو شد؛ منتظرها خودشان دوباره تلاش می‌کنند"""
+
+
+class AsyncTTLCache:
+    """
+    کش async با انقضای زمانی.
+    چند درخواست هم‌زمان برای یک key که در کش نیست فقط یک تماس (loader) می‌سازند
+    و همه منتظر همان نتیجه می‌مانند. خطاها کش نمی‌شوند.
+    اگر تسک leader لغو شود، لغو به منتظرها سرایت نمی‌کند و یکی از آن‌ها loader را دوباره اجرا می‌کند.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()   # {key: (expires_at, value)}
+        self._inflight = {}          # {key: asyncio.Future}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def peek(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def get(self, key, loader):
+        """loader: تابع بدون آرگومان که coroutine مقدار را برمی‌گرداند"""
+        entry = self._data.get(key)
+        if entry is not None and entry[0] >= time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except _LeaderCancelled:
+                return await self.get(key, loader)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            if not future.done():
+                future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            future.exception()  # جلوگیری از هشدار «exception was never retrieved»
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self.set(key, value)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        for key in [k for k in self._data if predicate(k)]:
+            del self._data[key]
+
+    def stats(self):
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / total, 3) if total else 0.0,
+            "size": len(self._data),
+        }
+
+
+class ChatCache:
+    """مدیران گروه (chat_id) و اعضا ((chat_id, user_id)) با TTL جدا"""
+
+    def __init__(self):
+        self.admins_cache = AsyncTTLCache(ADMINS_TTL)
+        self.members_cache = AsyncTTLCache(MEMBER_TTL)
+
+    async def admins(self, bot, chat_id):
+        async def load():
+            admins = await bot.get_chat_administrators(chat_id)
+            # اطلاعات مدیران همین‌جا در کش اعضا هم می‌نشیند
+            for member in admins:
+                self.members_cache.set((chat_id, member.user.id), member)
+            return admins
+        return await self.admins_cache.get(chat_id, load)
+
+    async def admin_ids(self, bot, chat_id):
+        return {member.user.id for member in await self.admins(bot, chat_id)}
+
+    async def member(self, bot, chat_id, user_id):
+        return await self.members_cache.get(
+            (chat_id, user_id), lambda: bot.get_chat_member(chat_id, user_id)
+        )
+
+    def on_member_update(self, chat_id, user_id):
+        """با آپدیت chat_member (ادمین شدن، خروج، تغییر نام و ...) صدا زده می‌شود"""
+        self.members_cache.invalidate((chat_id, user_id))
+        self.admins_cache.invalidate(chat_id)
+
+    def forget_chat(self, chat_id):
+        self.admins_cache.invalidate(chat_id)
+        self.members_cache.invalidate_where(lambda key: key[0] == chat_id)
+
+    def stats(self):
+        return {"admins": self.admins_cache.stats(), "members": self.members_cache.stats()}
+
+
+chat_cache = ChatCache()
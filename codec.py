@@ -0,0 +1,143 @@
+import base64
+import hashlib
+import hmac
+import os
+import zlib
+
+# ======================
+# کدگذاری فشرده callback_data (حداکثر ۶۴ بایت تلگرام)
+# ======================
+MARKER = "~"          # callback_dataهای کدشده با این کاراکتر شروع می‌شوند
+MAX_CALLBACK_BYTES = 64
+TAG_BYTES = 6         # طول HMAC کوتاه‌شده
+
+
+class InvalidCallback(ValueError):
+    """callback_data خراب، ناشناخته یا جعلی"""
+
+
+def _stable_id(text: str, bits: int) -> int:
+    # id پایدار بین ری‌استارت‌ها (وابسته به ترتیب ثبت نیست)
+    return zlib.crc32(text.encode("utf-8")) & ((1 << bits) - 1)
+
+
+def _put_varint(out: bytearray, n: int):
+    n = (n << 1) ^ (n >> 63)  # zigzag تا اعداد منفی (آیدی گروه‌ها) هم کوتاه بمانند
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _get_varint(data: bytes, pos: int):
+    shift = n = 0
+    while True:
+        if pos >= len(data) or shift > 63:
+            raise InvalidCallback("varint خراب")
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (n >> 1) ^ -(n & 1), pos
+        shift += 7
+
+
+class StringTable:
+    """
+    intern کردن رشته‌های طولانی (مثل نام فارسی سناریوها) به id عددی کوتاه.
+    id از crc32 رشته ساخته می‌شود تا بعد از ری‌استارت هم همان بماند.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+
+    def intern(self, text: str) -> int:
+        sid = _stable_id(text, 31)
+        other = self._by_id.get(sid)
+        if other is not None and other != text:
+            raise ValueError(f"برخورد id برای «{text}» و «{other}»")
+        self._by_id[sid] = text
+        return sid
+
+    def lookup(self, sid: int) -> str:
+        try:
+            return self._by_id[sid]
+        except KeyError:
+            raise InvalidCallback(f"رشته ناشناخته {sid}")
+
+    def discard(self, text: str):
+        self._by_id.pop(_stable_id(text, 31), None)
+
+
+class CallbackCodec:
+    """
+    action + آرگومان‌های عددی → MARKER + base64(action_id[2] + varintها + HMAC[6]).
+    مثلا accept_before با دو آیدی کاربر حدود ۲۵ کاراکتر می‌شود.
+    اگر CALLBACK_SECRET تنظیم شده باشد، HMAC اضافه و هنگام decode بررسی می‌شود.
+    """
+
+    def __init__(self, secret=None):
+        self._key = secret.encode("utf-8") if secret else None
+        self._actions = {}   # {action_id: name}
+        self._ids = {}       # {name: action_id}
+
+    def action(self, name: str) -> str:
+        """ثبت یک action؛ برخورد id همان موقع خطا می‌دهد"""
+        aid = _stable_id(name, 16)
+        other = self._actions.get(aid)
+        if other is not None and other != name:
+            raise ValueError(f"برخورد action id برای «{name}» و «{other}»")
+        self._actions[aid] = name
+        self._ids[name] = aid
+        return name
+
+    def _tag(self, payload: bytes) -> bytes:
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:TAG_BYTES]
+
+    def encode(self, action: str, *args: int) -> str:
+        aid = self._ids.get(action)
+        if aid is None:
+            aid = _stable_id(self.action(action), 16)
+        out = bytearray(aid.to_bytes(2, "big"))
+        for arg in args:
+            _put_varint(out, int(arg))
+        if self._key:
+            out += self._tag(bytes(out))
+        data = MARKER + base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode("ascii")
+        if len(data) > MAX_CALLBACK_BYTES:
+            raise ValueError(f"callback_data برای {action} بیشتر از {MAX_CALLBACK_BYTES} بایت است")
+        return data
+
+    def decode(self, data: str):
+        """(action, args) — یک بار decode، بدون split رشته"""
+        if not data or data[0] != MARKER:
+            raise InvalidCallback("کدشده نیست")
+        body = data[1:]
+        try:
+            raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        except Exception:
+            raise InvalidCallback("base64 خراب")
+        if self._key:
+            if len(raw) < 2 + TAG_BYTES:
+                raise InvalidCallback("کوتاه")
+            raw, tag = raw[:-TAG_BYTES], raw[-TAG_BYTES:]
+            if not hmac.compare_digest(tag, self._tag(raw)):
+                raise InvalidCallback("HMAC نامعتبر")
+        if len(raw) < 2:
+            raise InvalidCallback("کوتاه")
+        name = self._actions.get(int.from_bytes(raw[:2], "big"))
+        if name is None:
+            raise InvalidCallback("action ناشناخته")
+        args, pos = [], 2
+        while pos < len(raw):
+            value, pos = _get_varint(raw, pos)
+            args.append(value)
+        return name, tuple(args)
+
+
+callback_codec = CallbackCodec(os.getenv("CALLBACK_SECRET"))
+scenario_ids = StringTable()
@@ -1,49 +1,95 @@
 from aiogram import types
-from loader import dp, bot
 
-# دستورات فارسی و انگلیسی
-COMMANDS = {
-    "تگ همه": "tag_all",
-    "تگ ادمین": "tag_admins",
-    "تگ لیست": "tag_list",
-    "tag all": "tag_all",
-    "tag admins": "tag_admins",
-    "tag list": "tag_list",
-}
+# ======================
+# دستورات متنی (فارسی و انگلیسی)
+# ======================
+GROUP_CHATS = ("group", "supergroup")
 
+# یکسان‌سازی حروف عربی/فارسی و نیم‌فاصله
+_NORMALIZE = str.maketrans({
+    "\u064a": "\u06cc",  # ي → ی
+    "\u0649": "\u06cc",  # ى → ی
+    "\u0643": "\u06a9",  # ك → ک
+    "\u200c": " ",       # ZWNJ (نیم‌فاصله)
+    "\u200d": None,      # ZWJ
+    "\u200e": None,      # LRM
+    "\u200f": None,      # RLM
+    "\u0640": None,      # کشیده (ـ)
+})
 
-async def cmd_tag_all(message: types.Message):
-    await message.reply("🔔 تگ همه: " + ", ".join(["@user1", "@user2"]))
 
+def normalize(text: str) -> str:
+    """«صندلي‌  من» → «صندلی من»؛ فقط یک بار برای هر پیام اجرا می‌شود"""
+    return " ".join(text.translate(_NORMALIZE).lower().split())
 
-async def cmd_tag_admins(message: types.Message):
-    await message.reply("🛡 تگ ادمین‌ها")
 
+class TextCommands:
+    """
+    یک فیلتر واحد برای همه دستورات متنی.
+    متن هر پیام یک بار normalize و با یک lookup در dict به هندلر می‌رسد؛
+    پیام‌های معمولی گفتگو فقط همین یک lookup را هزینه می‌کنند و به هندلرهای بعدی می‌روند.
+    """
 
-async def cmd_tag_players(message: types.Message):
-    await message.reply("🎭 تگ بازیکنان حاضر")
+    def __init__(self):
+        self._exact = {}     # {عبارت normalizeشده: (handler, chat_types)}
+        self._contains = []  # [(کلمه, handler, chat_types)] برای دستوراتی مثل «جایگزین»
+        self.matched = 0
+        self.skipped = 0
 
+    # ---------- ثبت ----------
+    def command(self, *phrases, chats=None):
+        """@text_commands.command("صندلی من") — chats: محدود به نوع چت (مثلا GROUP_CHATS)"""
+        def decorator(handler):
+            for phrase in phrases:
+                key = normalize(phrase)
+                if key in self._exact:
+                    raise ValueError(
+                        f"دستور «{phrase}» دو بار ثبت شده: {self._exact[key][0].__name__} و {handler.__name__}"
+                    )
+                self._exact[key] = (handler, chats)
+            return handler
+        return decorator
 
-# اجرای دستور
-async def run_command(name, message: types.Message):
-    if name == "tag_all":
-        await cmd_tag_all(message)
-    elif name == "tag_admins":
-        await cmd_tag_admins(message)
-    elif name == "tag_list":
-        await cmd_tag_players(message)
+    def contains(self, *words, chats=None):
+        """@text_commands.contains("جایگزین") — هر پیامی که این کلمه را داشته باشد"""
+        def decorator(handler):
+            for word in words:
+                self._contains.append((normalize(word), handler, chats))
+            return handler
+        return decorator
 
+    # ---------- پیدا کردن ----------
+    def resolve(self, message: types.Message):
+        if not message.text:
+            return None
+        text = normalize(message.text)
+        entry = self._exact.get(text)
+        if entry is not None:
+            handler, chats = entry
+            if chats is None or message.chat.type in chats:
+                return handler
+        for word, handler, chats in self._contains:
+            if word in text and (chats is None or message.chat.type in chats):
+                return handler
+        return None
 
-# هندلر متنی
-@dp.message_handler(lambda m: m.text)
-async def handle_text_commands(message: types.Message):
-    text = message.text.strip().lower()
+    def _filter(self, message: types.Message):
+        handler = self.resolve(message)
+        if handler is None:
+            self.skipped += 1
+            return False
+        self.matched += 1
+        return {"text_command": handler}
 
-    if text.startswith("/"):
-        text = text[1:]
+    async def dispatch(self, message: types.Message, text_command):
+        return await text_command(message)
 
-    text = text.replace("‌", " ")
-    text = " ".join(text.split())
+    def register(self, dp):
+        """ثبت به عنوان یک message_handler؛ پیامی که دستور نیست از فیلتر رد می‌شود"""
+        dp.register_message_handler(self.dispatch, self._filter)
 
-    if text in COMMANDS:
-        await run_command(COMMANDS[text], message)
+    def stats(self):
+        return {"commands": len(self._exact), "matched": self.matched, "skipped": self.skipped}
+
+
+text_commands = TextCommands()
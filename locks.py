@@ -0,0 +1,104 @@
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+# ======================
+# قفل‌های ریز برای تغییر وضعیت بازی
+# ======================
+# هر بازی برای هر منبع قفل جدا دارد تا کارهای مستقل (مثلا رزرو و درخواست چالش) پشت هم نمانند
+SEATS = "seats"             # players و player_slots
+WAITING = "waiting"         # waiting_list
+CHALLENGES = "challenges"   # challenge_requests، active_challenger_seats، pending_challenges
+LOCK_ORDER = (SEATS, WAITING, CHALLENGES)   # قفل‌های چندتایی همیشه به این ترتیب گرفته می‌شوند
+
+HOLD_BUCKETS_MS = (1, 5, 20, 100, 500)
+
+
+class _LockStats:
+    __slots__ = ("acquired", "contended", "wait_time", "max_hold", "buckets")
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0      # دفعاتی که قفل در دست کس دیگری بود
+        self.wait_time = 0.0
+        self.max_hold = 0.0
+        self.buckets = [0] * (len(HOLD_BUCKETS_MS) + 1)
+
+    def record_hold(self, seconds):
+        ms = seconds * 1000
+        self.max_hold = max(self.max_hold, seconds)
+        for i, bound in enumerate(HOLD_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        labels = [f"<={b}ms" for b in HOLD_BUCKETS_MS] + [f">{HOLD_BUCKETS_MS[-1]}ms"]
+        return {
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "wait_ms": round(self.wait_time * 1000, 1),
+            "max_hold_ms": round(self.max_hold * 1000, 1),
+            "hold": dict(zip(labels, self.buckets)),
+        }
+
+
+class SessionLocks:
+    """
+    asyncio.Lock به ازای (chat_id، منبع).
+    قفل‌ها weakref نگه داشته می‌شوند و وقتی کسی منتظرشان نیست خودبه‌خود پاک می‌شوند.
+    فقط بخش read-modify-write داخل قفل باشد؛ جواب دادن و بروزرسانی لابی بعد از آزاد شدن.
+
+    رابطه با UpdatePipeline: آپدیت‌های خود گروه در یک lane و پشت سر هم اجرا می‌شوند، پس
+    بین دو کلیک در گروه این قفل‌ها رقابتی ندارند. قفل‌ها برای تغییرهایی هستند که از آن lane
+    نمی‌آیند: دکمه‌های پیوی گرداننده (lane چت خصوصی)، تسک‌های پس‌زمینه و تایمرها،
+    و آپدیت‌هایی که قبل از start شدن pipeline پردازش می‌شوند. تقسیم بر اساس منبع یعنی این مسیرها
+    فقط پشت همان بخشی از وضعیت می‌مانند که واقعا تغییر می‌دهند. contended در stats نشان می‌دهد
+    این حالت‌ها چقدر پیش می‌آیند.
+
+        async with session_locks.hold(session.chat_id, SEATS, WAITING):
+            ...
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()   # {(chat_id, resource): Lock}
+        self._stats = {resource: _LockStats() for resource in LOCK_ORDER}
+
+    def _lock(self, chat_id, resource):
+        key = (chat_id, resource)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, chat_id, *resources):
+        ordered = sorted(set(resources), key=LOCK_ORDER.index)
+        held = []   # [(stats، قفل، زمان گرفتن)]
+        try:
+            for resource in ordered:
+                lock = self._lock(chat_id, resource)
+                stats = self._stats[resource]
+                if lock.locked():
+                    stats.contended += 1
+                started = time.monotonic()
+                await lock.acquire()
+                acquired_at = time.monotonic()
+                stats.wait_time += acquired_at - started
+                stats.acquired += 1
+                held.append((stats, lock, acquired_at))
+            yield
+        finally:
+            now = time.monotonic()
+            for stats, lock, acquired_at in reversed(held):
+                lock.release()
+                stats.record_hold(now - acquired_at)
+
+    def stats(self):
+        return {resource: stats.as_dict() for resource, stats in self._stats.items() if stats.acquired}
+
+
+session_locks = SessionLocks()
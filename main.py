@@ -1,19 +1,39 @@
 import os
-import json
+import math
 import random
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types
+import time
+from aiogram import Dispatcher, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
 import html
-import commands
 from aiogram.utils.exceptions import ChatAdminRequired
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.utils.exceptions import MessageNotModified, MessageToEditNotFound, MessageCantBeEdited
+from aiogram.utils.exceptions import MessageNotModified, MessageToEditNotFound, MessageCantBeEdited, RetryAfter
 import jdatetime
+from session import (
+    DEFAULT_TURN_DURATION, sessions, get_session, open_session, close_session,
+    find_session_for_manager, find_session_for_player,
+)
+from storage import state_store, UpdateOffsetMiddleware
+from render import lobby_renderer, edit_cache
+from timers import turn_timers, timer_edit_budget, countdown_cadence
+from outbound import OutboundBot, outbound, outbound_priority, CRITICAL, LOW
+from tasks import session_tasks
+from temp_messages import temp_messages
+from cache import chat_cache
+from router import callback_router
+from codec import callback_codec, scenario_ids
+from commands import text_commands, GROUP_CHATS
+from roster import roster, RosterMiddleware, mention_chunks
+from scenario_store import scenario_store
+from scenario_picker import ScenarioPicker, PICK, DELETE
+from roles import role_name, FILLER_ROLE_ID
+from pipeline import update_pipeline, PipelineDispatcher
+from locks import session_locks, SEATS, WAITING, CHALLENGES
 class AddScenario(StatesGroup):
     waiting_for_name = State()
     waiting_for_roles = State()
@@ -30,96 +50,81 @@ if not API_TOKEN:
     raise ValueError("API_TOKEN environment variable is not set!")
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=API_TOKEN, parse_mode="HTML")
-dp = Dispatcher(bot, storage=MemoryStorage())
-
-# فقط این گروه اجازه اجرای بازی داره
-#تست
-#ALLOWED_GROUP_ID = -1003080272814
-#اصلی
-ALLOWED_GROUP_ID = -1001760002160
-#چکنویس
-#ALLOWED_GROUP_ID = -1002356353761
+bot = OutboundBot(token=API_TOKEN, parse_mode="HTML")
+# آپدیت‌های هر چت به ترتیب و چت‌های مختلف موازی پردازش می‌شوند
+dp = PipelineDispatcher(bot, storage=MemoryStorage(), pipeline=update_pipeline)
+# RetryAfter یک گروه → تایمرهای همان گروه هم عقب بکشند
+outbound.on_retry_after.append(timer_edit_budget.pause)
+# ویرایش‌های مستقیم (callback.message.edit_text و ...) digest کش ویرایش را باطل می‌کنند
+outbound.on_request.append(edit_cache.note_request)
+# هر پیام گروه، roster اعضا را برای «تگ همه» بروز می‌کند
+dp.middleware.setup(RosterMiddleware(roster))
+# update_id پردازش‌شده ذخیره می‌شود تا بعد از ری‌استارت دکمه‌ها گم نشوند
+update_offsets = UpdateOffsetMiddleware(state_store)
+# laneها خارج از ترتیب تمام می‌کنند؛ offset ذخیره‌شده watermark صف است نه بزرگ‌ترین update_id
+state_store.offset_source = update_pipeline.watermark
+dp.middleware.setup(update_offsets)
+
+# گروه‌های مجاز برای اجرای بازی (با کاما جدا شوند)؛ اگر خالی باشد همه گروه‌ها مجازند
+#تست  -1003080272814
+#اصلی -1001760002160
+#چکنویس -1002356353761
+ALLOWED_GROUP_IDS = {int(x) for x in os.getenv("ALLOWED_GROUP_IDS", "").split(",") if x.strip()}
 
 # ======================
 # متغیرهای سراسری
 # ======================
-players = {}                # بازیکنان: {user_id: name}
-moderator_id = None         # آیدی گرداننده
-selected_scenario = None    # سناریوی انتخابی
-scenarios = {}              # لیست سناریوها
-game_message_id = None
-lobby_message_id = None     # پیام لابی
-group_chat_id = None
-admins = set()
-game_running = False     # وقتی بازی واقعاً شروع شده است (نقش‌ها ارسال شدند)
-lobby_active = False     # وقتی لابی فعال است (انتخاب سناریو و گرداننده)
-turn_order = []             # ترتیب نوبت‌ها
-current_turn_index = 0      # اندیس نوبت فعلی
-current_turn_message_id = None  # پیام پین شده برای نوبت
-turn_timer_task = None      # تسک تایمر نوبت
-player_slots = {}  # {slot_number: user_id}
-challenge_requests = {}  
-pending_challenges = {}
-active_challenger_seats = set()
-challenge_mode = False      # آیا الان در حالت نوبت چالش هستیم؟
-paused_main_player = None   # اگر چالش "قبل" ثبت شد، اینجا id نوبت اصلی ذخیره می‌شود تا بعد از چالش resume شود
-paused_main_duration = None # (اختیاری) مدت زمان نوبت اصلی برای resume — معمولا 120
-DEFAULT_TURN_DURATION = 120  # مقدار پیش‌فرض نوبت اصلی (در صورت تمایل تغییر بده)
-challenges = {}  # {player_id: {"type": "before"/"after", "challenger": user_id}}
-challenge_active = True
-post_challenge_advance = False   # وقتی اجرای چالش 'بعد' باشه، بعد از چالش به نوبت بعدی می‌رویم
-substitute_list = {}  # group_id: {user_id: {"name": name}}
+# وضعیت هر بازی در GameSession (session.py) و به ازای هر گروه نگه‌داری می‌شود
+scenarios = scenario_store  # لیست سناریوها (scenario_store.py)
 players_in_game = {}  # group_id: {seat_number: {"id": user_id, "name": name, "role": role}}
-removed_players = {}  # group_id: {seat_number: {"id": user_id, "name": name, "roles": []}}
-MAX_SEATS = 0        # تعداد صندلی‌ها، بعد از انتخاب سناریو مقداردهی میشه
-waiting_message_id = None
-waiting_list = []     # لیست انتظار جایگزین
-substitute_list = {}  # لیست جایگزین‌ها بر اساس گروه
-extra_turns = []  # لیست بازیکن‌هایی که باید بعد از پایان دور یک ترن اضافه بگیرن
 
-#=======================
-# داده های ریست در شروع روز
-#=======================
-def reset_round_data():
-    global current_turn_index, turn_order, challenge_requests, active_challenger_seats
-    global paused_main_player, paused_main_duration, post_challenge_advance, pending_challenges
-
-    current_turn_index = 0
-    turn_order = []
-    challenge_requests = {}
-    active_challenger_seats = set()
-    paused_main_player = None
-    paused_main_duration = None
-    post_challenge_advance = False
-    pending_challenges = {}
 
 # ======================
 #  لود سناریوها
 # ======================
-def load_scenarios():
-    try:
-        with open("scenarios.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {
-            "سناریو کلاسیک": {"min_players": 5, "max_players": 10, "roles": ["مافیا", "مافیا", "شهروند", "شهروند", "شهروند"]},
-            "سناریو ویژه": {"min_players": 6, "max_players": 12, "roles": ["مافیا", "مافیا", "شهروند", "شهروند", "شهروند", "کارآگاه"]}
-        }
-
-def save_scenarios():
-    with open("scenarios.json", "w", encoding="utf-8") as f:
-        json.dump(scenarios, f, ensure_ascii=False, indent=2)
+def intern_scenario_names(names):
+    # تا دکمه‌های قبل از ری‌استارت (و بعد از ویرایش دستی فایل) هم decode شوند
+    for name in names:
+        scenario_ids.intern(name)
 
-scenarios = load_scenarios()
+scenarios.listeners.append(intern_scenario_names)
+scenarios.load()
+scenario_picker = ScenarioPicker(scenarios)
 
 # ------------------------------
-# انتخاب سناریو → تنظیم MAX_SEATS
+# انتخاب سناریو → تنظیم max_seats
 # ------------------------------
-def set_max_seats_from_scenario(scenario_name: str):
-    global MAX_SEATS
-    roles = scenarios.get(scenario_name, [])
-    MAX_SEATS = len(roles)
+def set_max_seats_from_scenario(session, scenario_name: str):
+    session.max_seats = scenarios.seats(scenario_name) if scenario_name in scenarios else 0
+
+# ================================
+# پیدا کردن بازی مربوط به دکمه
+# ================================
+async def session_for_callback(callback: types.CallbackQuery):
+    """
+    بازی مربوط به یک دکمه را برمی‌گرداند.
+    در گروه از chat.id و در پیوی از بازی‌ای که کاربر گرداننده/مدیر آن است.
+    اگر بازی پیدا نشد پیام خطا نشان داده می‌شود و None برمی‌گردد.
+    """
+    if callback.message.chat.type == "private":
+        session = find_session_for_manager(callback.from_user.id)
+    else:
+        session = get_session(callback.message.chat.id)
+    if session is None:
+        await callback.answer("🚫 هنوز هیچ بازی فعالی شروع نشده.", show_alert=True)
+    return session
+
+
+async def answer_first(callback: types.CallbackQuery, key, coro, text=None, show_alert=False):
+    """
+    اول callback را جواب می‌دهد تا دکمه معطل نماند،
+    بعد بقیه کار را به صورت تسک پس‌زمینه‌ی همان بازی (key = chat_id) اجرا می‌کند.
+    """
+    try:
+        await callback.answer(text, show_alert=show_alert)
+    except Exception:
+        pass
+    return session_tasks.spawn(key, coro)
 
 # ================================
 # تابع تقویم
@@ -131,15 +136,18 @@ def get_jalali_today():
 # ======================
 # مدیریت سناریو
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "manage_scenarios")
+@callback_router.exact("manage_scenarios")
 async def manage_scenarios(callback: types.CallbackQuery):
     # گرفتن لیست ادمین‌ها از گروه اصلی
-    if not group_chat_id:
+    if callback.message.chat.type == "private":
+        session = find_session_for_manager(callback.from_user.id)
+    else:
+        session = get_session(callback.message.chat.id)
+    if not session:
         await callback.answer("❌ هنوز گروهی ثبت نشده.", show_alert=True)
         return
 
-    admins_chat = await bot.get_chat_administrators(group_chat_id)
-    admin_ids = [a.user.id for a in admins_chat]
+    admin_ids = await chat_cache.admin_ids(bot, session.chat_id)
 
     if callback.from_user.id not in admin_ids:
         await callback.answer("❌ فقط ادمین‌های گروه می‌توانند مدیریت سناریو کنند.", show_alert=True)
@@ -155,7 +163,7 @@ async def manage_scenarios(callback: types.CallbackQuery):
 
 
 # شروع افزودن سناریو
-@dp.callback_query_handler(lambda c: c.data == "add_scenario")
+@callback_router.exact("add_scenario")
 async def add_scenario_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer("📝 نام سناریو را وارد کنید:")
     await state.set_state(AddScenario.waiting_for_name)
@@ -192,15 +200,8 @@ async def add_scenario_min_players(message: types.Message, state: FSMContext):
     roles = data["roles"]
     max_players = len(roles)  # حداکثر تعداد بازیکن = تعداد نقش‌ها
 
-    # ذخیره در دیکشنری scenarios
-    scenarios[name] = {
-        "roles": roles,
-        "min_players": min_players,
-        "max_players": max_players
-    }
-
-    # ذخیره در فایل
-    save_scenarios()
+    # ذخیره در حافظه و فایل (اتمیک، خارج از event loop)
+    await scenarios.put(name, roles, min_players)
 
     await message.answer(
         f"✅ سناریو <b>{name}</b> با موفقیت ذخیره شد!\n\n"
@@ -214,21 +215,17 @@ async def add_scenario_min_players(message: types.Message, state: FSMContext):
 
 
 # حذف سناریو
-@dp.callback_query_handler(lambda c: c.data == "remove_scenario")
+@callback_router.exact("remove_scenario")
 async def remove_scenario(callback: types.CallbackQuery):
-    kb = InlineKeyboardMarkup(row_width=1)
-    for scen in scenarios:
-        kb.add(InlineKeyboardButton(f"❌ {scen}", callback_data=f"delete_scen_{scen}"))
-    kb.add(InlineKeyboardButton("⬅ بازگشت", callback_data="manage_scenarios"))
+    kb, _, _ = scenario_picker.keyboard(DELETE)
     await callback.message.edit_text("یک سناریو را برای حذف انتخاب کنید:", reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_scen_"))
-async def delete_scenario(callback: types.CallbackQuery):
-    scen = callback.data.replace("delete_scen_", "")
-    if scen in scenarios:
-        scenarios.pop(scen)
-        save_scenarios()
+@callback_router.encoded("delete_scen")
+async def delete_scenario(callback: types.CallbackQuery, args):
+    scen = scenario_ids.lookup(args[0])
+    if await scenarios.remove(scen):
+        scenario_ids.discard(scen)
         await callback.message.edit_text(f"✅ سناریو «{scen}» حذف شد.", reply_markup=main_menu_keyboard())
     else:
         await callback.answer("⚠ این سناریو وجود ندارد.", show_alert=True)
@@ -236,76 +233,75 @@ async def delete_scenario(callback: types.CallbackQuery):
 # ======================
 # 🎮 مدیریت بازی در پیوی
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "manage_game")
+@callback_router.exact("manage_game")
 async def manage_game_handler(callback: types.CallbackQuery):
     if callback.message.chat.type != "private":
         await callback.answer("⚠️ این گزینه فقط در پیوی کار می‌کند.", show_alert=True)
         return
 
     user_id = callback.from_user.id
-    # 🔴 قبلاً: if not reserved_god or (user_id != reserved_god.get("id") and user_id not in admins):
-    if not moderator_id or (user_id != moderator_id and user_id not in admins):
-        await callback.answer("⛔ فقط گرداننده یا مدیران گروه می‌تونن به منوی مدیریت دسترسی داشته باشن!", show_alert=True)
+    # بازی‌ای که این کاربر گرداننده یا مدیر آن است
+    session = find_session_for_manager(user_id)
+    if not session:
+        await callback.answer("🚫 هنوز هیچ بازی فعالی شروع نشده.", show_alert=True)
         return
 
-    if not group_chat_id:
-        await callback.answer("🚫 هنوز هیچ بازی فعالی شروع نشده.", show_alert=True)
+    # 🔴 قبلاً: if not reserved_god or (user_id != reserved_god.get("id") and user_id not in admins):
+    if not session.moderator_id or (user_id != session.moderator_id and user_id not in session.admins):
+        await callback.answer("⛔ فقط گرداننده یا مدیران گروه می‌تونن به منوی مدیریت دسترسی داشته باشن!", show_alert=True)
         return
 
-    kb = manage_game_keyboard(group_chat_id)
+    kb = manage_game_keyboard(session.chat_id)
     await callback.message.edit_text("🎮 منوی مدیریت بازی:", reply_markup=kb)
     await callback.answer()
 
 # ==============================
 # لیست بعد از انتخاب سر صحبت
 # ==============================
-async def send_turn_order_list():
-    if not turn_order:
+async def send_turn_order_list(session):
+    if not session.turn_order:
         return
 
     text = "👥 لیست بازیکنان (بر اساس نوبت صحبت):\n"
     text += "◤◢◣◥◤◢◣◥◤◢◣◥\n\n"
 
-    for i, seat in enumerate(turn_order, start=1):
-        uid = player_slots.get(seat)
+    for i, seat in enumerate(session.turn_order, start=1):
+        uid = session.player_slots.get(seat)
         if not uid:
             continue
-        name = players.get(uid, "❓")
+        name = session.players.get(uid, "❓")
         mention = f"<a href='tg://user?id={uid}'><b>{html.escape(name)}</b></a>"
         text += f"\u200F{i:02d} {mention}\n"
 
     text += "\n◤◢◣◥◤◢◣◥◤◢◣◥"
-    await bot.send_message(group_chat_id, text, parse_mode="HTML")
+    await bot.send_message(session.chat_id, text, parse_mode="HTML")
 
 
 # -----------------------------
 # اضافه شدن به لیست جایگزین
 # -----------------------------
-@dp.message_handler(lambda m: m.text and "جایگزین" in m.text)
+@text_commands.contains("جایگزین")
 async def add_to_substitute_list(message: types.Message):
-    global substitute_list, group_chat_id
+    session = get_session(message.chat.id)
 
-    if not group_chat_id:
+    if not session:
         await message.reply("⚠️ هنوز هیچ بازی فعالی شروع نشده.")
         return
 
     user_id = message.from_user.id
     user_name = message.from_user.full_name
 
-    # مطمئن میشیم substitute_list ساختار درست داشته باشه
-    if group_chat_id not in substitute_list:
-        substitute_list[group_chat_id] = {}
-
     # جلوگیری از تکرار
-    if user_id in substitute_list[group_chat_id]:
+    if user_id in session.substitute_list:
         await message.reply("ℹ️ شما قبلاً در لیست جایگزین هستید.")
         return
 
     # ذخیره با ساختار درست
-    substitute_list[group_chat_id][user_id] = {
+    session.substitute_list[user_id] = {
         "id": user_id,
         "name": user_name
     }
+    session.mark_dirty()
 
     await message.reply(f"✅ شما به لیست جایگزین اضافه شدید: {user_name}")
 
@@ -313,13 +309,14 @@ async def add_to_substitute_list(message: types.Message):
 # =========================
 # صندلی من
 # =========================
-@dp.message_handler(lambda m: m.text and m.text.strip() == "صندلی من")
+@text_commands.command("صندلی من")
 async def my_seat_handler(message: types.Message):
-    global player_slots, group_chat_id
+    session = get_session(message.chat.id) or find_session_for_player(message.from_user.id)
 
     uid = message.from_user.id
     # پیدا کردن صندلی از player_slots (seat -> uid)
-    seat = next((s for s, u in (player_slots or {}).items() if u == uid), None)
+    seat = session.player_slots.seat_of(uid) if session else None
+
 
     if seat is None:
         await message.reply("⚠️ شما در بازی ثبت نشده‌اید یا هنوز صندلی به شما اختصاص نیافته.")
@@ -330,21 +327,17 @@ async def my_seat_handler(message: types.Message):
 # =========================
 # لیست صندلی
 # =========================
-@dp.message_handler(lambda m: m.text and m.text.strip() == "لیست صندلی")
+@text_commands.command("لیست صندلی")
 async def seats_list_handler(message: types.Message):
-    global player_slots, players, reserved_list, group_chat_id
+    session = get_session(message.chat.id) or find_session_for_player(message.from_user.id)
 
-    # اگر بازی در حال اجراست از player_slots و players استفاده کن، در غیر اینصورت از reserved_list
+    # اگر بازی در حال اجراست از player_slots و players استفاده کن
     text_lines = []
-    if player_slots:
-        for seat in sorted(player_slots.keys()):
-            uid = player_slots.get(seat)
-            name = players.get(uid, "❓") if uid else "---"
+    if session and session.player_slots:
+        for seat in sorted(session.player_slots.keys()):
+            uid = session.player_slots.get(seat)
+            name = session.players.get(uid, "❓") if uid else "---"
             text_lines.append(f"{seat:02d}. {html.escape(name)}")
-    elif reserved_list:
-        for item in reserved_list:
-            name = item.get("player", {}).get("name") if item.get("player") else "---"
-            text_lines.append(f"{item['seat']:02d}. {html.escape(name if name else '---')}")
     else:
         await message.reply("🚫 هیچ لیست صندلی فعالی وجود ندارد.")
         return
@@ -356,25 +349,21 @@ async def seats_list_handler(message: types.Message):
 # =========================
 # نقش من (فقط در پیوی)
 # =========================
-@dp.message_handler(lambda m: m.text and m.text.strip() == "نقش من")
+@text_commands.command("نقش من")
 async def my_role_handler(message: types.Message):
-    global last_role_map, group_chat_id
 
     if message.chat.type != "private":
         await message.reply("ℹ️ برای دریافت نقش، لطفاً در پیوی این پیام را ارسال کنید: «نقش من»")
         return
 
     uid = message.from_user.id
-    # نقش‌ها ممکنه در last_role_map یا player_roles ذخیره شده باشه
-    role = None
-    if globals().get("last_role_map"):
-        role = last_role_map.get(uid)
-    if not role and globals().get("player_roles"):
-        role = globals().get("player_roles").get(uid)
-
-    if role:
+    # نقش‌ها در last_role_map بازی‌ای که کاربر در آن است ذخیره شده
+    session = find_session_for_player(uid)
+    role = session.last_role_map.get(uid) if session else None
+
+    if role is not None:
         # نقش خصوصی به کاربر در پیوی ارسال می‌شود
-        await message.reply(f"🔐 نقش شما: {html.escape(str(role))}")
+        await message.reply(f"🔐 نقش شما: {html.escape(role_name(role))}")
     else:
         await message.reply("⚠️ هنوز نقشی برای شما اختصاص داده نشده یا بازی شروع نشده.")
 
@@ -382,27 +371,33 @@ async def my_role_handler(message: types.Message):
 # =========================
 # لیست بازیکنان (فقط گرداننده یا مدیران)
 # =========================
-@dp.message_handler(lambda m: m.text and m.text.strip() == "لیست بازیکنان")
+@text_commands.command("لیست بازیکنان")
 async def show_players_handler(message: types.Message):
-    global group_chat_id, reserved_god, players, player_slots, group_admins, bot
+    uid = message.from_user.id
+    if message.chat.type in ["group", "supergroup"]:
+        session = get_session(message.chat.id)
+    else:
+        session = find_session_for_manager(uid)
+
+    if not session:
+        await message.reply("🚫 هیچ بازیکنی در بازی ثبت نشده است.")
+        return
 
     # در گروه: بررسی اینکه فرستنده ادمین هست یا نه
     is_allowed = False
-    uid = message.from_user.id
 
     # اگر فرستنده گرداننده باشه اجازه بده
-    if reserved_god and uid == reserved_god.get("id"):
+    if uid == session.moderator_id:
         is_allowed = True
     else:
         # اگر پیام در گروه باشه، چک کن او ادمین است
         if message.chat.type in ["group", "supergroup"]:
-            member = await bot.get_chat_member(message.chat.id, uid)
+            member = await chat_cache.member(bot, message.chat.id, uid)
             if member.status in ["creator", "administrator"]:
                 is_allowed = True
         else:
-            # اگر در پیویه، سعی کن group_admins رو آپدیت کنی و چک کن
-            await ensure_group_admins()
-            if uid in (group_admins or []):
+            # اگر در پیویه، از لیست مدیران همان بازی چک کن
+            if uid in session.admins:
                 is_allowed = True
 
     if not is_allowed:
@@ -410,11 +405,11 @@ async def show_players_handler(message: types.Message):
         return
 
     # ساخت متن لیست بازیکنان
-    if player_slots:
+    if session.player_slots:
         lines = []
-        for seat in sorted(player_slots.keys()):
-            uid = player_slots.get(seat)
-            name = players.get(uid, "❓") if uid else "---"
+        for seat in sorted(session.player_slots.keys()):
+            uid = session.player_slots.get(seat)
+            name = session.players.get(uid, "❓") if uid else "---"
             lines.append(f"{seat:02d}. {html.escape(name)}")
         text = "📜 لیست بازیکنان:\n\n" + "\n".join(lines)
     else:
@@ -426,27 +421,27 @@ async def show_players_handler(message: types.Message):
 # =========================
 # وضعیت بازی
 # =========================
-@dp.message_handler(lambda m: m.text and m.text.strip() == "وضعیت بازی")
+@text_commands.command("وضعیت بازی")
 async def game_status_handler(message: types.Message):
-    global group_chat_id, players, player_slots, reserved_list, reserved_scenario, round_active, turn_order
+    session = get_session(message.chat.id) or find_session_for_player(message.from_user.id)
+    if not session:
+        await message.reply("⚠️ هنوز هیچ بازی فعالی شروع نشده.")
+        return
 
-    num_players = len(players) if globals().get("players") else 0
+    num_players = len(session.players)
     seats_total = None
-    if globals().get("reserved_list"):
-        seats_total = len(reserved_list)
-    else:
-        try:
-            if reserved_scenario:
-                seats_total = len(scenarios[reserved_scenario]["roles"])
-        except Exception:
-            seats_total = None
+    try:
+        if session.selected_scenario:
+            seats_total = scenarios.seats(session.selected_scenario)
+    except Exception:
+        seats_total = None
 
     text = "🔎 وضعیت بازی:\n\n"
     text += f"تعداد بازیکنان ثبت‌شده: {num_players}\n"
     text += f"مجموع صندلی‌ها: {seats_total if seats_total is not None else '---'}\n"
-    text += f"سناریو: {reserved_scenario or '---'}\n"
-    text += f"وضعیت دور: {'فعال' if round_active else 'غیرفعال'}\n"
-    text += f"ترتیب نوبت: {len(turn_order) if globals().get('turn_order') else 0}\n"
+    text += f"سناریو: {session.selected_scenario or '---'}\n"
+    text += f"وضعیت دور: {'فعال' if session.round_active else 'غیرفعال'}\n"
+    text += f"ترتیب نوبت: {len(session.turn_order)}\n"
 
     await message.reply(text)
 
@@ -454,36 +449,33 @@ async def game_status_handler(message: types.Message):
 # =============================
 # خروج بازیکن (فقط در لابی)
 # =============================
-@dp.message_handler(lambda m: m.chat.type in ["group", "supergroup"] and m.text and m.text.strip() == "خروج")
+@text_commands.command("خروج", chats=GROUP_CHATS)
 async def leave_game(message: types.Message):
-    global round_active
-
-    group_id = message.chat.id
+    session = get_session(message.chat.id)
     user_id = message.from_user.id
 
+    if not session:
+        await message.reply("⚠️ شما در حال حاضر داخل بازی نیستید.")
+        return
+
     # بررسی اینکه هنوز دور شروع نشده (لابی فعال باشه)
-    if round_active:
+    if session.round_active:
         await message.reply("⚠️ بعد از شروع بازی امکان خروج وجود ندارد.")
         return
 
     # بررسی اینکه بازیکن داخل بازی هست یا نه
-    if user_id not in players:
+    if user_id not in session.players:
         await message.reply("⚠️ شما در حال حاضر داخل بازی نیستید.")
         return
 
     # پیدا کردن شماره صندلی بازیکن
-    seat_to_remove = None
-    for seat, uid in player_slots.items():
-        if uid == user_id:
-            seat_to_remove = seat
-            break
-
     # حذف بازیکن از players و player_slots
-    name = players.pop(user_id, "❓")
+    name = session.players.pop(user_id, "❓")
+    seat_to_remove = session.player_slots.free_player(user_id)
     if seat_to_remove:
-        player_slots.pop(seat_to_remove, None)
+        session.removed_players[seat_to_remove] = {"id": user_id, "name": name}  # برای ثبت در لیست حذف‌شده‌ها
+    session.mark_dirty()
 
-    removed_players[user_id] = name  # برای ثبت در لیست حذف‌شده‌ها
 
     await message.reply(f"🚪 بازیکن {html.escape(name)} از بازی خارج شد (صندلی {seat_to_remove}).")
 
@@ -492,7 +484,7 @@ async def leave_game(message: types.Message):
 # =========================
 # راهنما / help (عمومی)
 # =========================
-@dp.message_handler(lambda m: m.text and m.text.strip() in ["راهنما", "/help"])
+@text_commands.command("راهنما", "/help")
 async def help_handler(message: types.Message):
     help_text = (
         "📚 راهنمای دستورات ربات:\n\n"
@@ -513,26 +505,27 @@ async def help_handler(message: types.Message):
 # ======================
 # لیست بازیکنان
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "list_players")
+@callback_router.exact("list_players")
 async def list_players_handler(callback: types.CallbackQuery):
     # فقط پیوی
     if callback.message.chat.type != "private":
         await callback.answer()
         return
 
-    # چک کن که group_chat_id ست شده باشه
-    if not group_chat_id:
+    # چک کن که بازی‌ای برای این کاربر ست شده باشه
+    session = find_session_for_manager(callback.from_user.id)
+    if not session:
         await callback.message.answer("🚫 هنوز لابی/گروهی ست نشده است.")
         await callback.answer()
         return
 
     # استفاده از player_slots برای ترتیب صندلی‌ها
-    seats = sorted(player_slots.items())  # [(seat, user_id), ...]
+    seats = sorted(session.player_slots.items())  # [(seat, user_id), ...]
     if not seats:
         # اگر هیچ صندلی‌ای ثبت نشده، fallback به players (اگر players دیکشنریه)
-        if isinstance(players, dict) and players:
+        if isinstance(session.players, dict) and session.players:
             text = "👥 لیست بازیکنان (بدون صندلی):\n"
-            for i, (uid, name) in enumerate(players.items(), start=1):
+            for i, (uid, name) in enumerate(session.players.items(), start=1):
                 text += f"{i}. <a href='tg://user?id={uid}'>{html.escape(name)}</a>\n"
         else:
             await callback.message.answer("👥 هیچ بازیکنی ثبت نشده است.")
@@ -541,7 +534,7 @@ async def list_players_handler(callback: types.CallbackQuery):
     else:
         text = "👥 لیست بازیکنان (بر اساس شماره صندلی):\n"
         for seat, uid in seats:
-            name = players.get(uid, "❓")
+            name = session.players.get(uid, "❓")
             text += f"{seat}. <a href='tg://user?id={uid}'>{html.escape(name)}</a>\n"
 
     await callback.message.answer(text, parse_mode="HTML")
@@ -598,7 +591,7 @@ def manage_game_keyboard(group_id: int):
     kb.add(InlineKeyboardButton("🔇 سکوت بازیکن", callback_data="mute_player"))     # ➕ سکوت
     kb.add(InlineKeyboardButton("🔊 حذف سکوت", callback_data="unmute_player"))     # ➕ حذف سکوت
     kb.add(InlineKeyboardButton("⚔ وضعیت چالش", callback_data="challenge_status"))
-    kb.add(InlineKeyboardButton("🚫 لغو بازی", callback_data=f"cancel_{group_id}"))
+    kb.add(InlineKeyboardButton("🚫 لغو بازی", callback_data=callback_codec.encode("cancel_group", group_id)))
     kb.add(InlineKeyboardButton("⬅️ بازگشت", callback_data="back_main"))
     return kb
 
@@ -608,126 +601,96 @@ def manage_game_keyboard(group_id: int):
 # =========================
 # پیام موقتی
 async def send_temp_message(chat_id, text, delay=5, **kwargs):
-    msg = await bot.send_message(chat_id, text, **kwargs)
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id, msg.message_id)
-    except:
-        pass
+    """پیام می‌فرستد و حذفش را بعد از delay ثانیه به temp_messages می‌سپارد (بدون sleep)"""
+    with outbound_priority(LOW):
+        msg = await bot.send_message(chat_id, text, **kwargs)
+    temp_messages.schedule(chat_id, msg.message_id, delay)
+    return msg
 
 # ========================
 # لیست مدیران
 # ========================
-async def update_group_admins(bot, chat_id):
+async def update_group_admins(bot, session):
     """به‌روزرسانی لیست مدیران گروه"""
-    global group_admins
-    admins = await bot.get_chat_administrators(chat_id)
-    group_admins = [admin.user.id for admin in admins]
+    session.admins = await chat_cache.admin_ids(bot, session.chat_id)
     
 
-# ======================
-# مدیریت بازی در پیوی
-# ======================
-async def manage_game_handler(callback: types.CallbackQuery):
-    # فقط در پیوی کار کنه
-    if callback.message.chat.type != "private":
-        return
-
-    group_id = group_chat_id  # یا اگر چند گروه داری باید با تابع پیدا کنی
-    await callback.message.edit_text(
-        "🎮 مدیریت بازی:",
-        reply_markup=manage_game_keyboard(group_id)
-    )
-    await callback.answer()
-
-
 
 # -------------------------
 # اضافه شدن به لیست رزرو (دکمه)
 # -------------------------
-@dp.callback_query_handler(lambda c: c.data == "reserve_waiting")
+@callback_router.exact("reserve_waiting")
 async def reserve_waiting(callback: types.CallbackQuery):
-    global waiting_list
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     user_id = callback.from_user.id
     user_name = callback.from_user.full_name
 
-    # 1) اگر بازیکن در لیست اصلی است → اجازه نده
-    if user_id in players:
+    async with session_locks.hold(session.chat_id, WAITING):
+        # 1) اگر بازیکن در لیست اصلی است → اجازه نده
+        in_game = user_id in session.players
+        # 2) جلوگیری از اضافه شدن تکراری
+        duplicate = not in_game and any(w.get("id") == user_id for w in session.waiting_list)
+        # 3) ثبت با ساختار ثابت (dict)
+        if not in_game and not duplicate:
+            session.waiting_list.append({"id": user_id, "name": user_name})
+            session.mark_dirty()
+
+    if in_game:
         await callback.answer("⚠️ شما در حال حاضر در لیست اصلی بازی هستید و نمی‌توانید در لیست رزرو باشید.", show_alert=True)
         return
-
-    # 2) جلوگیری از اضافه شدن تکراری
-    if any(w.get("id") == user_id for w in waiting_list):
+    if duplicate:
         await callback.answer("ℹ️ شما قبلاً در لیست رزرو هستید.", show_alert=True)
         # اما اگر پیام لیست رزرو ناقص است، آن را آپدیت کن
-        await update_waiting_list_message()
+        await update_waiting_list_message(session)
         return
 
-    # 3) ثبت با ساختار ثابت (dict)
-    waiting_list.append({"id": user_id, "name": user_name})
-
     await callback.answer("✅ شما به لیست رزرو اضافه شدید.")
     # به‌روزرسانی پیام لیست رزرو و لابی (در صورت نیاز)
-    await update_waiting_list_message()
-    await update_lobby()
+    await update_waiting_list_message(session)
+    await update_lobby(session)
 # =========================
 # کنسل رزرو
 # =========================
-@dp.callback_query_handler(lambda c: c.data == "cancel_seat")
+@callback_router.exact("cancel_seat")
 async def cancel_seat(callback: types.CallbackQuery):
-    global reserved_list, waiting_list
+    session = await session_for_callback(callback)
+    if not session:
+        return
     user_id = callback.from_user.id
 
-    seat_info = next((s for s in reserved_list if s["player"] and s["player"]["id"] == user_id), None)
-    if seat_info:
-        seat_info["player"] = None
-        await callback.answer("❌ رزرو شما لغو شد")
-        if waiting_list:
-            next_user = waiting_list.pop(0)
-            seat_info["player"] = next_user
+    async with session_locks.hold(session.chat_id, SEATS, WAITING):
+        seat = session.player_slots.free_player(user_id)
+        if seat is not None and session.waiting_list:
+            next_user = session.waiting_list.pop(0)
+            session.players[next_user["id"]] = next_user["name"]
+            session.player_slots[seat] = next_user["id"]
+            session.mark_dirty()
 
-        await update_reserved_message(callback.message)
+    if seat is not None:
+        await callback.answer("❌ رزرو شما لغو شد")
+        await update_lobby(session)
     else:
         await callback.answer("⚠️ شما صندلی رزرو نکرده‌اید", show_alert=True)
 
-#=======================
-# لیست بازیکنان
-#=======================
-@dp.callback_query_handler(lambda c: c.data == "list_players")
-async def list_players_handler(callback: types.CallbackQuery):
-    if callback.message.chat.type != "private":
-        await callback.answer()
-        return
-
-    global players  # فرض: players لیستی از دیکشنری بازیکنان فعلیه
-    if not players:
-        await callback.message.answer("👥 هیچ بازیکنی در بازی نیست.")
-        await callback.answer()
-        return
-
-    text = "👥 لیست بازیکنان:\n\n"
-    for p in players:
-        text += f"{p['seat']} - <a href='tg://user?id={p['id']}'>{p['name']}</a>\n"
-
-    await callback.message.answer(text, parse_mode="HTML")
-    await callback.answer()
-
 # ===================================
 # لیست بازیکنان و نقش ها
 # ===================================
-async def show_roles_list(user_id: int):
+async def show_roles_list(session, user_id: int):
+
     """
     ارسال لیست نقش‌ها و بازیکنان برای گرداننده در پیوی
     """
-    if not selected_scenario:
+    if not session.selected_scenario:
         return
 
     # 📆 تاریخ روز شمسی
-    today = JalaliDate.today().strftime("%Y/%m/%d")
+    today = jdatetime.date.today().strftime("%Y/%m/%d")
 
-    max_players = len(scenarios[selected_scenario]["roles"])
-    current_players = len(players)
+    max_players = scenarios.seats(session.selected_scenario)
+    current_players = len(session.players)
 
     # 📝 هدر لیست
     text = (
@@ -735,8 +698,8 @@ async def show_roles_list(user_id: int):
         "    Mafia Nights\n\n"
         f"⏱ Time : 21:00\n"
         f"📆 Date : {today}\n"
-        f"🗓 Scenario : {selected_scenario}\n"
-        f"👮‍♂ God : {players.get(moderator_id, '---')}\n\n"
+        f"🗓 Scenario : {session.selected_scenario}\n"
+        f"👮‍♂ God : {session.players.get(session.moderator_id, '---')}\n\n"
         f"👥 Players : {current_players}/{max_players}\n\n"
         " ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ \n"
         "        لیست بازیکنان\n"
@@ -744,9 +707,9 @@ async def show_roles_list(user_id: int):
     )
 
     # 📋 لیست بازیکنان بر اساس شماره صندلی
-    for seat in sorted(player_slots.keys()):
-        uid = player_slots[seat]
-        name = players.get(uid, "❓")
+    for seat in sorted(session.player_slots.keys()):
+        uid = session.player_slots[seat]
+        name = session.players.get(uid, "❓")
         mention = f"<b><a href='tg://user?id={uid}'>{html.escape(name)}</a></b>"
         text += f"{seat:02d} {mention}\n"
 
@@ -762,41 +725,41 @@ async def show_roles_list(user_id: int):
 #=======================
 # ارسال نقش ها
 #=======================
-@dp.callback_query_handler(lambda c: c.data == "resend_roles")
+@callback_router.exact("resend_roles")
 async def resend_roles_handler(callback: types.CallbackQuery):
     if callback.message.chat.type != "private":
         await callback.answer()
         return
 
-    if not group_chat_id:
+    session = find_session_for_manager(callback.from_user.id)
+    if not session:
         await callback.message.answer("🚫 هنوز هیچ بازی فعالی وجود ندارد.")
         await callback.answer()
         return
 
     # بررسی وجود نقش‌های قبلی
-    global last_role_map
-    if not last_role_map:
+    if not session.last_role_map:
         await callback.message.answer("⚠️ نقش‌ها هنوز پخش نشده‌اند؛ ابتدا «پخش نقش» در گروه را بزنید.")
         await callback.answer()
         return
 
     # ارسال نقش به هر بازیکن
     sent = 0
-    if player_slots:
-        for seat in sorted(player_slots.keys()):
-            uid = player_slots[seat]
-            role = last_role_map.get(uid, "❓")
+    if session.player_slots:
+        for seat in sorted(session.player_slots.keys()):
+            uid = session.player_slots[seat]
+            role = role_name(session.last_role_map.get(uid))
             try:
-                await bot.send_message(uid, f"🎭 نقش شما: {html.escape(str(role))}")
+                await bot.send_message(uid, f"🎭 نقش شما: {html.escape(role)}")
                 sent += 1
             except Exception as e:
                 logging.warning("⚠️ ارسال نقش به %s خطا: %s", uid, e)
     else:
         # fallback
-        for uid in players.keys():
-            role = last_role_map.get(uid, "❓")
+        for uid in session.players.keys():
+            role = role_name(session.last_role_map.get(uid))
             try:
-                await bot.send_message(uid, f"🎭 نقش شما: {html.escape(str(role))}")
+                await bot.send_message(uid, f"🎭 نقش شما: {html.escape(role)}")
                 sent += 1
             except Exception as e:
                 logging.warning("⚠️ ارسال نقش به %s خطا: %s", uid, e)
@@ -810,16 +773,16 @@ async def resend_roles_handler(callback: types.CallbackQuery):
     fancy_text = "༄\n    Mafia Nights\n\n"
     fancy_text += "⏱ Time : 21:00\n"
     fancy_text += f"📆 Date : {get_jalali_today()}\n"
-    fancy_text += f"🗓 Scenario : {selected_scenario}\n"
-    fancy_text += f"👮‍♂ God : {players.get(moderator_id, '❓')}\n\n"
+    fancy_text += f"🗓 Scenario : {session.selected_scenario}\n"
+    fancy_text += f"👮‍♂ God : {session.players.get(session.moderator_id, '❓')}\n\n"
     fancy_text += " ~ ~ ~ ~ ~ ~ ~ ~ ~ ~ \n"
     fancy_text += "          لیست نقش‌ها\n"
     fancy_text += "◤◢◣◥◤◢◣◥◤◢◣◥\n\n"
 
-    for seat in sorted(player_slots.keys()):
-        uid = player_slots[seat]
-        role = last_role_map.get(uid, "❓")
-        name = players.get(uid, "❓")
+    for seat in sorted(session.player_slots.keys()):
+        uid = session.player_slots[seat]
+        role = role_name(session.last_role_map.get(uid))
+        name = session.players.get(uid, "❓")
         mention = f"<a href='tg://user?id={uid}'><b>{html.escape(name)}</b></a>"
         fancy_text += f"\u200E{seat:02d} {mention} — {html.escape(role)}\n"
 
@@ -827,7 +790,7 @@ async def resend_roles_handler(callback: types.CallbackQuery):
 
     # ارسال لیست به گرداننده
     try:
-        await bot.send_message(moderator_id, fancy_text, parse_mode="HTML")
+        await bot.send_message(session.moderator_id, fancy_text, parse_mode="HTML")
     except Exception as e:
         logging.warning("⚠️ ارسال لیست نقش‌ها به گرداننده شکست خورد: %s", e)
 
@@ -838,13 +801,17 @@ async def resend_roles_handler(callback: types.CallbackQuery):
 # -----------------------------
 # جایگزینی بازیکن - نمایش لیست جایگزین‌ها
 # -----------------------------
-@dp.callback_query_handler(lambda c: c.data == "replace_player")
+@callback_router.exact("replace_player")
 async def replace_player_list_handler(callback: types.CallbackQuery):
     if callback.message.chat.type != "private":
         await callback.answer()
         return
 
-    subs = substitute_list.get(group_chat_id, {})
+    session = await session_for_callback(callback)
+    if not session:
+        return
+
+    subs = session.substitute_list
     if not subs:
         await callback.message.answer("🚫 لیست جایگزین‌ها خالی است.")
         await callback.answer()
@@ -853,7 +820,7 @@ async def replace_player_list_handler(callback: types.CallbackQuery):
     kb = InlineKeyboardMarkup(row_width=1)
     for uid, info in subs.items():
         name = info.get("name") or "❓"
-        kb.add(InlineKeyboardButton(html.escape(name), callback_data=f"choose_sub_{uid}"))
+        kb.add(InlineKeyboardButton(html.escape(name), callback_data=callback_codec.encode("choose_sub", uid)))
 
     await callback.message.answer("👥 لیست جایگزین‌ها:", reply_markup=kb)
     await callback.answer()
@@ -862,12 +829,15 @@ async def replace_player_list_handler(callback: types.CallbackQuery):
 # -----------------------------
 # انتخاب بازیکن اصلی برای جایگزینی
 # -----------------------------
-@dp.callback_query_handler(lambda c: c.data.startswith("choose_sub_"))
-async def choose_substitute_for_replace(callback: types.CallbackQuery):
-    uid_sub = int(callback.data.replace("choose_sub_", ""))
+@callback_router.encoded("choose_sub")
+async def choose_substitute_for_replace(callback: types.CallbackQuery, args):
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    uid_sub, = args
 
     # بازیکنان فعلی
-    current = {seat: players.get(uid, "❓") for seat, uid in player_slots.items()}
+    current = {seat: session.players.get(uid, "❓") for seat, uid in session.player_slots.items()}
     if not current:
         await callback.message.answer("🚫 هیچ بازیکنی در بازی نیست.")
         await callback.answer()
@@ -876,7 +846,7 @@ async def choose_substitute_for_replace(callback: types.CallbackQuery):
     kb = InlineKeyboardMarkup(row_width=1)
     for seat, name in sorted(current.items()):
         label = f"{seat}. {html.escape(name)}"
-        kb.add(InlineKeyboardButton(label, callback_data=f"do_replace_{uid_sub}_{seat}"))
+        kb.add(InlineKeyboardButton(label, callback_data=callback_codec.encode("do_replace", uid_sub, seat)))
 
     await callback.message.answer("👤 بازیکن جایگزین، بازیکن فعلی را انتخاب کنید:", reply_markup=kb)
     await callback.answer()
@@ -885,70 +855,71 @@ async def choose_substitute_for_replace(callback: types.CallbackQuery):
 # -----------------------------
 # انجام جایگزینی
 # -----------------------------
-@dp.callback_query_handler(lambda c: c.data.startswith("do_replace_"))
-async def do_replace_handler(callback: types.CallbackQuery):
+@callback_router.encoded("do_replace")
+async def do_replace_handler(callback: types.CallbackQuery, args):
     try:
-        _, _, uid_sub_str, seat_str = callback.data.split("_")
-        uid_sub = int(uid_sub_str)
-        seat = int(seat_str)
-    except Exception:
+        uid_sub, seat = args
+    except ValueError:
         await callback.answer("⚠️ داده جایگزینی نامعتبر است.", show_alert=True)
         return
 
-    subs = substitute_list.get(group_chat_id, {})
-    sub_info = subs.pop(uid_sub, None)
+    session = await session_for_callback(callback)
+    if not session:
+        return
+
+    sub_info = session.substitute_list.pop(uid_sub, None)
     if not sub_info:
         await callback.message.answer("⚠️ جایگزینی پیدا نشد.")
         await callback.answer()
         return
 
     # بازیکن قدیمی
-    old_uid = player_slots.get(seat)
-    old_name = players.pop(old_uid, "❓") if old_uid in players else "❓"
+    old_uid = session.player_slots.get(seat)
+    old_name = session.players.pop(old_uid, "❓") if old_uid in session.players else "❓"
 
     # جایگزین جدید
-    players[uid_sub] = sub_info.get("name", f"User{uid_sub}")
-    player_slots[seat] = uid_sub
+    session.players[uid_sub] = sub_info.get("name", f"User{uid_sub}")
+    session.player_slots[seat] = uid_sub
 
     # انتقال نقش در صورت وجود
-    global last_role_map
-    if old_uid and last_role_map and old_uid in last_role_map:
-        last_role_map[uid_sub] = last_role_map.pop(old_uid)
+    if old_uid and session.last_role_map and old_uid in session.last_role_map:
+        session.last_role_map[uid_sub] = session.last_role_map.pop(old_uid)
+    session.mark_dirty()
 
-    await callback.message.answer(
-        f"✅ بازیکن {html.escape(old_name)} با {html.escape(players[uid_sub])} جایگزین شد (صندلی {seat})."
-    )
-    await callback.answer()
+    await answer_first(callback, session.chat_id, callback.message.answer(
+        f"✅ بازیکن {html.escape(old_name)} با {html.escape(session.players[uid_sub])} جایگزین شد (صندلی {seat})."
+    ))
 
 #=======================
 # حذف بازیکن
 #=======================
-@dp.callback_query_handler(lambda c: c.data == "remove_player")
+@callback_router.exact("remove_player")
 async def remove_player_handler(callback: types.CallbackQuery):
     if callback.message.chat.type != "private":
         await callback.answer()
         return
 
-    if not group_chat_id:
+    session = find_session_for_manager(callback.from_user.id)
+    if not session:
         await callback.message.answer("🚫 هنوز هیچ بازی فعالی وجود ندارد.")
         await callback.answer()
         return
 
     # اگر player_slots پر است: لیست بر اساس صندلی
-    if player_slots:
+    if session.player_slots:
         kb = InlineKeyboardMarkup(row_width=1)
-        for seat in sorted(player_slots.keys()):
-            uid = player_slots[seat]
-            name = players.get(uid, "❓")
+        for seat in sorted(session.player_slots.keys()):
+            uid = session.player_slots[seat]
+            name = session.players.get(uid, "❓")
             kb.add(InlineKeyboardButton(f"{seat}. {html.escape(name)}", callback_data=f"confirm_remove_{seat}"))
         await callback.message.answer("🗑 لطفاً بازیکنی که می‌خواهید حذف شود را انتخاب کنید:", reply_markup=kb)
         await callback.answer()
         return
 
     # fallback: اگر فقط players دیکشنری است
-    if isinstance(players, dict) and players:
+    if isinstance(session.players, dict) and session.players:
         kb = InlineKeyboardMarkup(row_width=1)
-        for uid, name in players.items():
+        for uid, name in session.players.items():
             kb.add(InlineKeyboardButton(html.escape(name), callback_data=f"confirm_remove_uid_{uid}"))
         await callback.message.answer("🗑 بازیکنی را انتخاب کنید:", reply_markup=kb)
         await callback.answer()
@@ -959,34 +930,38 @@ async def remove_player_handler(callback: types.CallbackQuery):
 
 
 # پردازش تایید حذف بر اساس صندلی
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_remove_"))
+@callback_router.prefix("confirm_remove_")
 async def remove_player_confirm(callback: types.CallbackQuery):
+    session = await session_for_callback(callback)
+    if not session:
+        return
     data = callback.data
     # دو حالت: confirm_remove_{seat} یا confirm_remove_uid_{uid}
     if data.startswith("confirm_remove_uid_"):
         uid = int(data.replace("confirm_remove_uid_", ""))
         # جستجو برای صندلی (اگر وجود داشته باشه)
-        seat = next((s for s, u in player_slots.items() if u == uid), None)
+        seat = session.player_slots.seat_of(uid)
     else:
         seat = int(data.replace("confirm_remove_", ""))
-        uid = player_slots.get(seat)
+        uid = session.player_slots.get(seat)
 
     if uid is None:
         await callback.message.answer("⚠️ بازیکن پیدا نشد.")
         await callback.answer()
         return
 
-    # حذف از player_slots و players؛ و اضافه شدن به removed_players[group]
-    removed_players.setdefault(group_chat_id, {})[seat] = {"id": uid, "name": players.get(uid, "❓")}
+    # حذف از player_slots و players؛ و اضافه شدن به removed_players
+    session.removed_players[seat] = {"id": uid, "name": session.players.get(uid, "❓")}
     # حذف از players dict اگر موجوده
     try:
-        if uid in players:
-            del players[uid]
+        if uid in session.players:
+            del session.players[uid]
     except Exception:
         pass
 
-    if seat in player_slots:
-        del player_slots[seat]
+    if seat in session.player_slots:
+        del session.player_slots[seat]
+    session.mark_dirty()
 
     await callback.message.answer(f"✅ بازیکن با آی‌دی {uid} حذف شد و به لیست خارج‌شده‌ها منتقل شد.")
     await callback.answer()
@@ -996,18 +971,19 @@ async def remove_player_confirm(callback: types.CallbackQuery):
 #=======================
 # تولد بازیکن
 #=======================
-@dp.callback_query_handler(lambda c: c.data == "player_birthday")
+@callback_router.exact("player_birthday")
 async def birthday_player_handler(callback: types.CallbackQuery):
     if callback.message.chat.type != "private":
         await callback.answer()
         return
 
-    if not group_chat_id:
+    session = find_session_for_manager(callback.from_user.id)
+    if not session:
         await callback.message.answer("🚫 هنوز هیچ بازی فعالی وجود ندارد.")
         await callback.answer()
         return
 
-    removed = removed_players.get(group_chat_id, {})
+    removed = session.removed_players
     if not removed:
         await callback.message.answer("🚫 لیست بازیکنان خارج‌شده خالی است.")
         await callback.answer()
@@ -1021,10 +997,13 @@ async def birthday_player_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_revive_"))
+@callback_router.prefix("confirm_revive_")
 async def birthday_player_confirm(callback: types.CallbackQuery):
+    session = await session_for_callback(callback)
+    if not session:
+        return
     seat = int(callback.data.replace("confirm_revive_", ""))
-    info = removed_players.get(group_chat_id, {}).pop(seat, None)
+    info = session.removed_players.pop(seat, None)
     if not info:
         await callback.message.answer("⚠️ موردی برای بازگرداندن پیدا نشد.")
         await callback.answer()
@@ -1033,8 +1012,9 @@ async def birthday_player_confirm(callback: types.CallbackQuery):
     uid = info["id"]
     name = info.get("name", "❓")
     # بازگرداندن به players و player_slots
-    players[uid] = name
-    player_slots[seat] = uid
+    session.players[uid] = name
+    session.player_slots[seat] = uid
+    session.mark_dirty()
 
     await callback.message.answer(f"✅ بازیکن {html.escape(name)} با صندلی {seat} بازگردانده شد.")
     await callback.answer()
@@ -1044,25 +1024,31 @@ async def birthday_player_confirm(callback: types.CallbackQuery):
 #=======================
 # لغو بازی
 #=======================
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_"))
-async def cancel_game_handler(callback: types.CallbackQuery):
-    global players, removed_players, substitute_list
+@callback_router.encoded("cancel_group")
+async def cancel_game_handler(callback: types.CallbackQuery, args):
 
     user_id = callback.from_user.id
-    chat_id = callback.message.chat.id
+    # آیدی گروه از دکمه‌ی پنل پیوی
+    chat_id = args[0] if args else callback.message.chat.id
+
+    session = get_session(chat_id)
+    if not session:
+        await callback.answer("🚫 هنوز هیچ بازی فعالی شروع نشده.", show_alert=True)
+        return
 
     # گرفتن لیست ادمین‌های گروه
-    admins = await callback.bot.get_chat_administrators(chat_id)
-    admin_ids = [admin.user.id for admin in admins]
+    admin_ids = await chat_cache.admin_ids(callback.bot, chat_id)
 
     # شرط دسترسی
-    if not reserved_god or (user_id != reserved_god.get("id") and user_id not in admin_ids):
+    if not session.moderator_id or (user_id != session.moderator_id and user_id not in admin_ids):
+
         await callback.answer("⛔ فقط گرداننده یا مدیران گروه می‌تونن بازی رو لغو کنن!", show_alert=True)
         return
 
-    players.clear()
-    removed_players.clear()
-    substitute_list.clear()
+    session.players.clear()
+    session.removed_players.clear()
+    session.substitute_list.clear()
+    session.mark_dirty()
 
     await callback.message.answer("🚫 بازی لغو شد.")
     await callback.answer()
@@ -1089,7 +1075,7 @@ def register_game_panel_handlers(dp: Dispatcher):
 
 
 
-@dp.callback_query_handler(lambda c: c.data == "help")
+@callback_router.exact("help")
 async def show_help(callback: types.CallbackQuery):
     try:
         with open("help.txt", "r", encoding="utf-8") as f:
@@ -1099,7 +1085,7 @@ async def show_help(callback: types.CallbackQuery):
     kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅ بازگشت", callback_data="back_main"))
     await callback.message.edit_text(help_text, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data == "back_main")
+@callback_router.exact("back_main")
 async def back_main(callback: types.CallbackQuery):
     await callback.message.edit_text("🏠 منوی اصلی:", reply_markup=main_menu_keyboard())
 
@@ -1107,208 +1093,252 @@ async def back_main(callback: types.CallbackQuery):
 #======================
 # تابع کمکی برای پخش نقش‌ها
 #======================
-@dp.callback_query_handler(lambda c: c.data == "distribute_roles")
+@callback_router.exact("distribute_roles")
 async def distribute_roles_callback(callback: types.CallbackQuery):
-    global game_message_id, lobby_message_id, game_running, group_chat_id, last_role_map
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     # فقط گرداننده اجازه دارد
-    if callback.from_user.id != moderator_id:
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند نقش‌ها را پخش کند.", show_alert=True)
         return
 
-    if not selected_scenario:
+    if not session.selected_scenario:
         await callback.answer("❌ سناریو انتخاب نشده.", show_alert=True)
         return
 
-    try:
-        mapping = await distribute_roles()
-        last_role_map = mapping
-    except Exception as e:
-        logging.exception("⚠️ مشکل در پخش نقش‌ها: %s", e)
-        await callback.answer("❌ خطا در پخش نقش‌ها.", show_alert=True)
-        return
+    async def distribute_and_announce():
+        # پیام لابی به پیام بازی تبدیل می‌شود؛ رندر در انتظار لابی نباید رویش بنویسد
+        lobby_renderer.cancel((session.chat_id, "lobby"))
+        try:
+            mapping = await distribute_roles(session)
+            session.last_role_map = mapping
+        except Exception as e:
+            logging.exception("⚠️ مشکل در پخش نقش‌ها: %s", e)
+            await bot.send_message(session.moderator_id, "❌ خطا در پخش نقش‌ها.")
+            return
 
-    # نمایش لیست بازیکنان در گروه
-    seats = {seat: (uid, players.get(uid, "❓")) for seat, uid in player_slots.items()}
-    players_list = "\n".join([
-        f"{seat:02d}. <a href='tg://user?id={uid}'>{html.escape(name)}</a>"
-        for seat, (uid, name) in sorted(seats.items())
-    ])
+        # نمایش لیست بازیکنان در گروه
+        seats = {seat: (uid, session.players.get(uid, "❓")) for seat, uid in session.player_slots.items()}
+        players_list = "\n".join([
+            f"{seat:02d}. <a href='tg://user?id={uid}'>{html.escape(name)}</a>"
+            for seat, (uid, name) in sorted(seats.items())
+        ])
+
+        text = (
+            "🎭 نقش‌ها پخش شد!\n\n"
+            f"👥 لیست بازیکنان:\n{players_list}\n\n"
+            "ℹ️ برای دیدن نقش به پیوی ربات بروید.\n"
+            "👑 گرداننده سر صحبت را انتخاب کند تا بازی شروع شود."
+        )
 
-    text = (
-        "🎭 نقش‌ها پخش شد!\n\n"
-        f"👥 لیست بازیکنان:\n{players_list}\n\n"
-        "ℹ️ برای دیدن نقش به پیوی ربات بروید.\n"
-        "👑 گرداننده سر صحبت را انتخاب کند تا بازی شروع شود."
-    )
+        # ساخت کیبورد مدیریت دور
+        kb = InlineKeyboardMarkup(row_width=1)
+        kb.add(InlineKeyboardButton("👑 انتخاب سر صحبت", callback_data="choose_head"))
+        kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
+        kb.add(InlineKeyboardButton("⚔ چالش روشن" if session.challenge_active else "⚔ چالش خاموش",
+                                    callback_data="challenge_toggle"))
 
-    # ساخت کیبورد مدیریت دور
-    kb = InlineKeyboardMarkup(row_width=1)
-    kb.add(InlineKeyboardButton("👑 انتخاب سر صحبت", callback_data="choose_head"))
-    kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
-    kb.add(InlineKeyboardButton("⚔ چالش روشن" if challenge_active else "⚔ چالش خاموش",
-                                callback_data="challenge_toggle"))
+        # ویرایش یا ارسال پیام بازی
+        try:
+            if session.lobby_message_id:
+                msg = await bot.edit_message_text(
+                    text, chat_id=session.chat_id, message_id=session.lobby_message_id,
+                    parse_mode="HTML", reply_markup=kb
+                )
+                session.game_message_id = msg.message_id
+            else:
+                msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+                session.game_message_id = msg.message_id
+        except Exception as e:
+            logging.warning("⚠️ distribute_roles: edit failed, sending new message: %s", e)
+            msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+            session.game_message_id = msg.message_id
 
-    # ویرایش یا ارسال پیام بازی
-    try:
-        if lobby_message_id:
-            msg = await bot.edit_message_text(
-                text, chat_id=group_chat_id, message_id=lobby_message_id,
-                parse_mode="HTML", reply_markup=kb
-            )
-            game_message_id = msg.message_id
-        else:
-            msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-            game_message_id = msg.message_id
-    except Exception as e:
-        logging.warning("⚠️ distribute_roles: edit failed, sending new message: %s", e)
-        msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-        game_message_id = msg.message_id
+        session.game_running = True
 
-    game_running = True
-    await callback.answer("✅ نقش‌ها پخش شد!")
+    # دکمه فوراً جواب می‌گیرد؛ ارسال نقش‌ها و ویرایش پیام گروه در پس‌زمینه
+    await answer_first(callback, session.chat_id, distribute_and_announce(), "⏳ نقش‌ها در حال پخش است...")
 
 
+# ======================
+# ارسال هم‌زمان نقش‌ها
+# ======================
+ROLE_DM_CONCURRENCY = int(os.getenv("ROLE_DM_CONCURRENCY", "8"))
 
 
-async def distribute_roles():
+async def send_role_dms(session, mapping, bold=False):
     """
-    نقش‌ها را به پیوی بازیکنان می‌فرستد و mapping از user_id -> role برمی‌گرداند.
-    ترتیب اختصاص نقش: اگر صندلی رزرو شده باشد بر اساس شماره صندلی، در غیر اینصورت بر اساس insertion-order players.
+    نقش هر بازیکن را هم‌زمان (حداکثر ROLE_DM_CONCURRENCY ارسال باز) به پیوی‌اش می‌فرستد.
+    محدودیت نرخ را صف outbound رعایت می‌کند. خروجی: لیست uidهایی که ارسال برایشان شکست خورد.
     """
-    if not selected_scenario:
-        raise ValueError("سناریو انتخاب نشده")
-
-    roles_template = scenarios[selected_scenario]["roles"]
+    semaphore = asyncio.Semaphore(max(1, ROLE_DM_CONCURRENCY))
 
-    # ترتیب بازیکنان: بر اساس صندلی اگر موجود باشد، وگرنه بر اساس players.keys()
-    if player_slots:
-        player_ids = [player_slots[s] for s in sorted(player_slots.keys())]
-    else:
-        player_ids = list(players.keys())
+    async def send_one(pid, role):
+        role_text = f"<b>{html.escape(role_name(role))}</b>" if bold else html.escape(role_name(role))
+        async with semaphore:
+            try:
+                with outbound_priority(CRITICAL):
+                    await bot.send_message(pid, f"🎭 نقش شما: {role_text}", parse_mode="HTML")
+                return None
+            except Exception as e:
+                logging.warning("⚠️ ارسال نقش به %s شکست خورد: %s", pid, e)
+                return pid
 
-    # آماده‌سازی لیست نقش‌ها مطابق تعداد بازیکنان
-    roles = list(roles_template)  # کپی
-    if len(player_ids) > len(roles):
-        # اگر نیاز به نقش بیشتر هست، بقیه را "شهروند" قرار می‌دهیم
-        roles += ["شهروند"] * (len(player_ids) - len(roles))
-    roles = roles[:len(player_ids)]  # اگر نقش بیشتر از بازیکن بود کوتاه می‌کنیم
+    results = await asyncio.gather(*(send_one(pid, role) for pid, role in mapping.items()))
+    return [pid for pid in results if pid is not None]
 
-    random.shuffle(roles)
 
-    mapping = {}
-    for pid, role in zip(player_ids, roles):
-        mapping[pid] = role
-        try:
-            await bot.send_message(pid, f"🎭 نقش شما: <b>{html.escape(str(role))}</b>", parse_mode="HTML")
-        except Exception as e:
-            # به گرداننده اطلاع بده که ارسال به یکی از بازیکنان شکست خورد
-            logging.warning("⚠️ ارسال نقش به %s شکست خورد: %s", pid, e)
-            if moderator_id:
-                try:
-                    await bot.send_message(moderator_id, f"⚠️ نمی‌توانم نقش را به {players.get(pid, pid)} ارسال کنم.")
-                except:
-                    pass
+def role_failures_text(session, failed):
+    """متن گزارش ارسال‌های ناموفق برای گرداننده"""
+    if not failed:
+        return ""
+    text = "⚠️ نمی‌توانم نقش را به این بازیکنان ارسال کنم (باید اول ربات را استارت کنند):\n"
+    for pid in failed:
+        text += f"- {html.escape(str(session.players.get(pid, pid)))}\n"
+    return text
 
-    return mapping
 
-#==================
 
 # =========================
 # هندلرهای دستورات متنی گروه
 # =========================
-@dp.message_handler(lambda m: m.chat.type in ["group", "supergroup"] and not m.text.startswith("/"))
-async def text_commands_handler(message: types.Message):
-    text = message.text.strip().lower()
-    group_id = message.chat.id
+def get_group_player_ids(session):
+    """لیست uidهای بازیکنان برای گروه جاری با چند fallback"""
+    if session is None:
+        return []
 
-    # helper: تعیین لیست uidهای بازیکنان برای گروه جاری با چند fallback
-    def get_group_player_ids(gid):
-        # 1) players[group_id] اگر ساختار گروهی داشته باشی (لیست)
-        try:
-            val = players.get(gid)
-            if isinstance(val, list) and val:
-                return val
-        except Exception:
-            pass
+    # 1) player_slots (صندلی -> uid) اگر پر است، از اون استفاده کن
+    try:
+        if session.player_slots:
+            # بازگرداندن فقط uidها (به ترتیب صندلی)
+            return [uid for seat, uid in sorted(session.player_slots.items())]
+    except Exception:
+        pass
 
-        # 2) player_slots (صندلی -> uid) اگر پر است، از اون استفاده کن
-        try:
-            if player_slots:
-                # بازگرداندن فقط uidها (به ترتیب صندلی)
-                return [uid for seat, uid in sorted(player_slots.items())]
-        except Exception:
-            pass
+    # 2) players به شکل {uid: name} → کل uidها
+    try:
+        if isinstance(session.players, dict) and session.players:
+            # اگر values ها اسامی باشن (str) فرض می‌کنیم کلیدها uid هستند
+            sample_val = next(iter(session.players.values()))
+            if isinstance(sample_val, str) or isinstance(sample_val, (str,)):
+                return list(session.players.keys())
+    except Exception:
+        pass
 
-        # 3) players به شکل {uid: name} → کل uidها
-        try:
-            if isinstance(players, dict) and players:
-                # اگر values ها اسامی باشن (str) فرض می‌کنیم کلیدها uid هستند
-                sample_val = next(iter(players.values()))
-                if isinstance(sample_val, str) or isinstance(sample_val, (str,)):
-                    return list(players.keys())
-        except Exception:
-            pass
+    return []
 
-        return []
 
+# -------------------
+# دستور "تگ لیست" → فقط بازیکنان حاضر در بازی
+# -------------------
+@text_commands.command("تگ لیست", "tag list", chats=GROUP_CHATS)
+async def tag_list_handler(message: types.Message):
+    session = get_session(message.chat.id)
 
-    # -------------------
-    # دستور "تگ لیست" → فقط بازیکنان حاضر در بازی
-    # -------------------
-    if text == "تگ لیست":
-        # ترجیحاً از player_slots استفاده کن چون صندلی‌ها نشان‌دهندهٔ حاضر بودنن
+    # ترجیحاً از player_slots استفاده کن چون صندلی‌ها نشان‌دهندهٔ حاضر بودنن
+    uids = []
+    try:
+        if session and session.player_slots:
+            uids = [uid for seat, uid in sorted(session.player_slots.items())]
+    except Exception:
         uids = []
-        try:
-            if player_slots:
-                uids = [uid for seat, uid in sorted(player_slots.items())]
-        except Exception:
-            uids = []
 
-        # اگر خالی بود، fallback به همان تابع بالا
-        if not uids:
-            uids = get_group_player_ids(group_id)
+    # اگر خالی بود، fallback به همان تابع بالا
+    if not uids:
+        uids = get_group_player_ids(session)
 
-        if not uids:
-            await message.reply("👥 هیچ بازیکنی در بازی نیست.")
-            return
+    if not uids:
+        await message.reply("👥 هیچ بازیکنی در بازی نیست.")
+        return
+
+    parts = []
+    for uid in uids:
+        name = session.players.get(uid) if isinstance(session.players, dict) else None
+        if name:
+            parts.append(f"<a href='tg://user?id={uid}'>{html.escape(name)}</a>")
+        else:
+            parts.append(f"<a href='tg://user?id={uid}'>🎮</a>")
+
+    await message.reply("📢 تگ بازیکنان حاضر:\n" + " ".join(parts), parse_mode="HTML")
 
-        parts = []
-        for uid in uids:
-            name = players.get(uid) if isinstance(players, dict) else None
-            if name:
-                parts.append(f"<a href='tg://user?id={uid}'>{html.escape(name)}</a>")
-            else:
-                parts.append(f"<a href='tg://user?id={uid}'>🎮</a>")
 
-        await message.reply("📢 تگ بازیکنان حاضر:\n" + " ".join(parts), parse_mode="HTML")
+# -------------------
+# دستور "تگ ادمین" → فقط مدیران گروه
+# -------------------
+@text_commands.command("تگ ادمین", "tag admins", chats=GROUP_CHATS)
+async def tag_admins_handler(message: types.Message):
+    try:
+        admins = await chat_cache.admins(bot, message.chat.id)
+    except Exception as e:
+        await message.reply("⚠️ خطا در دریافت مدیران گروه.")
         return
 
-    # -------------------
-    # دستور "تگ ادمین" → فقط مدیران گروه
-    # -------------------
-    if text == "تگ ادمین":
-        try:
-            admins = await bot.get_chat_administrators(group_id)
-        except Exception as e:
-            await message.reply("⚠️ خطا در دریافت مدیران گروه.")
-            return
+    if not admins:
+        await message.reply("ℹ️ هیچ مدیری در این گروه یافت نشد.")
+        return
 
-        if not admins:
-            await message.reply("ℹ️ هیچ مدیری در این گروه یافت نشد.")
-            return
+    parts = []
+    for admin in admins:
+
+        uid = admin.user.id
+        full = admin.user.full_name or str(uid)
+        parts.append(f"<a href='tg://user?id={uid}'>{html.escape(full)}</a>")
 
-        parts = []
-        for admin in admins:
-            uid = admin.user.id
-            full = admin.user.full_name or str(uid)
-            parts.append(f"<a href='tg://user?id={uid}'>{html.escape(full)}</a>")
+    await message.reply("📢 تگ مدیران گروه:\n" + " ".join(parts), parse_mode="HTML")
 
-        await message.reply("📢 تگ مدیران گروه:\n" + " ".join(parts), parse_mode="HTML")
+
+# -------------------
+# دستور "تگ همه" → همه اعضایی که ربات در گروه دیده است (roster.py)
+# -------------------
+@text_commands.command("تگ همه", "tag all", chats=GROUP_CHATS)
+async def tag_all_handler(message: types.Message):
+    group_id = message.chat.id
+    try:
+        admin_ids = await chat_cache.admin_ids(bot, group_id)
+    except Exception:
+        await message.reply("⚠️ خطا در دریافت مدیران گروه.")
+        return
+    if message.from_user.id not in admin_ids:
+        await message.reply("⛔ فقط مدیران گروه می‌توانند همه را تگ کنند.")
         return
 
-    # بقیه پیام‌ها — نادیده بگیر
-    return
+    key = ("tag_all", group_id)
+    if session_tasks.running(key):
+        await message.reply("⏳ تگ همه در حال انجام است. برای توقف: «لغو تگ»")
+        return
+
+    # مدیران (که از کش آمده‌اند) هم حتما در roster باشند
+    for admin in await chat_cache.admins(bot, group_id):
+        roster.seen(group_id, admin.user)
+    members = [(uid, name) for uid, name in roster.members(group_id).items() if uid != message.from_user.id]
+    if not members:
+        await message.reply("ℹ️ هنوز عضوی در این گروه ثبت نشده.")
+        return
+
+    chunks = mention_chunks(members, header="📢 ")
+    await message.reply(f"📢 تگ {len(members)} عضو در {len(chunks)} پیام...")
+    session_tasks.spawn(key, send_tag_chunks(group_id, chunks))
+
+
+async def send_tag_chunks(group_id, chunks):
+    # پیام‌ها یکی‌یکی از صف outbound رد می‌شوند (~۲۰ در دقیقه برای هر گروه)،
+    # پس پیام‌های بازی (CRITICAL) جلوتر می‌روند و به flood limit نمی‌خوریم
+    for text in chunks:
+        await bot.send_message(group_id, text, parse_mode="HTML", disable_web_page_preview=True)
+
+
+@text_commands.command("لغو تگ", "stop tag", chats=GROUP_CHATS)
+async def stop_tag_all_handler(message: types.Message):
+    key = ("tag_all", message.chat.id)
+    if not session_tasks.running(key):
+        await message.reply("ℹ️ تگی در حال انجام نیست.")
+        return
+    if message.from_user.id not in await chat_cache.admin_ids(bot, message.chat.id):
+        return
+    session_tasks.cancel(key)
+    await message.reply("🛑 تگ همه متوقف شد.")
 
 # ======================
 # کیبوردها
@@ -1359,32 +1389,21 @@ def manage_game_keyboard(group_id: int):
     kb.add(InlineKeyboardButton("🎂 تولد بازیکن", callback_data="player_birthday"))
     kb.add(InlineKeyboardButton("⚔ وضعیت چالش", callback_data="challenge_status"))
     kb.add(InlineKeyboardButton("⚙️ تنظیم گرداننده", callback_data="manage_moderator"))
-    kb.add(InlineKeyboardButton("🚫 لغو بازی", callback_data=f"cancel_{group_id}"))
+    kb.add(InlineKeyboardButton("🚫 لغو بازی", callback_data=callback_codec.encode("cancel_group", group_id)))
     kb.add(InlineKeyboardButton("⬅️ بازگشت", callback_data="back_main"))
     return kb
 
-# =========================
-# توابع کمکی
-# =========================
-# پیام موقتی
-async def send_temp_message(chat_id, text, delay=5, **kwargs):
-    msg = await bot.send_message(chat_id, text, **kwargs)
-    await asyncio.sleep(delay)
-    try:
-        await bot.delete_message(chat_id, msg.message_id)
-    except:
-        pass
-
 # ======================
 # انتخاب / لغو انتخاب صندلی
 # ======================
-@dp.callback_query_handler(lambda c: c.data.startswith("slot_"))
+@callback_router.prefix("slot_")
 async def handle_slot(callback: types.CallbackQuery):
-    global player_slots, player_slots
+    session = await session_for_callback(callback)
+    if not session:
+        return
     user = callback.from_user
-    seat_number = int(callback.data.split("_")[1])
-    
-    if not selected_scenario:
+
+    if not session.selected_scenario:
         await callback.answer("❌ هنوز سناریویی انتخاب نشده.", show_alert=True)
         return
     try:
@@ -1392,53 +1411,47 @@ async def handle_slot(callback: types.CallbackQuery):
     except Exception:
         await callback.answer("⚠ شماره صندلی نامعتبر است.", show_alert=True)
         return
-        
-    if user.id not in players:
-        await callback.answer("❌ ابتدا وارد بازی شوید.", show_alert=True)
-        return   
-        
-        
-    slot_num = int(callback.data.replace("slot_", ""))
-    user_id = callback.from_user.id
 
-    # اگه همون بازیکن دوباره بزنه → لغو انتخاب
-    if slot_num in player_slots and player_slots[slot_num] == user_id:
-        del player_slots[slot_num]
-        await callback.answer(f"جایگاه {slot_num} آزاد شد ✅")
-        await update_lobby()
-        return
-        
-    else:
-        # اگه جایگاه پر باشه
-        if seat_number in player_slots and player_slots[seat_number] != user.id:
-            await callback.answer("❌ این صندلی قبلاً رزرو شده است.", show_alert=True)
-            return
-        # اگه بازیکن قبلاً جای دیگه نشسته → اون رو آزاد کن
-    for seat, uid in list(player_slots.items()):
-        if uid == user.id:
-            del player_slots[seat]
-            
-    player_slots[seat_number] = user.id
-    await callback.answer(f"✅ صندلی {seat_number} برای شما رزرو شد.")        
-    await update_lobby()
+    # بررسی و تغییر صندلی بدون await بین آن‌ها؛ جواب بعد از آزاد شدن قفل
+    async with session_locks.hold(session.chat_id, SEATS):
+        owner = session.player_slots.get(seat_number)
+        if user.id not in session.players:
+            text, alert = "❌ ابتدا وارد بازی شوید.", True
+        elif owner == user.id:
+            # اگه همون بازیکن دوباره بزنه → لغو انتخاب
+            del session.player_slots[seat_number]
+            session.mark_dirty()
+            text, alert = f"جایگاه {seat_number} آزاد شد ✅", False
+        elif owner is not None:
+            # اگه جایگاه پر باشه
+            text, alert = "❌ این صندلی قبلاً رزرو شده است.", True
+        else:
+            # اگه بازیکن قبلاً جای دیگه نشسته، move صندلی قبلی رو آزاد می‌کنه
+            session.player_slots.move(user.id, seat_number)
+            session.mark_dirty()
+            text, alert = f"✅ صندلی {seat_number} برای شما رزرو شد.", False
+
+    await callback.answer(text, show_alert=alert)
+    if not alert:
+        await update_lobby(session)
     
-def turn_keyboard(seat, is_challenge=False):
+def turn_keyboard(session, seat, is_challenge=False):
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(InlineKeyboardButton("⏭ نکست", callback_data=f"next_{seat}"))
 
     if not is_challenge:
-        if not challenge_active:
+        if not session.challenge_active:
             return kb
-        player_id = player_slots.get(seat)
+        player_id = session.player_slots.get(seat)
         if player_id:
             # فقط اگر این بازیکن قبلاً چالش داده (accept کرده) → دکمه حذف بشه
-            if seat in active_challenger_seats:
+            if seat in session.active_challenger_seats:
                 return kb
 
             # فقط اگر هنوز درخواست pending داره → دکمه غیرفعال بشه
             already_challenged = any(
                 reqs.get(player_id) == "pending"
-                for reqs in challenge_requests.values()
+                for reqs in session.challenge_requests.values()
             )
             if not already_challenged:
                 kb.add(InlineKeyboardButton("⚔ درخواست چالش", callback_data=f"challenge_request_{seat}"))
@@ -1448,7 +1461,7 @@ def turn_keyboard(seat, is_challenge=False):
 # =======================
 # تنظیم گرداننده
 # =======================
-@dp.callback_query_handler(lambda c: c.data == "manage_moderator")
+@callback_router.exact("manage_moderator")
 async def manage_moderator_menu(callback: types.CallbackQuery):
     kb = InlineKeyboardMarkup(row_width=1)
     kb.add(InlineKeyboardButton("👤 گرداننده فعلی", callback_data="show_current_mod"))
@@ -1458,31 +1471,39 @@ async def manage_moderator_menu(callback: types.CallbackQuery):
     await callback.message.edit_text("⚙️ تنظیمات گرداننده:", reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "show_current_mod")
+@callback_router.exact("show_current_mod")
 async def show_current_moderator(callback: types.CallbackQuery):
-    if not moderator_id:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if not session.moderator_id:
         await callback.answer("⛔ گرداننده هنوز تنظیم نشده.", show_alert=True)
         return
-    mod_name = players.get(moderator_id, "❓")
+    mod_name = session.players.get(session.moderator_id, "❓")
     await callback.answer(f"👤 گرداننده فعلی: {mod_name}", show_alert=True)
 
-@dp.callback_query_handler(lambda c: c.data == "change_mod")
+@callback_router.exact("change_mod")
 async def change_moderator(callback: types.CallbackQuery):
-    admins = await bot.get_chat_administrators(group_chat_id)
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    admins = await chat_cache.admins(bot, session.chat_id)
     kb = InlineKeyboardMarkup(row_width=1)
     for admin in admins:
-        kb.add(InlineKeyboardButton(admin.user.full_name, callback_data=f"set_mod_{admin.user.id}"))
+        kb.add(InlineKeyboardButton(admin.user.full_name, callback_data=callback_codec.encode("set_mod", admin.user.id)))
 
     await callback.message.edit_text("🔄 انتخاب گرداننده جدید:", reply_markup=kb)
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("set_mod_"))
-async def set_new_moderator(callback: types.CallbackQuery):
-    global moderator_id
-    new_id = int(callback.data.split("set_mod_")[1])
-    moderator_id = new_id
-    new_name = callback.from_user.full_name if callback.from_user.id == new_id else players.get(new_id, "❓")
+@callback_router.encoded("set_mod")
+async def set_new_moderator(callback: types.CallbackQuery, args):
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    new_id, = args
+    session.moderator_id = new_id
+    new_name = callback.from_user.full_name if callback.from_user.id == new_id else session.players.get(new_id, "❓")
 
     await callback.message.edit_text(f"✅ گرداننده جدید تنظیم شد: <b>{new_name}</b>", parse_mode="HTML")
     await callback.answer()
@@ -1490,12 +1511,16 @@ async def set_new_moderator(callback: types.CallbackQuery):
 # =======================
 # وضعیت چالش
 # =======================
-@dp.callback_query_handler(lambda c: c.data == "challenge_status")
+@callback_router.exact("challenge_status")
 async def challenge_status_pv(callback: types.CallbackQuery):
     # فقط برای پیوی
     if callback.message.chat.type != "private":
         return  # اگر در گروه است، هندلر قبلی لابی اجرا شود
-    group_id = ...  # آیدی گروه مربوطه را از دیتابیس یا سیستم خود بگیرید
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    group_id = session.chat_id
+
     # پیام جدید در پیوی
     await callback.message.answer(
         "⚔ وضعیت چالش:",
@@ -1603,14 +1628,14 @@ async def remove_player_confirm(callback: types.CallbackQuery):
         await callback.message.answer("⚠️ بازیکن پیدا نشد.")
         return
 
-    removed_players.setdefault(group_id, {})[seat] = player
+    get_session(group_id).removed_players[seat] = player
     await callback.message.answer(f"✅ بازیکن {player['name']} حذف شد و به لیست خارج شده‌ها منتقل شد.")
 #=======================
 # تولد بازیکن
 #=======================
 async def birthday_player_handler(callback: types.CallbackQuery):
     group_id = get_group_for_admin(callback.from_user.id)
-    removed = removed_players.get(group_id, {})
+    removed = get_session(group_id).removed_players
     if not removed:
         await callback.message.answer("⚠️ هیچ بازیکنی در لیست خارج شده‌ها نیست.")
         await callback.answer()
@@ -1627,7 +1652,7 @@ async def birthday_player_confirm(callback: types.CallbackQuery):
     seat = int(parts[1])
     group_id = int(parts[2])
 
-    player = removed_players[group_id].pop(seat, None)
+    player = get_session(group_id).removed_players.pop(seat, None)
     if not player:
         await callback.message.answer("⚠️ بازیکن پیدا نشد.")
         return
@@ -1649,7 +1674,8 @@ async def start_cmd(message: types.Message):
         
         
         # فقط مدیر ربات این دو دکمه را می‌بیند
-        if message.from_user.id == moderator_id:
+        session = find_session_for_manager(message.from_user.id)
+        if session and message.from_user.id == session.moderator_id:
             kb.add(InlineKeyboardButton("🛠 مدیریت بازی", callback_data="manage_game"))
             kb.add(InlineKeyboardButton("⚙ مدیریت سناریو", callback_data="manage_scenarios"))
 
@@ -1662,26 +1688,25 @@ async def start_cmd(message: types.Message):
         kb = main_menu_keyboard()  # همان منوی قبلی گروه
         await message.reply("🏠 منوی اصلی گروه:", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data == "new_game")
+@callback_router.exact("new_game")
 async def start_game(callback: types.CallbackQuery):
-    # محدودیت به گروه خاص
-    if callback.message.chat.id != ALLOWED_GROUP_ID:
+    # محدودیت به گروه‌های مجاز (اگر تنظیم شده باشد)
+    if ALLOWED_GROUP_IDS and callback.message.chat.id not in ALLOWED_GROUP_IDS:
         await callback.answer("❌ این ربات فقط در گروه اصلی کار می‌کند.", show_alert=True)
         return
 
-    global group_chat_id, lobby_active, admins, lobby_message_id
 
     # فقط در گروه: شروع لابی
     if callback.message.chat.type != "private":
-        group_chat_id = callback.message.chat.id
-        lobby_active = True    # فقط لابی فعال، بازی هنوز شروع نشده
-        admins = {member.user.id for member in await bot.get_chat_administrators(group_chat_id)}
+        session = open_session(callback.message.chat.id)
+        session.lobby_active = True    # فقط لابی فعال، بازی هنوز شروع نشده
+        session.admins = await chat_cache.admin_ids(bot, session.chat_id)
 
         msg = await callback.message.reply(
             "🎮 بازی مافیا فعال شد!\nلطفا سناریو و گرداننده را انتخاب کنید:",
             reply_markup=game_menu_keyboard()
         )
-        lobby_message_id = msg.message_id
+        session.lobby_message_id = msg.message_id
 
     await callback.answer()
 
@@ -1690,55 +1715,79 @@ async def start_game(callback: types.CallbackQuery):
 # ======================
 # انتخاب سناریو و گرداننده
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "choose_scenario")
+@callback_router.exact("choose_scenario")
 async def choose_scenario(callback: types.CallbackQuery):
-    global lobby_active
+    session = get_session(callback.message.chat.id)
 
-    if not lobby_active:
+    if not session or not session.lobby_active:
         await callback.answer("❌ هیچ بازی فعالی برای انتخاب سناریو وجود ندارد.", show_alert=True)
         return
 
-    kb = InlineKeyboardMarkup(row_width=1)
-    for scen in scenarios:
-        kb.add(InlineKeyboardButton(scen, callback_data=f"scenario_{scen}"))
+    kb, _, _ = scenario_picker.keyboard(PICK, suggest=len(session.players))
     await callback.message.edit_text("📝 یک سناریو انتخاب کنید:", reply_markup=kb)
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("scenario_"))
-async def scenario_selected(callback: types.CallbackQuery):
-    global selected_scenario
-    selected_scenario = callback.data.replace("scenario_", "")
+# صفحه‌های بعدی/قبلی و فیلتر تعداد بازیکن در کیبورد سناریوها
+@callback_router.encoded("scen_page")
+async def scenario_page(callback: types.CallbackQuery, args):
+    mode, page, players, suggest = args
+    kb, page, pages = scenario_picker.keyboard(mode, page, players, suggest)
+    if players and not scenario_picker.names(players):
+        await callback.answer(f"ℹ️ سناریویی برای {players} نفر وجود ندارد.", show_alert=True)
+        return
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except MessageNotModified:
+        pass
+    await callback.answer()
+
+
+@callback_router.exact("noop")
+async def noop_button(callback: types.CallbackQuery):
+    await callback.answer()
+
+
+@callback_router.encoded("scenario")
+async def scenario_selected(callback: types.CallbackQuery, args):
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    session.selected_scenario = scenario_ids.lookup(args[0])
     await callback.message.edit_text(
-        f"📝 سناریو انتخاب شد: {selected_scenario}\nحالا گرداننده را انتخاب کنید.",
+        f"📝 سناریو انتخاب شد: {session.selected_scenario}\nحالا گرداننده را انتخاب کنید.",
         reply_markup=game_menu_keyboard()
     )
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "choose_moderator")
+@callback_router.exact("choose_moderator")
 async def choose_moderator(callback: types.CallbackQuery):
-    global lobby_active
+    session = get_session(callback.message.chat.id)
 
-    if not lobby_active:
+    if not session or not session.lobby_active:
         await callback.answer("❌ هیچ بازی فعالی برای انتخاب گرداننده وجود ندارد.", show_alert=True)
         return
 
     kb = InlineKeyboardMarkup(row_width=1)
-    for admin_id in admins:
-        member = await bot.get_chat_member(group_chat_id, admin_id)
-        kb.add(InlineKeyboardButton(member.user.full_name, callback_data=f"moderator_{admin_id}"))
+    # نام مدیران از کش (در صورت نبود، هم‌زمان گرفته می‌شوند)
+    admin_ids = list(session.admins)
+    members = await asyncio.gather(*(chat_cache.member(bot, session.chat_id, admin_id) for admin_id in admin_ids))
+    for admin_id, member in zip(admin_ids, members):
+        kb.add(InlineKeyboardButton(member.user.full_name, callback_data=callback_codec.encode("moderator", admin_id)))
     await callback.message.edit_text("🎩 یک گرداننده انتخاب کنید:", reply_markup=kb)
     await callback.answer()
 
 
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("moderator_"))
-async def moderator_selected(callback: types.CallbackQuery):
-    global moderator_id
-    moderator_id = int(callback.data.replace("moderator_", ""))
+@callback_router.encoded("moderator")
+async def moderator_selected(callback: types.CallbackQuery, args):
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    session.moderator_id, = args
     await callback.message.edit_text(
-        f"🎩 گرداننده انتخاب شد: {(await bot.get_chat_member(group_chat_id, moderator_id)).user.full_name}\n"
+        f"🎩 گرداننده انتخاب شد: {(await chat_cache.member(bot, session.chat_id, session.moderator_id)).user.full_name}\n"
         f"حالا اعضا می‌توانند وارد بازی شوند یا انصراف دهند.",
         reply_markup=join_menu()
     )
@@ -1747,107 +1796,128 @@ async def moderator_selected(callback: types.CallbackQuery):
 # ======================
 # ورود و انصراف
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "join_game")
+@callback_router.exact("join_game")
 async def join_game_callback(callback: types.CallbackQuery):
-    global players, player_slots
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     user = callback.from_user
 
     # جلوگیری از ورود در حین بازی
-    if game_running:
+    if session.game_running:
         await callback.answer("❌ بازی در جریان است. نمی‌توانید وارد شوید.", show_alert=True)
         return
 
     # جلوگیری از ورود دوباره بازیکن
-    if user.id in players:
+    if user.id in session.players:
         await callback.answer("⚠️ شما از قبل در لیست هستید.", show_alert=True)
         return
 
     # ظرفیت سناریو
-    if not selected_scenario:
+    if not session.selected_scenario:
         await callback.answer("⚠️ لطفاً اول سناریو انتخاب کنید.", show_alert=True)
         return
 
-    max_players = len(scenarios[selected_scenario]["roles"])
-    if len(player_slots) >= max_players:
-        # اضافه به لیست رزرو
-        if not any(w["id"] == user.id for w in waiting_list):
-            waiting_list.append({"id": user.id, "name": user.full_name})
-            await callback.answer("✅ شما به لیست رزرو اضافه شدید.")
+    max_players = scenarios.seats(session.selected_scenario)
+    async with session_locks.hold(session.chat_id, SEATS, WAITING):
+        if user.id in session.players:
+            # کلیک هم‌زمان دوم همین کاربر
+            text, alert = "⚠️ شما از قبل در لیست هستید.", True
+        elif len(session.player_slots) >= max_players:
+            # اضافه به لیست رزرو
+            if not any(w["id"] == user.id for w in session.waiting_list):
+                session.waiting_list.append({"id": user.id, "name": user.full_name})
+                session.mark_dirty()
+                text, alert = "✅ شما به لیست رزرو اضافه شدید.", False
+            else:
+                text, alert = "⚠️ شما در لیست رزرو هستید.", True
         else:
-            await callback.answer("⚠️ شما در لیست رزرو هستید.", show_alert=True)
-    else:
-        # ثبت در لیست اصلی
-        players[user.id] = user.full_name
-        # پیدا کردن اولین صندلی خالی
-        for i in range(1, max_players + 1):
-            if i not in player_slots:
-                player_slots[i] = user.id
-                break
-        await callback.answer("✅ شما وارد بازی شدید.")
+            # ثبت در لیست اصلی
+            session.players[user.id] = user.full_name
+            # پیدا کردن اولین صندلی خالی
+            for i in range(1, max_players + 1):
+                if i not in session.player_slots:
+                    session.player_slots[i] = user.id
+                    break
+            text, alert = "✅ شما وارد بازی شدید.", False
+            session.mark_dirty()
+    await callback.answer(text, show_alert=alert)
 
-    await update_lobby()
+    await update_lobby(session)
 
 
 # ===============================
 # خروج از بازی
 #================================
-@dp.callback_query_handler(lambda c: c.data == "leave_game")
+@callback_router.exact("leave_game")
 async def leave_game_callback(callback: types.CallbackQuery):
-    global players, player_slots, waiting_list, waiting_message_id
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     user_id = callback.from_user.id
 
     # جلوگیری از خروج در حین بازی
-    if game_running:
+    if session.game_running:
         await callback.answer("❌ بازی در جریان است. نمی‌توانید خارج شوید.", show_alert=True)
         return
 
-    # پیدا کردن صندلی بازیکن
-    seat = next((s for s, uid in player_slots.items() if uid == user_id), None)
+    async with session_locks.hold(session.chat_id, SEATS, WAITING):
+        # پیدا کردن صندلی بازیکن
+        seat = session.player_slots.free_player(user_id)
+        sub = None
+        if seat is not None:
+            # حذف بازیکن
+            session.players.pop(user_id, None)
+            session.mark_dirty()
+            # اگر لیست رزرو خالی نبود → جایگزین کن
+            if session.waiting_list:
+                sub = session.waiting_list.pop(0)
+                session.player_slots[seat] = sub["id"]
+                session.players[sub["id"]] = sub["name"]
+
     if seat is None:
         await callback.answer("⚠️ شما در لیست اصلی نیستید.", show_alert=True)
         return
-
-    # حذف بازیکن
-    player_slots.pop(seat, None)
-    players.pop(user_id, None)
     await callback.answer("❌ شما از بازی خارج شدید.")
-    await update_lobby()
-
-    # اگر لیست رزرو خالی نبود → جایگزین کن
-    if waiting_list:
-        sub = waiting_list.pop(0)
-        player_slots[seat] = sub["id"]
-        players[sub["id"]] = sub["name"]
+    await update_lobby(session)
 
-        await bot.send_message(group_chat_id, f"♻️ {sub['name']} جایگزین شد (صندلی {seat}).")
-        await update_lobby()
+    if sub:
+        await bot.send_message(session.chat_id, f"♻️ {sub['name']} جایگزین شد (صندلی {seat}).")
+        await update_lobby(session)
 
         # اگه لیست رزرو خالی شد → پیام رزرو رو حذف کن
-        if not waiting_list and waiting_message_id:
+        if not session.waiting_list and session.waiting_message_id:
             try:
-                await bot.delete_message(group_chat_id, waiting_message_id)
+                await bot.delete_message(session.chat_id, session.waiting_message_id)
             except:
                 pass
-            waiting_message_id = None
+            session.waiting_message_id = None
 
 # ======================
 # بروزرسانی لابی
 # ======================
-async def update_lobby():
-    global lobby_message_id
+async def update_lobby(session):
+    """
+    رندر لابی را زمان‌بندی می‌کند؛ کلیک‌های پشت سر هم در یک ویرایش ادغام می‌شوند.
+    """
+    lobby_renderer.schedule((session.chat_id, "lobby"), lambda: _render_lobby(session))
+
 
-    if not group_chat_id:
+async def _render_lobby(session):
+
+    if not session.chat_id:
         return
 
+
     text = f"📋 <b>لیست بازی:</b>\n"
-    text += f"سناریو: {selected_scenario or 'انتخاب نشده'}\n\n"
+    text += f"سناریو: {session.selected_scenario or 'انتخاب نشده'}\n\n"
 
     # 👤 گرداننده
-    if moderator_id:
+    if session.moderator_id:
         try:
-            moderator = await bot.get_chat_member(group_chat_id, moderator_id)
+            moderator = await chat_cache.member(bot, session.chat_id, session.moderator_id)
             text += f"👤 گرداننده: {html.escape(moderator.user.full_name)}\n\n"
         except:
             text += "👤 گرداننده: انتخاب نشده\n\n"
@@ -1855,9 +1925,9 @@ async def update_lobby():
         text += "👤 گرداننده: انتخاب نشده\n\n"
 
     # 👥 بازیکنان اصلی
-    if players:
-        for uid, name in players.items():
-            seat = next((s for s, u in player_slots.items() if u == uid), None)
+    if session.players:
+        for uid, name in session.players.items():
+            seat = session.player_slots.seat_of(uid)
             seat_str = f" (صندلی {seat})" if seat else ""
             text += f"- <a href='tg://user?id={uid}'>{html.escape(name)}</a>{seat_str}\n"
     else:
@@ -1865,28 +1935,28 @@ async def update_lobby():
 
     kb = InlineKeyboardMarkup(row_width=5)
 
-    if selected_scenario:
-        max_players = len(scenarios[selected_scenario]["roles"])
+    if session.selected_scenario:
+        max_players = scenarios.seats(session.selected_scenario)
 
         # 🎯 دکمه‌های صندلی
         for i in range(1, max_players + 1):
-            if i in player_slots:
-                player_name = players.get(player_slots[i], "❓")
+            if i in session.player_slots:
+                player_name = session.players.get(session.player_slots[i], "❓")
                 kb.insert(InlineKeyboardButton(f"{i} ({player_name})", callback_data=f"slot_{i}"))
             else:
                 kb.insert(InlineKeyboardButton(str(i), callback_data=f"slot_{i}"))
 
         # 🎯 ورود/خروج یا غیرفعال شدن
-        if len(player_slots) >= max_players:
+        if len(session.player_slots) >= max_players:
             kb.row(
                 InlineKeyboardButton("🚫 لیست پر شده", callback_data="full_list"),
                 InlineKeyboardButton("❌ خروج از بازی", callback_data="leave_game"),
             )    
             
             # لیست رزرو
-            if waiting_list:
+            if session.waiting_list:
                 text += "\n\n📌 <b>لیست رزرو:</b>\n"
-                for w in waiting_list:
+                for w in session.waiting_list:
                     text += f"- <a href='tg://user?id={w['id']}'>{html.escape(w['name'])}</a>\n"
             else:
                 text += "\n\n📌 لیست رزرو خالی است."
@@ -1902,28 +1972,28 @@ async def update_lobby():
             )
 
         # ✅ نمایش لیست رزرو
-    if waiting_list:
+    if session.waiting_list:
         text += "\n\n📋 لیست رزرو:\n"
-        for i, w in enumerate(waiting_list, start=1):
+        for i, w in enumerate(session.waiting_list, start=1):
             text += f"{i}. {w['name']}\n"
             
     # 🎭 پخش نقش
-    if selected_scenario and moderator_id:
-        min_players = scenarios[selected_scenario]["min_players"]
-        max_players = len(scenarios[selected_scenario]["roles"])
-        if min_players <= len(players) <= max_players:
+    if session.selected_scenario and session.moderator_id:
+        min_players = scenarios.summary(session.selected_scenario).min_players
+        max_players = scenarios.seats(session.selected_scenario)
+        if min_players <= len(session.players) <= max_players:
             kb.add(InlineKeyboardButton("🎭 پخش نقش", callback_data="distribute_roles"))
          # 🎭 پخش نقش
 
 
     # 🚫 لغو بازی
-    if moderator_id and moderator_id in admins:
+    if session.moderator_id and session.moderator_id in session.admins:
         kb.add(InlineKeyboardButton("🚫 لغو بازی", callback_data="cancel_game"))
 
     # 🔄 بروزرسانی پیام
     try:
-        await bot.edit_message_text(
-            text, chat_id=group_chat_id, message_id=lobby_message_id,
+        await edit_cache.edit_text(
+            bot, text, chat_id=session.chat_id, message_id=session.lobby_message_id,
             reply_markup=kb, parse_mode="HTML"
         )
     except (MessageNotModified, MessageCantBeEdited):
@@ -1931,33 +2001,36 @@ async def update_lobby():
         pass
     except MessageToEditNotFound:
         # پیام پاک شده یا پیدا نشد → پیام جدید بساز
-        msg = await bot.send_message(group_chat_id, text, reply_markup=kb, parse_mode="HTML")
-        lobby_message_id = msg.message_id
+        msg = await bot.send_message(session.chat_id, text, reply_markup=kb, parse_mode="HTML")
+        session.lobby_message_id = msg.message_id
 
 
 # ======================================
 # ایجاد لیست رزرو
 # ======================================
-async def update_waiting_list_message():
+async def update_waiting_list_message(session):
+    lobby_renderer.schedule((session.chat_id, "waiting"), lambda: _render_waiting_list(session))
+
+
+async def _render_waiting_list(session):
     """
     پیام لیست رزرو را ایجاد یا آپدیت می‌کند.
     اگر لیست رزرو خالی شود، پیام حذف می‌شود.
     """
-    global waiting_message_id, waiting_list, group_chat_id
 
     # اگر لیست رزرو خالی است → پیام را پاک کن (اگه وجود دارد) و تمام
-    if not waiting_list:
-        if waiting_message_id:
+    if not session.waiting_list:
+        if session.waiting_message_id:
             try:
-                await bot.delete_message(group_chat_id, waiting_message_id)
+                await bot.delete_message(session.chat_id, session.waiting_message_id)
             except:
                 pass
-            waiting_message_id = None
+            session.waiting_message_id = None
         return
 
     # ساخت متن لیست رزرو
     text = "📢 <b>لیست رزرو</b>\n\n"
-    for idx, item in enumerate(waiting_list, start=1):
+    for idx, item in enumerate(session.waiting_list, start=1):
         name = item.get("name", "❓")
         text += f"{idx}. {html.escape(name)}\n"
 
@@ -1970,75 +2043,93 @@ async def update_waiting_list_message():
     )
 
     # اگر قبلاً پیام وجود داشت → ویرایشش کن، در غیر این صورت ارسال جدید
-    if waiting_message_id:
+    if session.waiting_message_id:
         try:
-            await bot.edit_message_text(text, chat_id=group_chat_id, message_id=waiting_message_id,
-                                        parse_mode="HTML", reply_markup=kb)
+            await edit_cache.edit_text(bot, text, chat_id=session.chat_id, message_id=session.waiting_message_id,
+                                       parse_mode="HTML", reply_markup=kb)
             return
         except Exception:
             # اگر ویرایش موفق نبود (مثلاً پیام پاک شده)، پیام جدید ارسال کن
             try:
-                msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-                waiting_message_id = msg.message_id
+                msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+                session.waiting_message_id = msg.message_id
                 return
             except Exception:
                 return
     else:
         try:
-            msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-            waiting_message_id = msg.message_id
+            msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+            session.waiting_message_id = msg.message_id
         except Exception:
             return
 
 #==========================
 # ورود به رزرو
 #==========================
-@dp.callback_query_handler(lambda c: c.data == "join_waiting")
+@callback_router.exact("join_waiting")
 async def join_waiting_handler(callback: types.CallbackQuery):
+    session = await session_for_callback(callback)
+    if not session:
+        return
     user = callback.from_user
 
-    # ✅ اگر داخل بازی هست → اجازه نداره بره رزرو
-    if user.id in players:
+    async with session_locks.hold(session.chat_id, WAITING):
+        # ✅ اگر داخل بازی هست → اجازه نداره بره رزرو
+        in_game = user.id in session.players
+        # ✅ اگر از قبل در رزرو هست → تکراری نره
+        duplicate = not in_game and any(w["id"] == user.id for w in session.waiting_list)
+        # ✅ اضافه به رزرو
+        if not in_game and not duplicate:
+            session.waiting_list.append({"id": user.id, "name": user.full_name})
+            session.mark_dirty()
+
+    if in_game:
         await callback.answer("❌ شما در لیست اصلی هستید و نمی‌توانید وارد رزرو شوید.", show_alert=True)
         return
-
-    # ✅ اگر از قبل در رزرو هست → تکراری نره
-    if any(w["id"] == user.id for w in waiting_list):
+    if duplicate:
         await callback.answer("⚠️ شما قبلاً در لیست رزرو هستید.", show_alert=True)
         return
-
-    # ✅ اضافه به رزرو
-    waiting_list.append({"id": user.id, "name": user.full_name})
     await callback.answer("✅ شما به لیست رزرو اضافه شدید.", show_alert=True)
 
-    await update_lobby()
+    await update_lobby(session)
 
 # -------------------------
 # کنسل رزرو (دکمه)
 # -------------------------
-@dp.callback_query_handler(lambda c: c.data == "leave_waiting")
+@callback_router.exact("leave_waiting", "cancel_waiting")
 async def leave_waiting_handler(callback: types.CallbackQuery):
+    session = await session_for_callback(callback)
+    if not session:
+        return
     user = callback.from_user
 
     # ✅ بررسی وجود در رزرو
-    before = len(waiting_list)
-    waiting_list[:] = [w for w in waiting_list if w["id"] != user.id]
+    async with session_locks.hold(session.chat_id, WAITING):
+        before = len(session.waiting_list)
+        session.waiting_list[:] = [w for w in session.waiting_list if w["id"] != user.id]
+        removed = len(session.waiting_list) < before
+        session.mark_dirty()
 
-    if len(waiting_list) < before:
+    if removed:
         await callback.answer("✅ شما از لیست رزرو خارج شدید.", show_alert=True)
     else:
         await callback.answer("⚠️ شما در لیست رزرو نبودید.", show_alert=True)
 
-    await update_lobby()
+    await update_lobby(session)
 # ======================
 # لغو بازی توسط مدیران
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "cancel_game")
+@callback_router.exact("cancel_game")
 async def cancel_game(callback: types.CallbackQuery):
-    if callback.from_user.id not in admins:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if callback.from_user.id not in session.admins:
         await callback.answer("❌ فقط مدیران می‌توانند بازی را لغو کنند.", show_alert=True)
         return
-    
+
+    # رندر در انتظار لابی نباید پیام تایید را بازنویسی کند
+    lobby_renderer.cancel((session.chat_id, "lobby"))
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
         InlineKeyboardButton("✅ تایید", callback_data="confirm_cancel"),
@@ -2047,147 +2138,73 @@ async def cancel_game(callback: types.CallbackQuery):
     await callback.message.edit_text("آیا مطمئنید که می‌خواهید بازی را لغو کنید؟", reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "confirm_cancel")
+@callback_router.exact("confirm_cancel")
 async def confirm_cancel(callback: types.CallbackQuery):
-    global players, player_slots, game_running, selected_scenario, moderator_id, lobby_message_id
-    players.clear()
-    player_slots.clear()
-    game_running = False
-    selected_scenario = None
-    moderator_id = None
-    lobby_message_id = None
-    # ریست کردن متغیرهای چالش
-    pending_challenges.clear()
-    challenge_mode = False
-    paused_main_player = None
-    paused_main_duration = None
-
-    # یک بار ویرایش کن
-    msg = await callback.message.edit_text("🚫 بازی لغو شد.")
-    await callback.answer()
+    # کل وضعیت بازی این گروه (بازیکنان، صندلی‌ها، چالش‌ها، تایمر و تسک‌ها) حذف می‌شود
+    close_session(callback.message.chat.id)
+    lobby_renderer.cancel_chat(callback.message.chat.id)
+    edit_cache.forget(callback.message.chat.id)
+    timer_edit_budget.forget(callback.message.chat.id)
 
-    # بعد ۵ ثانیه پاکش کن
-    await asyncio.sleep(5)
-    try:
-        await bot.delete_message(callback.message.chat.id, msg.message_id)
-    except:
-        pass
+    async def announce_cancel():
+        # پیام‌های موقت باقیمانده‌ی این بازی پاک شوند
+        await temp_messages.wipe_chat(callback.message.chat.id)
 
+        # یک بار ویرایش کن و بعد ۵ ثانیه پاکش کن
+        msg = await callback.message.edit_text("🚫 بازی لغو شد.")
+        temp_messages.schedule(callback.message.chat.id, msg.message_id, 5)
 
+    await answer_first(callback, callback.message.chat.id, announce_cancel())
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_lobby")
+
+
+@callback_router.exact("back_to_lobby")
 async def back_to_lobby(callback: types.CallbackQuery):
-    await update_lobby()
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    await update_lobby(session)
     await callback.answer()
 
 #======================
 # تابع کمکی برای پخش نقش‌ها
 #======================
-@dp.callback_query_handler(lambda c: c.data == "distribute_roles")
-async def distribute_roles_callback(callback: types.CallbackQuery):
-    global game_message_id, lobby_message_id, game_running
-
-    # فقط گرداننده اجازه دارد
-    if callback.from_user.id != moderator_id:
-        await callback.answer("❌ فقط گرداننده می‌تواند نقش‌ها را پخش کند.", show_alert=True)
-        return
-
-    if not selected_scenario:
-        await callback.answer("❌ سناریو انتخاب نشده.", show_alert=True)
-        return
-
-    try:
-        mapping = await distribute_roles()
-        await show_roles_list(moderator_id)
-    except Exception as e:
-        logging.exception("⚠️ مشکل در پخش نقش‌ها: %s", e)
-        await callback.answer("❌ خطا در پخش نقش‌ها.", show_alert=True)
-        return
-
-    # نمایش خلاصه در گروه و تبديل پیام لابی به پیام بازی (game_message_id)
-    seats = {seat: (uid, players.get(uid, "❓")) for seat, uid in player_slots.items()}
-    players_list = "\n".join([f"{seat}. <a href='tg://user?id={uid}'>{html.escape(name)}</a>" for seat, (uid, name) in sorted(seats.items())])
-
-    text = (
-        "🎭 نقش‌ها پخش شد!\n\n"
-        f"👥 لیست بازیکنان:\n{players_list}\n\n"
-        "ℹ️ برای دیدن نقش به پیوی ربات بروید.\n"
-        "👑 گرداننده سر صحبت را انتخاب کند تا بازی شروع شود."
-    )
-
-    kb = InlineKeyboardMarkup(row_width=1)
-    kb.add(InlineKeyboardButton("👑 انتخاب سر صحبت", callback_data="choose_head"))
-    kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
-    
-    if challenge_active:
-        kb.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
-    else:
-        kb.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
-
-    try:
-        if lobby_message_id:
-            msg = await bot.edit_message_text(text, chat_id=group_chat_id, message_id=lobby_message_id, parse_mode="HTML", reply_markup=kb)
-            game_message_id = msg.message_id
-            # اگر می‌خواهی بعد از پخش نقش پیام لابی را نداشته باشی می‌توانی lobby_message_id = None کنی
-        else:
-            msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-            game_message_id = msg.message_id
-    except Exception as e:
-        logging.warning("⚠️ distribute_roles: edit failed, sending new message: %s", e)
-        msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-        game_message_id = msg.message_id
-
-    game_running = True
-    await callback.answer("✅ نقش‌ها پخش شد!")
-
-
-
-async def distribute_roles():
+async def distribute_roles(session):
     """
     نقش‌ها را به پیوی بازیکنان می‌فرستد و mapping از user_id -> role برمی‌گرداند.
     ترتیب اختصاص نقش: اگر صندلی رزرو شده باشد بر اساس شماره صندلی، در غیر اینصورت بر اساس insertion-order players.
     """
-    if not selected_scenario:
+    if not session.selected_scenario:
         raise ValueError("سناریو انتخاب نشده")
 
-    roles_template = scenarios[selected_scenario]["roles"]
+    role_ids = scenarios.summary(session.selected_scenario).role_ids
     # ترتیب بازیکنان: بر اساس صندلی اگر موجود باشد، وگرنه بر اساس players.keys()
-    if player_slots:
-        player_ids = [player_slots[s] for s in sorted(player_slots.keys())]
+    if session.player_slots:
+        player_ids = [session.player_slots[s] for s in sorted(session.player_slots.keys())]
     else:
-        player_ids = list(players.keys())
+        player_ids = list(session.players.keys())
 
-    # آماده سازی لیست نقش‌ها مطابق تعداد بازیکنان
-    roles = list(roles_template)  # کپی
+    # آماده سازی id نقش‌ها مطابق تعداد بازیکنان (اگر نقش‌ها بیشتر بود کوتاه می‌شود)
+    roles = role_ids[:len(player_ids)]
     if len(player_ids) > len(roles):
         # اگر نیاز به نقش بیشتر هست، بقیه را "شهروند" قرار می‌دهیم
-        roles += ["شهروند"] * (len(player_ids) - len(roles))
-    # اگر نقش‌ها بیشتر از بازیکنان بود، کافی است کوتاهش کنیم
-    roles = roles[:len(player_ids)]
+        roles.extend([FILLER_ROLE_ID] * (len(player_ids) - len(roles)))
 
     random.shuffle(roles)
 
-    mapping = {}
-    for pid, role in zip(player_ids, roles):
-        mapping[pid] = role
-        try:
-            await bot.send_message(pid, f"🎭 نقش شما: {html.escape(str(role))}")
-        except Exception as e:
-            # به گرداننده اطلاع بده که ارسال به یکی از بازیکنان شکست خورد
-            logging.warning("⚠️ ارسال نقش به %s شکست خورد: %s", pid, e)
-            if moderator_id:
-                try:
-                    await bot.send_message(moderator_id, f"⚠ نمی‌توانم نقش را به {players.get(pid, pid)} ارسال کنم.")
-                except:
-                    pass
-
-    # ارسال لیست نقش‌ها به گرداننده (اگر وجود داشته باشد)
-    if moderator_id:
+    mapping = dict(zip(player_ids, roles))   # {user_id: role_id}
+    failed = await send_role_dms(session, mapping)
+
+    # ارسال لیست نقش‌ها + گزارش ارسال‌های ناموفق به گرداننده در یک پیام
+    if session.moderator_id:
         text = "📜 لیست نقش‌ها:\n"
         for pid, role in mapping.items():
-            text += f"{players.get(pid,'❓')} → {role}\n"
+            mark = " ❌" if pid in failed else ""
+            text += f"{html.escape(str(session.players.get(pid,'❓')))} → {html.escape(role_name(role))}{mark}\n"
+        if failed:
+            text += "\n" + role_failures_text(session, failed)
         try:
-            await bot.send_message(moderator_id, text)
+            await bot.send_message(session.moderator_id, text)
         except Exception:
             pass
 
@@ -2195,53 +2212,55 @@ async def distribute_roles():
 #==================
 # شروع راند
 #==================
-@dp.callback_query_handler(lambda c: c.data == "start_round")
+@callback_router.exact("start_round")
 async def start_round_handler(callback: types.CallbackQuery):
-    global turn_order, current_turn_index, round_active
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
-    if not turn_order:
-        seats_list = sorted(player_slots.keys())
+    if not session.turn_order:
+        seats_list = sorted(session.player_slots.keys())
         if not seats_list:
             await callback.answer("⚠️ هیچ بازیکنی در بازی نیست.", show_alert=True)
             return
-        turn_order = seats_list[:]  # همه بازیکن‌ها به ترتیب صندلی
+        session.turn_order = seats_list[:]  # همه بازیکن‌ها به ترتیب صندلی
 
-    round_active = True
-    current_turn_index = 0  # شروع از سر صحبت
+    session.round_active = True
+    session.current_turn_index = 0  # شروع از سر صحبت
 
-    first_seat = turn_order[current_turn_index]  # صندلی یا آی‌دی بازیکن اول
-    await start_turn(first_seat, duration=DEFAULT_TURN_DURATION, is_challenge=False)
-    await callback.answer()
+    first_seat = session.turn_order[session.current_turn_index]  # صندلی یا آی‌دی بازیکن اول
+    await answer_first(callback, session.chat_id,
+                       start_turn(session, first_seat, duration=DEFAULT_TURN_DURATION, is_challenge=False))
 
 #======================
 # تابع کمکی برای ساخت / بروزرسانی پیام گروه (پیام «بازی شروع شد»
 #======================
 
-async def render_game_message(edit=True):
+async def render_game_message(session, edit=True):
+
     """
     نمایش یا ویرایش پیام 'بازی شروع شد' در گروه بر اساس player_slots (صندلی‌ها).
     اگر edit==True سعی می‌کنیم پیام قبلی را ویرایش کنیم، در غیر اینصورت پیام جدید می‌فرستیم.
     """
-    global game_message_id
 
-    if not group_chat_id:
+    if not session.chat_id:
         return
 
     # لیست بازیکنان بر اساس صندلی مرتب
-    max_players = len(scenarios[selected_scenario]["roles"])
+    max_players = scenarios.seats(session.selected_scenario)
     lines = []
     for seat in range(1, max_players+1):
-        if seat in player_slots:
-            uid = player_slots[seat]
-            name = players.get(uid, "❓")
+        if seat in session.player_slots:
+            uid = session.player_slots[seat]
+            name = session.players.get(uid, "❓")
             lines.append(f"{seat}. <a href='tg://user?id={uid}'>{html.escape(name)}</a>")
     players_list = "\n".join(lines) if lines else "هیچ بازیکنی ثبت نشده است."
 
     head_text = ""
-    if current_head_seat:
-        head_uid = player_slots.get(current_head_seat)
-        head_name = players.get(head_uid, "❓")
-        head_text = f"\n\nسر صحبت: صندلی {current_head_seat} - <a href='tg://user?id={head_uid}'>{html.escape(head_name)}</a>"
+    if session.current_head_seat:
+        head_uid = session.player_slots.get(session.current_head_seat)
+        head_name = session.players.get(head_uid, "❓")
+        head_text = f"\n\nسر صحبت: صندلی {session.current_head_seat} - <a href='tg://user?id={head_uid}'>{html.escape(head_name)}</a>"
 
     text = (
         "🎮 بازی شروع شد!\n"
@@ -2257,63 +2276,65 @@ async def render_game_message(edit=True):
     kb.add(InlineKeyboardButton("🎯 انتخاب سر صحبت", callback_data="choose_head"))
     kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
     
-    if challenge_active:
+    if session.challenge_active:
         kb.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
     else:
         kb.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
     
 
     try:
-        if edit and game_message_id:
-            await bot.edit_message_text(text, chat_id=group_chat_id, message_id=game_message_id,
-                                        parse_mode="HTML", reply_markup=kb)
+        if edit and session.game_message_id:
+            await edit_cache.edit_text(bot, text, chat_id=session.chat_id, message_id=session.game_message_id,
+                                       parse_mode="HTML", reply_markup=kb)
         else:
-            msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-            game_message_id = msg.message_id
+            msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+            session.game_message_id = msg.message_id
     except Exception:
         # اگر ویرایش شکست خورد، پیام جدید بفرست و id را ذخیره کن
-        msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-        game_message_id = msg.message_id
+        msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+        session.game_message_id = msg.message_id
 
 
 # ======================
 # شروع بازی و نوبت اول
 # ======================
 
-@dp.callback_query_handler(lambda c: c.data == "start_play")
+@callback_router.exact("start_play")
 async def start_play(callback: types.CallbackQuery):
-    global game_running, lobby_active, turn_order, current_turn_index, game_message_id
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     # فقط گرداننده می‌تواند شروع کند
-    if callback.from_user.id != moderator_id:
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند بازی را شروع کند.", show_alert=True)
         return
 
-    if not selected_scenario:
+    if not session.selected_scenario:
         await callback.answer("❌ سناریو انتخاب نشده.", show_alert=True)
         return
 
-    max_players = len(scenarios[selected_scenario]["roles"])
+    max_players = scenarios.seats(session.selected_scenario)
     # اطمینان از اینکه صندلی‌ها حداقل به اندازه حداقل بازیکنان پر شده‌اند
-    occupied_seats = [s for s in range(1, max_players+1) if s in player_slots]
-    if len(occupied_seats) < scenarios[selected_scenario]["min_players"]:
-        await callback.answer(f"❌ تعداد بازیکنان کافی نیست. حداقل {scenarios[selected_scenario]['min_players']} صندلی باید انتخاب شود.", show_alert=True)
+    occupied_seats = [s for s in range(1, max_players+1) if s in session.player_slots]
+    if len(occupied_seats) < scenarios.summary(session.selected_scenario).min_players:
+        await callback.answer(f"❌ تعداد بازیکنان کافی نیست. حداقل {scenarios.summary(session.selected_scenario).min_players} صندلی باید انتخاب شود.", show_alert=True)
         return
 
     # یا اگر خواستی می‌تونی اصرار کنی که همهٔ بازیکنان صندلی انتخاب کنند:
-    if len(occupied_seats) != len(players):
+    if len(occupied_seats) != len(session.players):
         await callback.answer("❌ لطفا همه بازیکنان ابتدا صندلی انتخاب کنند تا لیست مرتب بر اساس صندلی ساخته شود.", show_alert=True)
         return
 
-    game_running = True
-    lobby_active = False
+    session.game_running = True
+    session.lobby_active = False
 
     # پخش نقش‌ها
-    await distribute_roles()
+    await distribute_roles(session)
     
         # ✅ اضافه شده
     # ساخت متن لیست بازیکنان بر اساس صندلی‌ها
-    seats = {seat: (uid, players[uid]) for seat, uid in player_slots.items()}
+    seats = {seat: (uid, session.players[uid]) for seat, uid in session.player_slots.items()}
     players_list = "\n".join(
         [f"{seat}. <a href='tg://user?id={uid}'>{name}</a>" for seat, (uid, name) in seats.items()]
     )
@@ -2333,24 +2354,24 @@ async def start_play(callback: types.CallbackQuery):
         InlineKeyboardButton("👑 انتخاب سر صحبت", callback_data="choose_head"),
         InlineKeyboardButton("▶ شروع دور", callback_data="start_round")
     )
-    if challenge_active:
+    if session.challenge_active:
         kb.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
     else:
         kb.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
     
     # ویرایش پیام لابی به پیام شروع بازی
     try:
-        if lobby_message_id:
+        if session.lobby_message_id:
             await bot.edit_message_text(
-                chat_id=group_chat_id,
-                message_id=lobby_message_id,
+                chat_id=session.chat_id,
+                message_id=session.lobby_message_id,
                 text=text,
                 parse_mode="HTML",
                 reply_markup=kb
             )
         else:
-            msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=kb)
-            lobby_message_id = msg.message_id
+            msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=kb)
+            session.lobby_message_id = msg.message_id
     except Exception as e:
         print("❌ خطا در ویرایش پیام لابی:", e)
         
@@ -2358,11 +2379,13 @@ async def start_play(callback: types.CallbackQuery):
 #==================================
 #منو انتخاب سر صحبت (نمایش گزینه خودکار/دستی)
 #==================================
-@dp.callback_query_handler(lambda c: c.data == "choose_head")
+@callback_router.exact("choose_head")
 async def choose_head(callback: types.CallbackQuery):
-    global game_message_id
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
-    if callback.from_user.id != moderator_id:
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند این کار را انجام دهد.", show_alert=True)
         return
 
@@ -2378,16 +2401,16 @@ async def choose_head(callback: types.CallbackQuery):
         # تلاش برای ویرایش پیام قبلی
         await bot.edit_message_text(
             text,
-            chat_id=group_chat_id,
-            message_id=game_message_id,
+            chat_id=session.chat_id,
+            message_id=session.game_message_id,
             reply_markup=kb,
             parse_mode="HTML"
         )
     except Exception as e:
         logging.warning(f"⚠️ خطا در نمایش منو: {e}")
         # اگر پیام قبلی قابل ویرایش نبود → پیام جدید بفرست
-        msg = await bot.send_message(group_chat_id, text, reply_markup=kb)
-        game_message_id = msg.message_id  # بروزرسانی آیدی پیام جدید
+        msg = await bot.send_message(session.chat_id, text, reply_markup=kb)
+        session.game_message_id = msg.message_id  # بروزرسانی آیدی پیام جدید
 
     await callback.answer()
 
@@ -2395,54 +2418,59 @@ async def choose_head(callback: types.CallbackQuery):
 # انتخاب خودکار → نمایش لیست صندلی‌ها با دکمه برای انتخاب
 #=======================================
 
-@dp.callback_query_handler(lambda c: c.data == "speaker_auto")
+@callback_router.exact("speaker_auto")
 async def speaker_auto(callback: types.CallbackQuery):
+    session = await session_for_callback(callback)
+    if not session:
+        return
     import random
-    global current_speaker, turn_order, current_turn_index
 
-    if callback.from_user.id != moderator_id:
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند انتخاب کند.", show_alert=True)
         return
 
-    if not player_slots:
+    if not session.player_slots:
         await callback.answer("⚠ هیچ صندلی ثبت نشده.", show_alert=True)
         return
 
-    seats_list = sorted(player_slots.keys())
-    current_speaker = random.choice(seats_list)
-    current_turn_index = seats_list.index(current_speaker)
+    seats_list = sorted(session.player_slots.keys())
+    session.current_speaker = random.choice(seats_list)
+    session.current_turn_index = seats_list.index(session.current_speaker)
 
     # درست‌کردن ترتیب نوبت‌ها: همه از سر صحبت شروع بشن
-    turn_order = seats_list[current_turn_index:] + seats_list[:current_turn_index]
+    session.turn_order = seats_list[session.current_turn_index:] + seats_list[:session.current_turn_index]
 
     # اطمینان از اینکه سر صحبت در اول لیست هست
-    if current_speaker in turn_order:
-        turn_order.remove(current_speaker)
-    turn_order.insert(0, current_speaker)
+    if session.current_speaker in session.turn_order:
+        session.turn_order.remove(session.current_speaker)
+    session.turn_order.insert(0, session.current_speaker)
+    session.mark_dirty()
 
-    await callback.answer(f"✅ صندلی {current_speaker} به صورت رندوم سر صحبت شد.")
+    async def show_order_and_menu():
+        # نمایش لیست بازیکنان بر اساس نوبت صحبت
+        await send_turn_order_list(session)
 
-    # نمایش لیست بازیکنان بر اساس نوبت صحبت
-    await send_turn_order_list()
-
-    # بازگرداندن منوی بازی (انتخاب سر صحبت + شروع دور)
-    kb = InlineKeyboardMarkup(row_width=1)
-    kb.add(InlineKeyboardButton("👑 انتخاب سر صحبت", callback_data="choose_head"))
-    kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
+        # بازگرداندن منوی بازی (انتخاب سر صحبت + شروع دور)
+        kb = InlineKeyboardMarkup(row_width=1)
+        kb.add(InlineKeyboardButton("👑 انتخاب سر صحبت", callback_data="choose_head"))
+        kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
     
-    if challenge_active:
-        kb.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
-    else:
-        kb.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
+        if session.challenge_active:
+            kb.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
+        else:
+            kb.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
 
-    try:
-        await bot.edit_message_reply_markup(
-            chat_id=group_chat_id,
-            message_id=game_message_id,
-            reply_markup=kb
-        )
-    except Exception:
-        pass
+        try:
+            await bot.edit_message_reply_markup(
+                chat_id=session.chat_id,
+                message_id=session.game_message_id,
+                reply_markup=kb
+            )
+        except Exception:
+            pass
+
+    await answer_first(callback, session.chat_id, show_order_and_menu(),
+                       f"✅ صندلی {session.current_speaker} به صورت رندوم سر صحبت شد.")
 
 
 
@@ -2452,28 +2480,31 @@ async def speaker_auto(callback: types.CallbackQuery):
 # انتخاب دستی → نمایش لیست صندلی‌ها با دکمه برای انتخاب
 #=======================================
 
-@dp.callback_query_handler(lambda c: c.data == "speaker_manual")
+@callback_router.exact("speaker_manual")
 async def speaker_manual(callback: types.CallbackQuery):
-    if callback.from_user.id != moderator_id:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند انتخاب کند.", show_alert=True)
         return
 
-    if not player_slots:
+    if not session.player_slots:
         await callback.answer("⚠ هیچ صندلی ثبت نشده.", show_alert=True)
         return
 
-    seats = {seat: (uid, players.get(uid, "❓")) for seat, uid in player_slots.items()}
+    seats = {seat: (uid, session.players.get(uid, "❓")) for seat, uid in session.player_slots.items()}
     kb = InlineKeyboardMarkup(row_width=2)
     for seat, (uid, name) in sorted(seats.items()):
         kb.add(InlineKeyboardButton(f"{seat}. {html.escape(name)}", callback_data=f"head_set_{seat}"))
 
     try:
-        await bot.edit_message_reply_markup(chat_id=group_chat_id, message_id=game_message_id, reply_markup=kb)
+        await bot.edit_message_reply_markup(chat_id=session.chat_id, message_id=session.game_message_id, reply_markup=kb)
     except Exception:
         # اگر اصلا ویرایش نشد، ارسال پیام جدید با همین کیبورد
         try:
-            msg = await bot.send_message(group_chat_id, "✋ یکی از بازیکنان را انتخاب کنید:", reply_markup=kb)
-            game_message_id = msg.message_id
+            msg = await bot.send_message(session.chat_id, "✋ یکی از بازیکنان را انتخاب کنید:", reply_markup=kb)
+            session.game_message_id = msg.message_id
         except:
             pass
 
@@ -2482,70 +2513,71 @@ async def speaker_manual(callback: types.CallbackQuery):
 #==========================
 # هد ست
 #==========================
-@dp.callback_query_handler(lambda c: c.data.startswith("head_set_"))
+@callback_router.prefix("head_set_")
 async def head_set_handler(callback: types.CallbackQuery):
-    global turn_order, current_turn_index
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
-    if callback.from_user.id != moderator_id:
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند سر صحبت را تعیین کند.", show_alert=True)
         return
 
     # صندلی انتخاب شده
     seat = int(callback.data.split("head_set_")[1])
 
-    if seat not in player_slots:
+    if seat not in session.player_slots:
         await callback.answer("⚠ این صندلی خالی است.", show_alert=True)
         return
 
     # ساخت ترتیب نوبت: بازیکن انتخاب‌شده اول، بقیه به ترتیب صندلی‌ها
-    all_seats = sorted(player_slots.keys())
+    all_seats = sorted(session.player_slots.keys())
     start_index = all_seats.index(seat)
-    turn_order = all_seats[start_index:] + all_seats[:start_index]
+    session.turn_order = all_seats[start_index:] + all_seats[:start_index]
 
-    current_turn_index = 0
+    session.current_turn_index = 0
 
     await callback.answer("✅ سر صحبت انتخاب شد!")
 
     # نمایش لیست بازیکنان به ترتیب نوبت صحبت
-    await send_turn_order_list()
+    await send_turn_order_list(session)
 
     # نمایش منوی شروع دور و چالش
     kb = InlineKeyboardMarkup(row_width=1)
     kb.add(InlineKeyboardButton("▶ شروع دور", callback_data="start_round"))
-    if challenge_active:
+    if session.challenge_active:
         kb.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
     else:
         kb.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
 
-    await bot.send_message(group_chat_id, "🔧 حالا می‌توانید دور را شروع کنید:", reply_markup=kb)
+    await bot.send_message(session.chat_id, "🔧 حالا می‌توانید دور را شروع کنید:", reply_markup=kb)
 
 
 # ======================
 # شروع بازی و نوبت اول
 # ======================
-async def start_turn(seat, duration=DEFAULT_TURN_DURATION, is_challenge=False):
+async def start_turn(session, seat, duration=DEFAULT_TURN_DURATION, is_challenge=False):
     """
     شروع نوبت برای یک seat (صندلی). این تابع:
     - پیام نوبت را در گروه می‌فرستد و پین می‌کند
     - کیبورد مناسب را می‌سازد
     - تایمر زنده را با countdown ایجاد می‌کند
     """
-    global current_turn_message_id, turn_timer_task, challenge_mode
 
-    if not group_chat_id:
+    if not session.chat_id:
         return
 
     # seat باید در player_slots باشد
-    if seat not in player_slots:
-        await bot.send_message(group_chat_id, f"⚠️ صندلی {seat} بازیکنی ندارد.")
+    if seat not in session.player_slots:
+        await bot.send_message(session.chat_id, f"⚠️ صندلی {seat} بازیکنی ندارد.")
         return
 
-    user_id = player_slots[seat]
-    player_name = players.get(user_id, "بازیکن")
+    user_id = session.player_slots[seat]
+    player_name = session.players.get(user_id, "بازیکن")
     mention = f"<a href='tg://user?id={user_id}'>{html.escape(str(player_name))}</a>"
 
     # حالت چالش را تنظیم کن
-    challenge_mode = bool(is_challenge)
+    session.challenge_mode = bool(is_challenge)
 
     # unpin پیام قبلی اگر لازم
     #if current_turn_message_id:
@@ -2555,7 +2587,8 @@ async def start_turn(seat, duration=DEFAULT_TURN_DURATION, is_challenge=False):
             #pass
 
     text = f"⏳ {duration//60:02d}:{duration%60:02d}\n🎙 نوبت صحبت {mention} است. ({duration} ثانیه)"
-    msg = await bot.send_message(group_chat_id, text, parse_mode="HTML", reply_markup=turn_keyboard(seat, is_challenge))
+    with outbound_priority(CRITICAL):
+        msg = await bot.send_message(session.chat_id, text, parse_mode="HTML", reply_markup=turn_keyboard(session, seat, is_challenge))
 
     # تلاش برای پین کردن پیام جدید (اختیاری)
     #try:
@@ -2565,182 +2598,210 @@ async def start_turn(seat, duration=DEFAULT_TURN_DURATION, is_challenge=False):
 
     #current_turn_message_id = msg.message_id
 
-    # لغو تایمر قبلی
-    if turn_timer_task and not turn_timer_task.done():
-        turn_timer_task.cancel()
-
-    # راه‌اندازی تایمر (task)
-    turn_timer_task = asyncio.create_task(countdown(seat, duration, msg.message_id, is_challenge))
+    # راه‌اندازی تایمر (تایمر قبلی همین گروه خودکار لغو می‌شود)
+    session.turn_timer = countdown(session, seat, duration, msg.message_id, is_challenge)
+    session.turn_state = (seat, time.time() + duration, bool(is_challenge))
 
 # ======================
 # هندلر دکمه شروع دور
 # ======================
-@dp.callback_query_handler(lambda c: c.data == "start_turn")
+@callback_router.exact("start_turn")
 async def handle_start_turn(callback: types.CallbackQuery):
-    if callback.from_user.id != moderator_id:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند دور را شروع کند.", show_alert=True)
         return
 
-    global current_turn_index
-    if not turn_order:
+    if not session.turn_order:
         await callback.answer("⚠️ ترتیب نوبت‌ها مشخص نشده.", show_alert=True)
         return
 
-    current_turn_index = 0
-    first_seat = turn_order[current_turn_index]
-    await start_turn(first_seat)
+    session.current_turn_index = 0
+    first_seat = session.turn_order[session.current_turn_index]
+    await start_turn(session, first_seat)
 
     await callback.answer()
 
 #================
 # چالش آف
 #================
-@dp.callback_query_handler(lambda c: c.data == "challenge_off")
+@callback_router.exact("challenge_off")
 async def challenge_off_handler(callback: types.CallbackQuery):
-    global challenge_active
-    if callback.from_user.id != moderator_id:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند چالش را غیرفعال کند.", show_alert=True)
         return
 
-    if not challenge_active:
+    if not session.challenge_active:
         await callback.answer("⚔ چالش از قبل غیرفعال است.", show_alert=True)
         return
 
-@dp.callback_query_handler(lambda c: c.data == "challenge_toggle")
+@callback_router.exact("challenge_toggle")
 async def challenge_toggle_handler(callback: types.CallbackQuery):
-    global challenge_active
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
-    if callback.from_user.id != moderator_id:
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند وضعیت چالش را تغییر دهد.", show_alert=True)
         return
 
     # اینجا: تغییر وضعیت
-    challenge_active = not challenge_active
+    session.challenge_active = not session.challenge_active
 #=============================
 # تایمر زندهٔ نوبت (ویرایش پیام هر N ثانیه)
 #=============================
-async def countdown(seat, duration, message_id, is_challenge=False):
-    remaining = duration
-    user_id = player_slots.get(seat)
-    player_name = players.get(user_id, "بازیکن")
+def countdown(session, seat, duration, message_id, is_challenge=False):
+    """
+    تایمر نوبت را در زمان‌بند مرکزی (timers.turn_timers) ثبت می‌کند.
+    زمان باقیمانده از deadline واقعی محاسبه می‌شود، نه از شمارش sleepها.
+    ریتم ویرایش‌ها با countdown_cadence تنظیم می‌شود (اول کم، نزدیک پایان بیشتر).
+    """
+    user_id = session.player_slots.get(seat)
+    player_name = session.players.get(user_id, "بازیکن")
     mention = f"<a href='tg://user?id={user_id}'>{html.escape(str(player_name))}</a>"
 
-    try:
-        while remaining > 0:
-            await asyncio.sleep(5)
-            remaining -= 5
-            new_text = f"⏳ {max(0, remaining)//60:02d}:{max(0, remaining)%60:02d}\n🎙 نوبت صحبت {mention} است. ({max(0, remaining)} ثانیه)"
-            try:
-                await bot.edit_message_text(new_text, chat_id=group_chat_id, message_id=message_id,
-                                            parse_mode="HTML", reply_markup=turn_keyboard(seat, is_challenge))
-            except:
-                pass
+    async def on_tick(timer, remaining):
+        remaining = math.ceil(remaining)
+        new_text = f"⏳ {remaining//60:02d}:{remaining%60:02d}\n🎙 نوبت صحبت {mention} است. ({remaining} ثانیه)"
+        if timer_edit_budget.wait_time(session.chat_id) > 0:
+            return
+        # کیبورد هر بار از وضعیت فعلی ساخته می‌شود (درخواست/قبول چالش وسط نوبت)؛
+        # اگر تغییری نکرده باشد edit_cache ویرایش را نمی‌فرستد
+        kb = turn_keyboard(session, seat, is_challenge)
+        try:
+            # تایمر کم‌اولویت است؛ ویرایش‌های منتظر یک پیام ادغام یا دور ریخته می‌شوند
+            with outbound_priority(LOW):
+                sent = await edit_cache.edit_text(bot, new_text, chat_id=session.chat_id, message_id=message_id,
+                                                  parse_mode="HTML", reply_markup=kb)
+            if sent:
+                timer_edit_budget.record(session.chat_id)
+        except RetryAfter as e:
+            # تلگرام گفته صبر کن → تایمر این گروه عقب می‌کشد تا پیام‌های بازی جا داشته باشند
+            timer_edit_budget.pause(session.chat_id, e.timeout)
+        except Exception:
+            pass
+
+    async def on_expire(timer):
+        session.turn_state = None
         # پایان زمان → پیام موقتی
-        await send_temp_message(group_chat_id, f"⏳ زمان {mention} به پایان رسید.", delay=5)
-    except asyncio.CancelledError:
-        return
+        await send_temp_message(session.chat_id, f"⏳ زمان {mention} به پایان رسید.", delay=5)
+
+    return turn_timers.schedule(session.chat_id, duration, on_tick=on_tick, on_expire=on_expire,
+                                cadence=countdown_cadence(session.chat_id))
 
 
 # ======================
 # نکست نوبت
 # ======================
-@dp.callback_query_handler(lambda c: c.data.startswith("next_"))
+@callback_router.prefix("next_")
 async def next_turn(callback: types.CallbackQuery):
-    global current_turn_index, challenge_mode
-    global paused_main_player, paused_main_duration, post_challenge_advance
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     try:
         seat = int(callback.data.split("_", 1)[1])
     except Exception:
-        await bot.send_message(group_chat_id, "⚠️ دادهٔ نادرست برای نکست.")
+        await bot.send_message(session.chat_id, "⚠️ دادهٔ نادرست برای نکست.")
         return
 
-    player_uid = player_slots.get(seat)
-    if callback.from_user.id != moderator_id and callback.from_user.id != player_uid:
+    player_uid = session.player_slots.get(seat)
+    if callback.from_user.id != session.moderator_id and callback.from_user.id != player_uid:
         await callback.answer("❌ فقط بازیکن مربوطه یا گرداننده می‌تواند نوبت را پایان دهد.", show_alert=True)
         return
 
     # لغو تایمر
-    if turn_timer_task and not turn_timer_task.done():
-        turn_timer_task.cancel()
+    session.cancel_timer()
 
     # =========================
     #  حالت "چالش"
     # =========================
-    if challenge_mode:
-        challenge_mode = False
+    if session.challenge_mode:
+        session.challenge_mode = False
 
-        if paused_main_player is not None:
-            if post_challenge_advance:
+        if session.paused_main_player is not None:
+            if session.post_challenge_advance:
                 # بعد از چالش → برو نفر بعد از main
-                post_challenge_advance = False
-                current_turn_index += 1
+                session.post_challenge_advance = False
+                session.current_turn_index += 1
 
             # پاکسازی وضعیت
-            paused_main_player = None
-            paused_main_duration = None
+            session.paused_main_player = None
+            session.paused_main_duration = None
 
     # =========================
     #  حالت "نوبت عادی"
     # =========================
     else:
         # بررسی کنیم آیا برای این بازیکن چالش رزرو شده؟
-        if seat in pending_challenges:
-            challenger_id = pending_challenges.pop(seat)
-            challenger_seat = next((s for s, u in player_slots.items() if u == challenger_id), None)
+        if seat in session.pending_challenges:
+            challenger_id = session.pending_challenges.pop(seat)
+            session.mark_dirty()
+            challenger_seat = session.player_slots.seat_of(challenger_id)
             if challenger_seat:
                 # ذخیره نوبت اصلی
-                paused_main_player = seat
-                paused_main_duration = 120  # یا زمان واقعی نوبت اصلی
-                post_challenge_advance = True
-                challenge_mode = True
+                session.paused_main_player = seat
+                session.paused_main_duration = 120  # یا زمان واقعی نوبت اصلی
+                session.post_challenge_advance = True
+                session.challenge_mode = True
 
                 # شروع چالش
-                await start_turn(challenger_seat, duration=60, is_challenge=True)
+                await start_turn(session, challenger_seat, duration=60, is_challenge=True)
                 return
 
         # اگر چالشی نبود → برو نفر بعدی
-        current_turn_index += 1
+        session.current_turn_index += 1
 
     # =========================
     #  پایان روز یا ادامه نوبت
     # =========================
-    if current_turn_index >= len(turn_order):
+    if session.current_turn_index >= len(session.turn_order):
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("🌙 شروع فاز شب", callback_data="start_night"))
-        await bot.send_message(group_chat_id, "✅ همه بازیکنان صحبت کردند. فاز روز پایان یافت.", reply_markup=kb)
+        await bot.send_message(session.chat_id, "✅ همه بازیکنان صحبت کردند. فاز روز پایان یافت.", reply_markup=kb)
     else:
-        next_seat = turn_order[current_turn_index]
-        await start_turn(next_seat)
+        next_seat = session.turn_order[session.current_turn_index]
+        await start_turn(session, next_seat)
 
 
 #========================
 # شب کردن
 #========================
-@dp.callback_query_handler(lambda c: c.data == "start_night")
+@callback_router.exact("start_night")
 async def start_night(callback: types.CallbackQuery):
-    if callback.from_user.id != moderator_id:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند فاز شب را شروع کند.", show_alert=True)
         return
 
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("🌞 شروع روز جدید", callback_data="start_new_day"))
 
-    await bot.send_message(group_chat_id, "🌙 فاز شب شروع شد. بازیکنان ساکت باشند...", reply_markup=kb)
+    await bot.send_message(session.chat_id, "🌙 فاز شب شروع شد. بازیکنان ساکت باشند...", reply_markup=kb)
     await callback.answer()
 
 
 #===========================
 # روز کردن و ریست دور قبل
 #===========================
-@dp.callback_query_handler(lambda c: c.data == "start_new_day")
+@callback_router.exact("start_new_day")
 async def start_new_day(callback: types.CallbackQuery):
-    if callback.from_user.id != moderator_id:
+    session = await session_for_callback(callback)
+    if not session:
+        return
+    if callback.from_user.id != session.moderator_id:
         await callback.answer("❌ فقط گرداننده می‌تواند روز جدید را شروع کند.", show_alert=True)
         return
 
     # ریست تمام داده‌های دور قبلی
-    reset_round_data()
+    session.reset_round()
 
     # دکمه‌ها
     keyboard = InlineKeyboardMarkup()
@@ -2750,7 +2811,7 @@ async def start_new_day(callback: types.CallbackQuery):
     )
 
     # دکمه وضعیت چالش
-    if challenge_active:
+    if session.challenge_active:
         keyboard.add(InlineKeyboardButton("⚔ چالش روشن", callback_data="challenge_toggle"))
     else:
         keyboard.add(InlineKeyboardButton("⚔ چالش خاموش", callback_data="challenge_toggle"))
@@ -2770,56 +2831,64 @@ async def start_new_day(callback: types.CallbackQuery):
 #=======================
 # درخواست چالش
 #=======================
-@dp.callback_query_handler(lambda c: c.data.startswith(("challenge_before_", "challenge_after_", "challenge_none_")))
+@callback_router.prefix("challenge_before_", "challenge_after_", "challenge_none_")
 async def challenge_choice(callback: types.CallbackQuery):
-    global paused_main_player, paused_main_duration
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     parts = callback.data.split("_")
     action = parts[1]     # before / after / none
     challenger_id = int(parts[2])
     target_id = int(parts[3])
 
-    challenger_name = players.get(challenger_id, "بازیکن")
-    target_name = players.get(target_id, "بازیکن")
+    challenger_name = session.players.get(challenger_id, "بازیکن")
+    target_name = session.players.get(target_id, "بازیکن")
 
-    if callback.from_user.id not in [challenger_id, moderator_id]:
+    if callback.from_user.id not in [challenger_id, session.moderator_id]:
         await callback.answer("❌ فقط چالش‌کننده یا گرداننده می‌تواند این گزینه را انتخاب کند.", show_alert=True)
         return
 
+    target_seat = session.player_slots.seat_of(target_id)
+
     if action == "before":
-        paused_main_player = target_seat
-        paused_main_duration = DEFAULT_TURN_DURATION
+        session.paused_main_player = target_seat
+        session.paused_main_duration = DEFAULT_TURN_DURATION
 
-        if turn_timer_task and not turn_timer_task.done():
-            turn_timer_task.cancel()
+        session.cancel_timer()
 
-        challenger_seat = next((s for s,u in player_slots.items() if u == challenger_id), None)
+        challenger_seat = session.player_slots.seat_of(challenger_id)
         if challenger_seat is None:
-            await bot.send_message(group_chat_id, "⚠️ چالش‌کننده صندلی ندارد؛ نمی‌توان چالش را اجرا کرد.")
+            await bot.send_message(session.chat_id, "⚠️ چالش‌کننده صندلی ندارد؛ نمی‌توان چالش را اجرا کرد.")
         else:
-            await bot.send_message(group_chat_id, f"⚔ چالش قبل صحبت برای {target_name} توسط {challenger_name} اجرا شد.")
-            await start_turn(challenger_seat, duration=60, is_challenge=True)
+            await bot.send_message(session.chat_id, f"⚔ چالش قبل صحبت برای {target_name} توسط {challenger_name} اجرا شد.")
+            await start_turn(session, challenger_seat, duration=60, is_challenge=True)
 
     elif action == "after":
-        target_seat = next((s for s,u in player_slots.items() if u == target_id), None)
         if target_seat is None:
-            await bot.send_message(group_chat_id, "⚠️ هدف چالش صندلی ندارد؛ نمی‌توان چالش را ثبت کرد.")
+            await bot.send_message(session.chat_id, "⚠️ هدف چالش صندلی ندارد؛ نمی‌توان چالش را ثبت کرد.")
         else:
-            pending_challenges[target_seat] = challenger_id
-            await bot.send_message(group_chat_id, f"⚔ چالش بعد صحبت برای {target_name} ثبت شد (چالش‌کننده: {challenger_name}).")
+            session.pending_challenges[target_seat] = challenger_id
+            session.mark_dirty()
+            await bot.send_message(session.chat_id, f"⚔ چالش بعد صحبت برای {target_name} ثبت شد (چالش‌کننده: {challenger_name}).")
 
     elif action == "none":
-        await bot.send_message(group_chat_id, f"🚫 {challenger_name} از ارسال چالش منصرف شد.")
+        await bot.send_message(session.chat_id, f"🚫 {challenger_name} از ارسال چالش منصرف شد.")
 
     await callback.answer()
     
 # ======================
 # درخواست چالش (باز کردن منوی انتخاب قبل/بعد/انصراف)
 # ======================
-challenge_requests = {}
+# پاسخ چالش به صورت عدد در callback_data کد می‌شود
+CHALLENGE_REJECT, CHALLENGE_BEFORE, CHALLENGE_AFTER = 0, 1, 2
+CHALLENGE_TIMINGS = {CHALLENGE_BEFORE: "before", CHALLENGE_AFTER: "after"}
 
-@dp.callback_query_handler(lambda c: c.data.startswith("challenge_request_"))
+@callback_router.prefix("challenge_request_")
 async def challenge_request(callback: types.CallbackQuery):
+    session = await session_for_callback(callback)
+    if not session:
+        return
     challenger_id = callback.from_user.id
     try:
         target_seat = int(callback.data.split("_", 2)[2])
@@ -2827,7 +2896,7 @@ async def challenge_request(callback: types.CallbackQuery):
         await callback.answer("⚠️ خطا در داده چالش.", show_alert=True)
         return
 
-    target_id = player_slots.get(target_seat)
+    target_id = session.player_slots.get(target_seat)
     if not target_id:
         await callback.answer("⚠️ بازیکن یافت نشد.", show_alert=True)
         return
@@ -2837,94 +2906,98 @@ async def challenge_request(callback: types.CallbackQuery):
         await callback.answer("❌ نمی‌توانی به خودت درخواست چالش بدهی.", show_alert=True)
         return
 
-    challenger_name = players.get(challenger_id, "بازیکن")
-    target_name = players.get(target_id, "بازیکن")
+    challenger_name = session.players.get(challenger_id, "بازیکن")
+    target_name = session.players.get(target_id, "بازیکن")
 
     # ثبت درخواست جدید
-    if target_seat not in challenge_requests:
-        challenge_requests[target_seat] = {}
-    if challenger_id in challenge_requests[target_seat]:
+    async with session_locks.hold(session.chat_id, CHALLENGES):
+        requests = session.challenge_requests.setdefault(target_seat, {})
+        duplicate = challenger_id in requests
+        if not duplicate:
+            requests[challenger_id] = "pending"
+            session.mark_dirty()
+    if duplicate:
         await callback.answer("❌ در این نوبت قبلاً درخواست داده‌ای.", show_alert=True)
         return
 
-    challenge_requests[target_seat][challenger_id] = "pending"
-
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton("✅ قبول (قبل)", callback_data=f"accept_before_{challenger_id}_{target_id}"),
-        InlineKeyboardButton("✅ قبول (بعد)", callback_data=f"accept_after_{challenger_id}_{target_id}"),
-        InlineKeyboardButton("❌ رد", callback_data=f"reject_{challenger_id}_{target_id}")
+        InlineKeyboardButton("✅ قبول (قبل)", callback_data=callback_codec.encode("challenge_reply", CHALLENGE_BEFORE, challenger_id, target_id)),
+        InlineKeyboardButton("✅ قبول (بعد)", callback_data=callback_codec.encode("challenge_reply", CHALLENGE_AFTER, challenger_id, target_id)),
+        InlineKeyboardButton("❌ رد", callback_data=callback_codec.encode("challenge_reply", CHALLENGE_REJECT, challenger_id, target_id))
     )
 
-    await bot.send_message(group_chat_id, f"⚔ {challenger_name} از {target_name} درخواست چالش کرد.", reply_markup=kb)
+    with outbound_priority(CRITICAL):
+        await bot.send_message(session.chat_id, f"⚔ {challenger_name} از {target_name} درخواست چالش کرد.", reply_markup=kb)
     await callback.answer("⏳ درخواست ارسال شد.", show_alert=True)
 
 
 #=======================
 # پذیرش/رد چالش
 #=======================
-@dp.callback_query_handler(lambda c: c.data.startswith(("accept_before_", "accept_after_", "reject_")))
-async def handle_challenge_response(callback: types.CallbackQuery):
-    global paused_main_player, paused_main_duration, challenge_mode, post_challenge_advance
+@callback_router.encoded("challenge_reply")
+async def handle_challenge_response(callback: types.CallbackQuery, args):
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
-    parts = callback.data.split("_")
-    action = parts[0]      # accept / reject
-    timing = parts[1] if action == "accept" else None
-    challenger_id = int(parts[2])
-    target_id = int(parts[3])
+    choice, challenger_id, target_id = args
+    action = "reject" if choice == CHALLENGE_REJECT else "accept"
+    timing = CHALLENGE_TIMINGS.get(choice)
 
-    target_seat = next((s for s, u in player_slots.items() if u == target_id), None)
-    challenger_seat = next((s for s, u in player_slots.items() if u == challenger_id), None)
+    target_seat = session.player_slots.seat_of(target_id)
+    challenger_seat = session.player_slots.seat_of(challenger_id)
 
     if not target_seat or not challenger_seat:
         await callback.answer("⚠️ صندلی نامعتبر.", show_alert=True)
         return
 
-    if callback.from_user.id not in [target_id, moderator_id]:
+    if callback.from_user.id not in [target_id, session.moderator_id]:
         await callback.answer("❌ فقط صاحب نوبت یا گرداننده می‌تواند تصمیم بگیرد.", show_alert=True)
         return
 
-    challenger_name = players.get(challenger_id, "بازیکن")
-    target_name = players.get(target_id, "بازیکن")
+    challenger_name = session.players.get(challenger_id, "بازیکن")
+    target_name = session.players.get(target_id, "بازیکن")
+
+    async with session_locks.hold(session.chat_id, CHALLENGES):
+        # دو کلیک هم‌زمان روی «قبول» نباید دو چالش بسازد
+        already_accepted = action == "accept" and target_seat in session.active_challenger_seats
+        if not already_accepted:
+            # همه درخواست‌های مربوط به target پاک بشن
+            session.challenge_requests[target_seat] = {}
+            session.mark_dirty()
+            if action == "accept":
+                # فقط target (صاحب نوبت) به لیست چالش‌دهنده‌ها اضافه میشه
+                session.active_challenger_seats.add(target_seat)
+                if timing == "before":
+                    session.paused_main_player = target_seat
+                    session.paused_main_duration = DEFAULT_TURN_DURATION
+                    session.challenge_mode = True
+                elif timing == "after":
+                    session.pending_challenges[target_seat] = challenger_id
 
-    # درخواست‌های بازیکن مربوطه رو از لیست پاک می‌کنیم
-    if target_seat in challenge_requests:
-        challenge_requests[target_seat].pop(challenger_id, None)
+    if already_accepted:
+        await callback.answer("⚠️ این بازیکن قبلاً چالش را پذیرفته است.", show_alert=True)
+        return
 
     if action == "reject":
-        challenge_requests[target_seat] = {}
         await callback.message.edit_reply_markup(reply_markup=None)  # ❌ حذف دکمه‌ها
-        await bot.send_message(group_chat_id, f"🚫 {target_name} درخواست چالش {challenger_name} را رد کرد.")
+        await bot.send_message(session.chat_id, f"🚫 {target_name} درخواست چالش {challenger_name} را رد کرد.")
         await callback.answer()
         return
 
-    if action == "accept":
-        # همه درخواست‌های مربوط به target پاک بشن
-        challenge_requests[target_seat] = {}
-        # فقط target به active_challenger_seats اضافه میشه
-        active_challenger_seats.add(target_seat)
-
-        await callback.message.edit_reply_markup(reply_markup=None)  # ❌ حذف دکمه‌ها
-
-    # ✅ فقط target (صاحب نوبت) به لیست چالش‌دهنده‌ها اضافه میشه
-    active_challenger_seats.add(target_seat)
+    await callback.message.edit_reply_markup(reply_markup=None)  # ❌ حذف دکمه‌ها
 
     if timing == "before":
-        paused_main_player = target_seat
-        paused_main_duration = DEFAULT_TURN_DURATION
-        challenge_mode = True
-
         await bot.send_message(
-            group_chat_id,
+            session.chat_id,
             f"⚔ {target_name} درخواست چالش {challenger_name} را قبول کرد (قبل از صحبت)."
         )
-        await start_turn(challenger_seat, duration=60, is_challenge=True)
+        await start_turn(session, challenger_seat, duration=60, is_challenge=True)
 
     elif timing == "after":
-        pending_challenges[target_seat] = challenger_id
-
         await bot.send_message(
-            group_chat_id,
+            session.chat_id,
             f"⚔ {target_name} درخواست چالش {challenger_name} را قبول کرد (بعد از صحبت)."
         )
 
@@ -2933,9 +3006,11 @@ async def handle_challenge_response(callback: types.CallbackQuery):
 # ======================
 # انتخاب نوع چالش (قبل / بعد / انصراف)
 # ======================
-@dp.callback_query_handler(lambda c: c.data.startswith("challenge_"))
+@callback_router.prefix("challenge_")
 async def challenge_choice(callback: types.CallbackQuery):
-    global paused_main_player, paused_main_duration
+    session = await session_for_callback(callback)
+    if not session:
+        return
 
     parts = callback.data.split("_")
     # مثال: challenge_before_12345_67890
@@ -2943,48 +3018,143 @@ async def challenge_choice(callback: types.CallbackQuery):
     challenger_id = int(parts[2])
     target_id = int(parts[3])
 
-    challenger_name = players.get(challenger_id, "بازیکن")
-    target_name = players.get(target_id, "بازیکن")
+    challenger_name = session.players.get(challenger_id, "بازیکن")
+    target_name = session.players.get(target_id, "بازیکن")
 
     # فقط چالش‌کننده یا گرداننده اجازه دارند
-    if callback.from_user.id not in [challenger_id, moderator_id]:
+    if callback.from_user.id not in [challenger_id, session.moderator_id]:
         await callback.answer("❌ فقط صاحب ترن یا گرداننده می‌تواند این گزینه را انتخاب کند.", show_alert=True)
         return
 
     if action == "before":
-        paused_main_player = target_id
-        paused_main_duration = DEFAULT_TURN_DURATION
+        session.paused_main_player = target_id
+        session.paused_main_duration = DEFAULT_TURN_DURATION
 
-        if turn_timer_task and not turn_timer_task.done():
-            turn_timer_task.cancel()
+        session.cancel_timer()
 
-        challenger_seat = next((s for s,u in player_slots.items() if u == challenger_id), None)
+        challenger_seat = session.player_slots.seat_of(challenger_id)
         if challenger_seat is None:
-            await bot.send_message(group_chat_id, "⚠️ چالش‌کننده صندلی ندارد؛ نمی‌توان چالش را اجرا کرد.")
+            await bot.send_message(session.chat_id, "⚠️ چالش‌کننده صندلی ندارد؛ نمی‌توان چالش را اجرا کرد.")
         else:
-            await bot.send_message(group_chat_id, f"⚔ چالش قبل صحب برای {challenger_name} از {target_name} اجرا شد.")
-            await start_turn(challenger_seat, duration=60, is_challenge=True)
+            await bot.send_message(session.chat_id, f"⚔ چالش قبل صحب برای {challenger_name} از {target_name} اجرا شد.")
+            await start_turn(session, challenger_seat, duration=60, is_challenge=True)
 
     elif action == "after":
-        target_seat = next((s for s,u in player_slots.items() if u == target_id), None)
+        target_seat = session.player_slots.seat_of(target_id)
         if target_seat is None:
-            await bot.send_message(group_chat_id, "⚠️ هدف چالش صندلی ندارد؛ نمی‌توان چالش را ثبت کرد.")
+            await bot.send_message(session.chat_id, "⚠️ هدف چالش صندلی ندارد؛ نمی‌توان چالش را ثبت کرد.")
         else:
-            pending_challenges[target_seat] = challenger_id
-            await bot.send_message(group_chat_id, f"⚔ چالش بعد صحبت برای {target_name} ثبت شد (: {challenger_name}).")
+            session.pending_challenges[target_seat] = challenger_id
+            session.mark_dirty()
+            await bot.send_message(session.chat_id, f"⚔ چالش بعد صحبت برای {target_name} ثبت شد (: {challenger_name}).")
 
     elif action == "none":
-        await bot.send_message(group_chat_id, f"🚫 {challenger_name}   چالش نداد .")
+        await bot.send_message(session.chat_id, f"🚫 {challenger_name}   چالش نداد .")
 
     await callback.answer()
 
 
+# ======================
+# ثبت مسیریاب callbackها و دستورات متنی (بعد از تعریف همه هندلرها)
+# ======================
+callback_router.register(dp)
+text_commands.register(dp)
+
+
+# ======================
+# باطل کردن کش اعضا با تغییر عضویت
+# ======================
+@dp.chat_member_handler()
+async def chat_member_updated(update: types.ChatMemberUpdated):
+    chat_cache.on_member_update(update.chat.id, update.new_chat_member.user.id)
+    roster.on_member_update(update)
+    # اگر بازی فعالی هست، لیست مدیرانش هم تازه شود
+    session = get_session(update.chat.id)
+    if session and update.new_chat_member.status != update.old_chat_member.status:
+        try:
+            await update_group_admins(bot, session)
+        except Exception as e:
+            logging.warning("refresh admins failed: %s", e)
+
+
+@dp.my_chat_member_handler()
+async def my_chat_member_updated(update: types.ChatMemberUpdated):
+    chat_cache.forget_chat(update.chat.id)
+    if update.new_chat_member.status in ("left", "kicked"):
+        roster.forget_chat(update.chat.id)
+
+
+# ======================
+# بازیابی بازی‌ها بعد از ری‌استارت
+# ======================
+async def restore_session(session):
+    """پیام‌های لابی/بازی/نوبت یک بازی بازیابی‌شده را دوباره می‌سازد"""
+    await bot.send_message(session.chat_id, "♻️ ربات دوباره راه‌اندازی شد و بازی بازیابی شد.")
+    if session.game_running:
+        await render_game_message(session, edit=False)
+        turn = session.turn_state
+        if turn:
+            seat, ends_at, is_challenge = turn
+            remaining = int(ends_at - time.time())
+            if remaining > 0 and seat in session.player_slots:
+                await start_turn(session, seat, remaining, is_challenge)
+            else:
+                session.turn_state = None
+    elif session.lobby_active:
+        await update_lobby(session)
+
+
+def restore_sessions():
+    state_store.open()
+    for session in state_store.load_all():
+        sessions[session.chat_id] = session
+        set_max_seats_from_scenario(session, session.selected_scenario)
+        session_tasks.spawn(session.chat_id, restore_session(session))
+    logging.info("restored %d sessions from %s", len(sessions), state_store.path)
+    state_store.start(sessions)
+
+
 # ======================
 # استارتاپ
 # ======================
+async def start_services():
+    """راه‌اندازی مشترک polling و webhook (webhook.py)"""
+    restore_sessions()
+    # حذف پیام‌های موقتی که قبل از ری‌استارت زمان‌بندی شده بودند
+    temp_messages.start(bot)
+    roster.start()
+    scenarios.start()
+    update_pipeline.start(dp)
+
 async def on_startup(dp):
-    await bot.delete_webhook(drop_pending_updates=True)
+    # آپدیت‌های در انتظار نگه داشته می‌شوند و polling از آخرین update پردازش‌شده ادامه می‌دهد
+    await bot.delete_webhook()
     logging.info("Webhook deleted and ready for polling.")
+    await start_services()
+    await update_offsets.resume(bot)
+
+async def on_shutdown(dp):
+    # آپدیت‌های مانده در صف قبل از ذخیره offset پردازش می‌شوند
+    await update_pipeline.drain()
+    # آمار ویرایش‌های صرفه‌جویی شده
+    logging.info("edit cache: %s", edit_cache.stats())
+    logging.info("lobby renders: %s requested / %s sent", lobby_renderer.requested, lobby_renderer.rendered)
+    logging.info("outbound: %s", outbound.stats())
+    logging.info("background tasks: %s", session_tasks.stats())
+    logging.info("chat cache: %s", chat_cache.stats())
+    logging.info("callback timings: %s", callback_router.stats())
+    logging.info("text commands: %s", text_commands.stats())
+    logging.info("roster: %s", roster.stats())
+    logging.info("scenarios: %s", scenarios.stats())
+    logging.info("scenario picker: %s", scenario_picker.stats())
+    logging.info("update pipeline: %s", update_pipeline.stats())
+    logging.info("session locks: %s", session_locks.stats())
+    logging.info("state store: %s", state_store.stats())
+    await state_store.close()
+    roster.save()
+    temp_messages.save()
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    # chat_member به‌صورت پیش‌فرض ارسال نمی‌شود و باید صریحا خواسته شود
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown,
+                           allowed_updates=types.AllowedUpdates.all())
@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, NetworkError, RestartingTelegram
+
+# ======================
+# صف خروجی تلگرام (rate limit سراسری و به ازای هر چت)
+# ======================
+GLOBAL_RATE = 30          # پیام در ثانیه برای کل ربات
+GROUP_RATE = 20 / 60      # پیام در ثانیه برای هر گروه (~۲۰ در دقیقه)
+GROUP_BURST = 5
+PRIVATE_RATE = 1          # پیام در ثانیه برای هر پیوی
+PRIVATE_BURST = 3
+MAX_RETRIES = 3           # تلاش دوباره برای خطاهای گذرا (شبکه، ری‌استارت تلگرام)
+
+# ======================
+# اولویت‌ها: هر چت سه لاین دارد و همیشه اول لاین بالاتر خالی می‌شود
+# ======================
+CRITICAL = 0   # پخش نقش، اعلام نوبت، درخواست چالش
+NORMAL = 1     # پیام‌ها و ویرایش‌های معمولی
+LOW = 2        # بروزرسانی تایمر، پیام‌های موقت، حذف پیام
+LOW_MAX_AGE = 15          # ثانیه؛ کار LOW قدیمی‌تر از این بی‌ارزش است و دور ریخته می‌شود
+LOW_MAX_QUEUED = 10       # حداکثر کار LOW در صف هر چت
+MERGEABLE_METHODS = {"editMessageText", "editMessageReplyMarkup"}
+
+_priority = ContextVar("outbound_priority", default=None)
+
+
+@contextmanager
+def outbound_priority(level):
+    """
+    اولویت تماس‌های bot داخل این بلوک:
+        with outbound_priority(CRITICAL):
+            await bot.send_message(...)
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def default_priority(method):
+    return LOW if method in ("deleteMessage", "deleteMessages") else NORMAL
+
+
+class OutboundDropped(Exception):
+    """کار کم‌اولویتی که به خاطر ازدحام یا کهنگی ارسال نشد"""
+
+# فقط متدهایی که پیام می‌فرستند/تغییر می‌دهند از صف رد می‌شوند؛
+# getUpdates، answerCallbackQuery و متدهای خواندنی مستقیم اجرا می‌شوند
+THROTTLED_METHODS = {
+    "sendMessage", "editMessageText", "editMessageReplyMarkup", "deleteMessage", "deleteMessages",
+    "pinChatMessage", "unpinChatMessage", "sendPhoto", "sendDocument",
+    "sendAnimation", "sendSticker", "forwardMessage", "copyMessage",
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """یک توکن رزرو می‌کند و می‌گوید چند ثانیه باید صبر کرد تا مصرفش مجاز شود."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        """پس دادن توکن رزروشده‌ای که مصرف نشد"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class _Job:
+    __slots__ = ("call", "future", "waiters", "created", "attempts", "priority", "merge_key")
+
+    def __init__(self, call, priority=NORMAL, merge_key=None):
+        self.call = call                 # تابع بدون آرگومان که coroutine تماس API را برمی‌گرداند
+        self.future = asyncio.get_event_loop().create_future()
+        self.waiters = []                # future جدای صدا زننده‌هایی که در این کار ادغام شدند
+        self.created = time.monotonic()
+        self.attempts = 0
+        self.priority = priority
+        self.merge_key = merge_key       # برای ادغام ویرایش‌های LOW یک پیام
+
+    def abandoned(self):
+        """همه صدا زننده‌ها (اصلی و ادغام‌شده‌ها) منصرف شده‌اند"""
+        return self.future.done() and all(waiter.done() for waiter in self.waiters)
+
+    def settle(self, result=None, error=None):
+        for future in (self.future, *self.waiters):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class OutboundScheduler:
+    """
+    هر چت یک صف (سه لاین اولویت) و یک worker دارد؛ ترتیب پیام‌های هم‌اولویت حفظ می‌شود.
+    - ویرایش‌های LOW منتظر برای یک پیام با هم ادغام می‌شوند (فقط آخرین متن ارسال می‌شود)
+    - کارهای LOW کهنه یا اضافی اول از همه دور ریخته می‌شوند
+    - bucket سراسری (~۳۰/ثانیه) بین همه چت‌ها مشترک است
+    - bucket هر چت: گروه ~۲۰/دقیقه، پیوی ~۱/ثانیه
+    - RetryAfter فقط همان چت را متوقف می‌کند و پیام دوباره در صف می‌ماند
+    - خطاهای گذرا تا MAX_RETRIES بار با backoff تکرار می‌شوند
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._queues = {}         # {chat_id: [deque[_Job] برای هر اولویت]}
+        self._mergeable = {}      # {(chat_id, merge_key): _Job} ویرایش‌های LOW در انتظار
+        self._buckets = {}        # {chat_id: TokenBucket}
+        self._workers = {}        # {chat_id: asyncio.Task}
+        self._paused_until = {}   # {chat_id: monotonic}
+        self.on_retry_after = []  # callbackها: (chat_id, seconds)؛ مثلا عقب کشیدن تایمرها
+        self.on_request = []      # callbackها: (method, data) قبل از هر تماس bot؛ مثلا باطل کردن edit_cache
+        self.sent = 0
+        self.retried = 0
+        self.retry_after = 0
+        self.failed = 0
+        self.merged = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def submit(self, chat_id, call, priority=NORMAL, merge_key=None):
+        lanes = self._queues.get(chat_id)
+        if lanes is None:
+            lanes = self._queues[chat_id] = [deque(), deque(), deque()]
+
+        if priority == LOW and merge_key is not None:
+            pending = self._mergeable.get((chat_id, merge_key))
+            if pending is not None and not pending.abandoned():
+                # ویرایش قبلی هنوز ارسال نشده → فقط متن جدید را بفرست
+                # هر صدا زننده future خودش را دارد؛ لغو یکی بقیه را لغو نمی‌کند
+                pending.call = call
+                self.merged += 1
+                waiter = asyncio.get_event_loop().create_future()
+                pending.waiters.append(waiter)
+                return await waiter
+
+        job = _Job(call, priority, merge_key)
+        lane = lanes[priority]
+        lane.append(job)
+        if priority == LOW:
+            if merge_key is not None:
+                self._mergeable[(chat_id, merge_key)] = job
+            # سر صف ممکن است در حال ارسال باشد یا توکنش رزرو شده باشد؛ از بعد از آن دور ریخته می‌شود
+            while len(lane) > LOW_MAX_QUEUED:
+                self._drop(chat_id, lane[1])
+                del lane[1]
+
+        worker = self._workers.get(chat_id)
+        if worker is None or worker.done():
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        return await job.future
+
+    def _drop(self, chat_id, job):
+        self.dropped += 1
+        self._forget_merge(chat_id, job)
+        job.settle(error=OutboundDropped())
+
+    def _forget_merge(self, chat_id, job):
+        if job.merge_key is not None and self._mergeable.get((chat_id, job.merge_key)) is job:
+            del self._mergeable[(chat_id, job.merge_key)]
+
+    @staticmethod
+    def _remove(queue, job):
+        """کار تمام‌شده را با هویتش برمی‌دارد، نه هر چه الان سر صف است"""
+        if queue and queue[0] is job:
+            queue.popleft()
+        else:
+            try:
+                queue.remove(job)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _head(lanes):
+        for lane in lanes:
+            if lane:
+                return lane
+        return None
+
+    async def _worker(self, chat_id):
+        lanes = self._queues[chat_id]
+        prepaid = False   # توکن رزروشده‌ای که هنوز برای ارسالی مصرف نشده
+        try:
+            while True:
+                queue = self._head(lanes)
+                if queue is None:
+                    break
+                job = queue[0]
+                if job.abandoned():        # همه صدا زننده‌ها منصرف شده‌اند
+                    queue.popleft()
+                    self._forget_merge(chat_id, job)
+                    continue
+                if job.priority == LOW and time.monotonic() - job.created > LOW_MAX_AGE:
+                    queue.popleft()
+                    self._drop(chat_id, job)
+                    continue
+
+                pause = self._paused_until.get(chat_id, 0) - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+
+                if not prepaid:
+                    await asyncio.sleep(self._bucket(chat_id).reserve())
+                    await asyncio.sleep(self.global_bucket.reserve())
+                    prepaid = True
+                    # در حین انتظار ممکن است کار مهم‌تری رسیده باشد؛ همین توکن خرج آن می‌شود
+                    if self._head(lanes) is not queue:
+                        continue
+
+                # از اینجا به بعد کار در حال ارسال است و دیگر ادغام نمی‌شود
+                prepaid = False
+                self._forget_merge(chat_id, job)
+                job.attempts += 1
+                try:
+                    result = await job.call()
+                except RetryAfter as e:
+                    # فقط همین چت صبر می‌کند؛ پیام اول صف می‌ماند
+                    self.retry_after += 1
+                    self._paused_until[chat_id] = time.monotonic() + e.timeout
+                    logging.warning("outbound: RetryAfter %ss for chat %s", e.timeout, chat_id)
+                    for callback in self.on_retry_after:
+                        callback(chat_id, e.timeout)
+                    continue
+                except (NetworkError, RestartingTelegram, asyncio.TimeoutError) as e:
+                    if job.attempts < MAX_RETRIES:
+                        self.retried += 1
+                        await asyncio.sleep(0.5 * 2 ** job.attempts)
+                        continue
+                    self._remove(queue, job)
+                    self.failed += 1
+                    job.settle(error=e)
+                    continue
+                except Exception as e:
+                    self._remove(queue, job)
+                    job.settle(error=e)
+                    continue
+
+                self._remove(queue, job)
+                waited = time.monotonic() - job.created
+                self.sent += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+                job.settle(result)
+        finally:
+            if prepaid:
+                self._bucket(chat_id).refund()
+                self.global_bucket.refund()
+            if not any(lanes):
+                self._queues.pop(chat_id, None)
+            if self._workers.get(chat_id) is asyncio.current_task():
+                del self._workers[chat_id]
+
+    def paused_for(self, chat_id):
+        return max(0.0, self._paused_until.get(chat_id, 0) - time.monotonic())
+
+    def queue_depth(self, chat_id=None):
+        if chat_id is not None:
+            return sum(len(lane) for lane in self._queues.get(chat_id, ()))
+        return sum(len(lane) for lanes in self._queues.values() for lane in lanes)
+
+    def stats(self):
+        return {
+            "queued": self.queue_depth(),
+            "busy_chats": len(self._workers),
+            "sent": self.sent,
+            "retried": self.retried,
+            "retry_after": self.retry_after,
+            "failed": self.failed,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "avg_wait": round(self.total_wait / self.sent, 3) if self.sent else 0.0,
+            "max_wait": round(self.max_wait, 3),
+        }
+
+
+def is_group_chat(chat_id):
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return True  # @username کانال/گروه
+
+
+outbound = OutboundScheduler()
+
+
+class OutboundBot(Bot):
+    """
+    Bot که تماس‌های ارسال/ویرایش/حذف پیام را از OutboundScheduler عبور می‌دهد.
+    بقیه کد همان bot.send_message و ... را صدا می‌زند و تغییری نمی‌خواهد.
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        for callback in outbound.on_request:
+            callback(method, data)
+        chat_id = data.get("chat_id") if data else None
+        if method not in THROTTLED_METHODS or chat_id is None:
+            return await super().request(method, data, files, **kwargs)
+        priority = _priority.get()
+        if priority is None:
+            priority = default_priority(method)
+        merge_key = (method, data.get("message_id")) if method in MERGEABLE_METHODS else None
+        parent = super()
+        return await outbound.submit(chat_id, lambda: parent.request(method, data, files, **kwargs),
+                                     priority=priority, merge_key=merge_key)
@@ -0,0 +1,306 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp.helpers import sentinel
+from aiogram import Bot, Dispatcher, types
+
+# ======================
+# صف پردازش آپدیت‌ها: ترتیبی در هر چت، موازی بین چت‌ها
+# ======================
+UPDATE_LANES = int(os.getenv("UPDATE_LANES", "64"))
+LANE_QUEUE_SIZE = int(os.getenv("LANE_QUEUE_SIZE", "100"))
+DRAIN_TIMEOUT = 10       # ثانیه؛ در خاموش شدن برای تمام شدن آپدیت‌های صف صبر می‌شود
+SLOW_UPDATE = 5.0        # ثانیه؛ آپدیت کندتر از این لاگ می‌شود
+
+
+def chat_key(update: types.Update):
+    """
+    کلید ترتیب: chat_id برای همه آپدیت‌های یک گروه/پیوی.
+    آپدیت‌های بدون چت (inline و ...) بر اساس کاربر پخش می‌شوند.
+    """
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message:
+        return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    member = update.my_chat_member or update.chat_member or update.chat_join_request
+    if member:
+        return member.chat.id
+    for event in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                  update.pre_checkout_query, update.poll_answer):
+        if event:
+            return event.from_user.id if hasattr(event, "from_user") else event.user.id
+    return update.update_id
+
+
+class _Lane:
+    __slots__ = ("queue", "intake", "submitting", "task", "processed", "blocked", "blocked_time", "rejected",
+                 "max_depth", "busy_time")
+
+    def __init__(self, size):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.intake = asyncio.Lock()   # ترتیب submitهای منتظر همین lane حفظ شود
+        self.submitting = 0            # submitهای در جریان (منتظر Lock یا جای خالی)
+        self.task = None
+        self.processed = 0
+        self.blocked = 0          # تعداد submitهایی که به خاطر پر بودن صف منتظر ماندند
+        self.blocked_time = 0.0
+        self.rejected = 0         # offer روی صف پر (webhook → 503)
+        self.max_depth = 0
+        self.busy_time = 0.0
+
+
+class UpdatePipeline:
+    """
+    هر آپدیت با hash(chat_id) به یکی از laneها می‌رود و هر lane یک worker دارد.
+    - آپدیت‌های یک چت دقیقا به ترتیب رسیدن و یکی‌یکی اجرا می‌شوند؛ مثلا دو کلیک هم‌زمان
+      روی صندلی‌ها دیگر نمی‌توانند هر دو «صندلی خالی است» را ببینند.
+    - چت‌های مختلف موازی اجرا می‌شوند و یک گروه شلوغ فقط lane خودش را کند می‌کند.
+    - صف هر lane محدود است: submit (polling) صبر می‌کند و offer (webhook) رد می‌کند.
+      PipelineDispatcher تا جا باز نشود getUpdates بعدی را نمی‌زند.
+    - laneها آپدیت‌ها را خارج از ترتیب تمام می‌کنند، پس offset امن watermark() است:
+      بزرگ‌ترین update_id که خودش و همه قبلی‌هایش تمام شده‌اند. هم SessionStore همین را ذخیره می‌کند
+      و هم getUpdates فقط تا همین‌جا را به تلگرام تایید می‌کند.
+    """
+
+    def __init__(self, lanes=UPDATE_LANES, lane_size=LANE_QUEUE_SIZE):
+        self.lane_size = max(1, lane_size)
+        self._lanes = [_Lane(self.lane_size) for _ in range(max(1, lanes))]
+        self.dp = None
+        self._pending = []     # heap از update_idهای در صف یا در حال اجرا
+        self._finished = set() # تمام‌شده‌هایی که هنوز از heap بیرون نیامده‌اند
+        self._highest = None   # بزرگ‌ترین update_id دریافت‌شده
+        self._progress = asyncio.Event()   # بعد از تمام شدن هر آپدیت set می‌شود
+        self.failed = 0
+        self.slow = 0
+
+    @property
+    def running(self):
+        return self.dp is not None
+
+    def lane_of(self, update: types.Update) -> _Lane:
+        return self._lanes[hash(chat_key(update)) % len(self._lanes)]
+
+    # ---------- ورودی ----------
+    async def submit(self, update: types.Update):
+        """برای polling: اگر صف lane پر باشد تا خالی شدن جا صبر می‌کند"""
+        lane = self.lane_of(update)
+        self._track(update.update_id)
+        lane.submitting += 1
+        try:
+            async with lane.intake:
+                if lane.queue.full():
+                    lane.blocked += 1
+                    started = time.monotonic()
+                    await lane.queue.put(update)
+                    lane.blocked_time += time.monotonic() - started
+                else:
+                    lane.queue.put_nowait(update)
+        finally:
+            lane.submitting -= 1
+        lane.max_depth = max(lane.max_depth, lane.queue.qsize())
+
+    async def submit_many(self, updates):
+        """یک دسته از getUpdates؛ lane پر فقط آپدیت‌های همان lane را معطل می‌کند"""
+        waiting = []
+        for update in updates:
+            lane = self.lane_of(update)
+            if lane.queue.full() or lane.submitting or waiting:
+                # از اینجا به بعد هم‌زمان؛ Lock هر lane ترتیب را نگه می‌دارد
+                waiting.append(self.submit(update))
+            else:
+                self._track(update.update_id)
+                lane.queue.put_nowait(update)
+                lane.max_depth = max(lane.max_depth, lane.queue.qsize())
+        if waiting:
+            await asyncio.gather(*waiting)
+
+    def offer(self, update: types.Update) -> bool:
+        """برای webhook: اگر صف lane پر باشد False (تلگرام بعدا دوباره می‌فرستد)"""
+        lane = self.lane_of(update)
+        try:
+            lane.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            lane.rejected += 1
+            return False
+        self._track(update.update_id)
+        lane.max_depth = max(lane.max_depth, lane.queue.qsize())
+        return True
+
+    # ---------- workerها ----------
+    def start(self, dp: Dispatcher):
+        self.dp = dp
+        for lane in self._lanes:
+            if lane.task is None or lane.task.done():
+                lane.task = asyncio.create_task(self._work(lane))
+
+    async def _work(self, lane: _Lane):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            update = await lane.queue.get()
+            started = time.monotonic()
+            try:
+                # updates_handler همان مسیر polling است؛ middlewareهای update هم اجرا می‌شوند
+                await self.dp.updates_handler.notify(update)
+            except Exception:
+                self.failed += 1
+                logging.exception("pipeline: update %s failed", update.update_id)
+            finally:
+                elapsed = time.monotonic() - started
+                lane.busy_time += elapsed
+                lane.processed += 1
+                self._finished.add(update.update_id)
+                self._progress.set()
+                lane.queue.task_done()
+            if elapsed > SLOW_UPDATE:
+                self.slow += 1
+                logging.warning("pipeline: update %s (chat %s) took %.1fs", update.update_id, chat_key(update), elapsed)
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        """در on_shutdown: صبر برای آپدیت‌های صف و سپس توقف workerها"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(lane.queue.join() for lane in self._lanes)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("pipeline: %d updates left in queue", self.queued())
+        for lane in self._lanes:
+            if lane.task is not None:
+                lane.task.cancel()
+                lane.task = None
+        self.dp = None
+
+    # ---------- offset ----------
+    def _track(self, update_id):
+        heapq.heappush(self._pending, update_id)
+        if self._highest is None or update_id > self._highest:
+            self._highest = update_id
+
+    def seen(self, update_id):
+        """این آپدیت قبلا گرفته شده (در صف، در حال اجرا یا تمام‌شده)"""
+        return self._highest is not None and update_id <= self._highest
+
+    async def wait_progress(self, watermark):
+        """تا جلو رفتن watermark از مقدار داده‌شده صبر می‌کند"""
+        while self.watermark() == watermark:
+            self._progress.clear()
+            await self._progress.wait()
+
+    def watermark(self):
+        """
+        offset امن برای ذخیره: کوچک‌ترین آپدیت تمام‌نشده منهای یک.
+        None یعنی از start تا حالا آپدیتی نیامده.
+        """
+        pending, finished = self._pending, self._finished
+        while pending and pending[0] in finished:
+            finished.discard(heapq.heappop(pending))
+        if pending:
+            return pending[0] - 1
+        return self._highest
+
+    # ---------- آمار ----------
+    def queued(self):
+        return sum(lane.queue.qsize() for lane in self._lanes)
+
+    def stats(self):
+        busiest = max(self._lanes, key=lambda lane: lane.busy_time)
+        return {
+            "lanes": len(self._lanes),
+            "queued": self.queued(),
+            "max_depth": max(lane.max_depth for lane in self._lanes),
+            "processed": sum(lane.processed for lane in self._lanes),
+            "failed": self.failed,
+            "slow": self.slow,
+            "blocked": sum(lane.blocked for lane in self._lanes),
+            "blocked_seconds": round(sum(lane.blocked_time for lane in self._lanes), 2),
+            "rejected": sum(lane.rejected for lane in self._lanes),
+            "busiest_lane_seconds": round(busiest.busy_time, 2),
+        }
+
+
+class PipelineDispatcher(Dispatcher):
+    """
+    Dispatcher که آپدیت‌های polling را به جای gather هم‌زمان به UpdatePipeline می‌دهد.
+    تا قبل از start شدن pipeline (یا بعد از drain) رفتار همان Dispatcher عادی است.
+
+    start_polling خود aiogram هر دسته را با create_task رها می‌کند و offset را فورا جلو می‌برد،
+    پس نه lane پر جلوی getUpdates را می‌گیرد و نه آپدیت در صف بعد از crash دوباره می‌آید.
+    اینجا polling خودمان است:
+    - دسته بعدی فقط بعد از جا گرفتن دسته قبلی در laneها گرفته می‌شود؛ یک lane پر کل دریافت را
+      نگه می‌دارد و تعداد آپدیت‌های در راه حداکثر ظرفیت laneها به‌علاوه یک دسته است.
+    - offset = watermark + 1؛ تلگرام آپدیت‌های تمام‌نشده را نگه می‌دارد و دوباره می‌فرستد.
+      آن‌هایی که قبلا گرفته شده‌اند (seen) دوباره اجرا نمی‌شوند.
+    """
+
+    def __init__(self, *args, pipeline: UpdatePipeline, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pipeline = pipeline
+
+    async def process_updates(self, updates, fast: bool = True):
+        if not self.pipeline.running:
+            return await super().process_updates(updates, fast)
+        await self.pipeline.submit_many(updates)
+        return []
+
+    async def start_polling(self, timeout=20, relax=0.1, limit=None, reset_webhook=None, fast: bool = True,
+                            error_sleep: int = 5, allowed_updates=None):
+        if not self.pipeline.running:
+            return await super().start_polling(timeout, relax, limit, reset_webhook, fast, error_sleep,
+                                               allowed_updates)
+        if self._polling:
+            raise RuntimeError("Polling already started")
+
+        logging.info("Start polling (update pipeline).")
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        try:
+            request_timeout = None
+            if self.bot.timeout is not sentinel and timeout is not None:
+                request_timeout = aiohttp.ClientTimeout(total=self.bot.timeout.total + timeout or 1)
+
+            while self._polling:
+                watermark = self.pipeline.watermark()
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(
+                            limit=limit,
+                            offset=None if watermark is None else watermark + 1,
+                            timeout=timeout,
+                            allowed_updates=allowed_updates,
+                        )
+                except asyncio.CancelledError:
+                    break
+                except Exception:
+                    logging.exception("pipeline: getUpdates failed")
+                    await asyncio.sleep(error_sleep)
+                    continue
+
+                fresh = [update for update in updates if not self.pipeline.seen(update.update_id)]
+                if fresh:
+                    # تا این دسته در laneها جا نگیرد getUpdates بعدی زده نمی‌شود
+                    await self.pipeline.submit_many(fresh)
+                elif updates:
+                    # همه هنوز در laneها هستند؛ تا جلو رفتن watermark دوباره گرفته نشوند
+                    await self.pipeline.wait_progress(watermark)
+
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            logging.warning("Polling is stopped.")
+
+
+update_pipeline = UpdatePipeline()
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from aiogram.utils.exceptions import MessageNotModified
+
+# ======================
+# رندر تجمیعی (debounce) پیام‌ها
+# ======================
+LOBBY_RENDER_DELAY = 0.7  # ثانیه؛ تغییرات داخل این بازه در یک ویرایش ادغام می‌شوند
+
+
+class RenderScheduler:
+    """
+    زمان‌بند رندر به ازای هر پیام (key).
+    - چند درخواست پشت سر هم داخل بازه delay فقط یک رندر می‌سازند
+    - رندر همیشه وضعیت لحظه‌ی اجرا را می‌خواند، پس آخرین وضعیت نمایش داده می‌شود
+    - برای هر key حداکثر یک رندر در حال اجراست؛ اگر وسط رندر تغییری بیاید،
+      بعد از تمام شدن آن یک رندر دیگر اجرا می‌شود
+    """
+
+    def __init__(self, delay: float = LOBBY_RENDER_DELAY):
+        self.delay = delay
+        self._tasks = {}    # {key: asyncio.Task}
+        self._dirty = set()
+        self.requested = 0  # تعداد درخواست‌ها
+        self.rendered = 0   # تعداد رندرهای واقعی
+
+    def schedule(self, key, render):
+        """
+        render: تابع بدون آرگومان که یک coroutine برمی‌گرداند (مثلا lambda: _render_lobby(session))
+        """
+        self.requested += 1
+        self._dirty.add(key)
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            self._tasks[key] = asyncio.create_task(self._run(key, render))
+
+    async def _run(self, key, render):
+        try:
+            while key in self._dirty:
+                await asyncio.sleep(self.delay)
+                self._dirty.discard(key)
+                try:
+                    await render()
+                    self.rendered += 1
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.warning("render %s failed: %s", key, e)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+    def cancel(self, key):
+        """لغو رندر در انتظار (مثلا وقتی بازی بسته می‌شود)"""
+        self._dirty.discard(key)
+        task = self._tasks.pop(key, None)
+        if task and not task.done():
+            task.cancel()
+
+    def cancel_chat(self, chat_id):
+        """لغو همه رندرهای یک گروه؛ keyها به شکل (chat_id, ...) هستند"""
+        for key in [k for k in self._tasks if isinstance(k, tuple) and k[0] == chat_id]:
+            self.cancel(key)
+
+
+lobby_renderer = RenderScheduler()
+
+# متدهایی که محتوای پیام را عوض می‌کنند؛ اگر از مسیر edit_cache نیامده باشند digest پیام پاک می‌شود
+MESSAGE_CHANGING_METHODS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+                            "editMessageMedia", "deleteMessage"}
+_cached_edit = ContextVar("cached_edit", default=False)
+
+
+# ======================
+# کش ویرایش پیام‌ها
+# ======================
+class EditCache:
+    """
+    digest آخرین متن و کیبوردی که با موفقیت روی هر پیام نشسته را نگه می‌دارد
+    تا ویرایش‌های بدون تغییر اصلا به API تلگرام نرسند.
+    key = (chat_id, message_id)
+    """
+
+    def __init__(self, max_size: int = 2048):
+        self.max_size = max_size
+        self._digests = OrderedDict()
+        self._epoch = 0  # با هر ویرایش مستقیم زیاد می‌شود؛ ویرایشی که هم‌زمان با آن بوده remember نمی‌شود
+        self.hits = 0    # ویرایش‌های حذف شده (بدون تماس API)
+        self.misses = 0  # ویرایش‌هایی که واقعا ارسال شدند
+
+    @staticmethod
+    def digest(text, reply_markup=None):
+        h = hashlib.blake2b(str(text).encode("utf-8"), digest_size=16)
+        if reply_markup is not None:
+            markup = reply_markup.to_python() if hasattr(reply_markup, "to_python") else reply_markup
+            h.update(json.dumps(markup, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return h.digest()
+
+    def is_current(self, chat_id, message_id, digest):
+        return self._digests.get((chat_id, message_id)) == digest
+
+    def remember(self, chat_id, message_id, digest):
+        key = (chat_id, message_id)
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while len(self._digests) > self.max_size:
+            self._digests.popitem(last=False)
+
+    def forget(self, chat_id, message_id=None):
+        """حذف یک پیام یا (بدون message_id) همه پیام‌های یک گروه"""
+        if message_id is not None:
+            self._digests.pop((chat_id, message_id), None)
+            return
+        for key in [k for k in self._digests if k[0] == chat_id]:
+            del self._digests[key]
+
+    async def edit_text(self, bot, text, chat_id, message_id, reply_markup=None, parse_mode="HTML"):
+        """
+        مثل bot.edit_message_text ولی اگر متن و کیبورد تغییری نکرده باشد تماسی نمی‌گیرد.
+        MessageNotModified را قورت می‌دهد؛ بقیه خطاها digest را پاک و دوباره raise می‌کنند.
+        """
+        digest = self.digest(text, reply_markup)
+        if self.is_current(chat_id, message_id, digest):
+            self.hits += 1
+            return False
+        self.misses += 1
+        epoch = self._epoch
+        token = _cached_edit.set(True)
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                        parse_mode=parse_mode, reply_markup=reply_markup)
+        except MessageNotModified:
+            pass
+        except Exception:
+            self.forget(chat_id, message_id)
+            raise
+        finally:
+            _cached_edit.reset(token)
+        if epoch == self._epoch:
+            self.remember(chat_id, message_id, digest)
+        return True
+
+    def note_request(self, method, data):
+        """
+        هوک OutboundBot: هر ویرایش/حذفی که از edit_text نیامده (callback.message.edit_text و ...)
+        digest آن پیام را باطل می‌کند تا ویرایش بعدی edit_cache به اشتباه hit نشود.
+        """
+        if method not in MESSAGE_CHANGING_METHODS or _cached_edit.get() or not data:
+            return
+        try:
+            key = (int(data["chat_id"]), int(data["message_id"]))
+        except (KeyError, TypeError, ValueError):
+            return
+        self._epoch += 1
+        self.forget(*key)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "size": len(self._digests),
+        }
+
+
+edit_cache = EditCache()
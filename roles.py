@@ -0,0 +1,93 @@
+from array import array
+
+# ======================
+# جدول نقش‌ها (id عددی برای هر نام نقش)
+# ======================
+CITIZEN, MAFIA, INDEPENDENT = 0, 1, 2
+FACTION_NAMES = ("شهروند", "مافیا", "مستقل")
+
+# نقش‌هایی که در جدول نیستند شهروند حساب می‌شوند؛
+# هر سناریو می‌تواند در scenarios.json با "factions": {"نقش": "مافیا"} این را عوض کند
+MAFIA_ROLES = {
+    "مافیا", "پدرخوانده", "ماتادور", "گودمن", "رئیس مافیا", "دن مافیا", "ناتاشا", "نوفیس",
+    "جاسوس", "آل کاپون", "شعبده باز", "بمب گذار", "جادوگر", "جلاد", "شاهکش", "تروریست",
+}
+INDEPENDENT_ROLES = {"نوستراداموس", "جک گنجیشکه", "شرلوک", "زودیاک", "قمار باز"}
+
+FILLER_ROLE = "شهروند"   # وقتی بازیکن بیشتر از نقش‌های سناریو است
+
+
+def base_role(name: str) -> str:
+    """«پابلو اسکوبار(پدرخوانده)» → «پدرخوانده»"""
+    if name.endswith(")") and "(" in name:
+        return name[name.rindex("(") + 1:-1].strip()
+    return name
+
+
+def default_faction(name: str) -> int:
+    base = base_role(name)
+    if base in MAFIA_ROLES:
+        return MAFIA
+    if base in INDEPENDENT_ROLES:
+        return INDEPENDENT
+    return CITIZEN
+
+
+class RoleTable:
+    """
+    هر نام نقش یک بار ذخیره می‌شود و یک id کوچک (ترتیبی) می‌گیرد.
+    سناریوها، پخش نقش و last_role_map فقط id نگه می‌دارند و نام موقع نمایش گرفته می‌شود.
+    idها به ترتیب intern بستگی دارند و پایدار نیستند؛ storage نقش‌ها را با نام ذخیره می‌کند.
+    """
+
+    def __init__(self):
+        self._names = []           # [name]  (اندیس = id)
+        self._factions = array("B")
+        self._ids = {}             # {name: id}
+
+    def intern(self, name: str) -> int:
+        rid = self._ids.get(name)
+        if rid is None:
+            rid = len(self._names)
+            self._names.append(name)
+            self._factions.append(default_faction(name))
+            self._ids[name] = rid
+        return rid
+
+    def name(self, rid) -> str:
+        if rid is None or not 0 <= rid < len(self._names):
+            return "❓"
+        return self._names[rid]
+
+    def faction(self, rid) -> int:
+        return self._factions[rid]
+
+    def compile(self, roles, overrides=None):
+        """
+        لیست نام نقش‌ها → (آرایه id نقش‌ها، تعداد هر جبهه).
+        overrides: {نام نقش: نام جبهه} از فایل سناریو
+        """
+        ids = array("H", (self.intern(name) for name in roles))
+        counts = [0] * len(FACTION_NAMES)
+        for faction in self.factions(ids, overrides):
+            counts[faction] += 1
+        return ids, tuple(counts)
+
+    def factions(self, ids, overrides=None):
+        """جبهه هر id (با در نظر گرفتن overrides سناریو) → array("B")"""
+        faction_of = {}
+        for name, faction in (overrides or {}).items():
+            if faction in FACTION_NAMES:
+                faction_of[self.intern(name)] = FACTION_NAMES.index(faction)
+        return array("B", (faction_of.get(rid, self._factions[rid]) for rid in ids))
+
+    def __len__(self):
+        return len(self._names)
+
+
+role_table = RoleTable()
+FILLER_ROLE_ID = role_table.intern(FILLER_ROLE)
+
+
+def role_name(rid) -> str:
+    return role_table.name(rid)
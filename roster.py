@@ -0,0 +1,145 @@
+import asyncio
+import html
+import json
+import logging
+import os
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# ======================
+# فهرست اعضای هر گروه (برای تگ همه)
+# ======================
+ROSTER_FILE = os.getenv("ROSTER_FILE", "roster.json")
+ROSTER_SAVE_INTERVAL = 60     # ثانیه؛ فاصله ذخیره تغییرات در فایل
+MAX_NAME_LENGTH = 32          # نام‌ها کوتاه نگه‌داری می‌شوند
+MENTIONS_PER_MESSAGE = 5      # تلگرام فقط به چند منشن اول هر پیام اعلان می‌دهد
+MAX_MESSAGE_LENGTH = 4096
+LEFT_STATUSES = ("left", "kicked")
+
+
+class GroupRoster:
+    """
+    اعضایی که ربات در هر گروه دیده است: {chat_id: {user_id: name}}.
+    تلگرام لیست کامل اعضا را به ربات نمی‌دهد، پس فهرست از روی پیام‌ها،
+    ورود/خروج و آپدیت‌های chat_member به‌تدریج ساخته می‌شود.
+    تغییرات هر ROSTER_SAVE_INTERVAL ثانیه (و هنگام خاموش شدن) در فایل ذخیره می‌شوند.
+    """
+
+    def __init__(self, path=ROSTER_FILE):
+        self.path = path
+        self._chats = {}     # {chat_id: {user_id: name}}
+        self._dirty = False
+        self._saver = None
+
+    # ---------- راه‌اندازی ----------
+    def start(self):
+        """در on_startup صدا زده می‌شود"""
+        self._chats = self._load()
+        if self._saver is None or self._saver.done():
+            self._saver = asyncio.create_task(self._autosave())
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            return {int(c): {int(u): n for u, n in members.items()} for c, members in raw.items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning("roster: could not load %s: %s", self.path, e)
+            return {}
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._chats, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except Exception as e:
+            logging.warning("roster: could not save %s: %s", self.path, e)
+
+    async def _autosave(self):
+        while True:
+            await asyncio.sleep(ROSTER_SAVE_INTERVAL)
+            self.save()
+
+    # ---------- بروزرسانی ----------
+    def seen(self, chat_id, user: types.User):
+        if user is None or user.is_bot:
+            return
+        name = (user.full_name or str(user.id))[:MAX_NAME_LENGTH]
+        members = self._chats.setdefault(chat_id, {})
+        if members.get(user.id) != name:
+            members[user.id] = name
+            self._dirty = True
+
+    def left(self, chat_id, user_id):
+        members = self._chats.get(chat_id)
+        if members and members.pop(user_id, None) is not None:
+            self._dirty = True
+
+    def on_message(self, message: types.Message):
+        if message.chat.type not in ("group", "supergroup"):
+            return
+        chat_id = message.chat.id
+        if message.left_chat_member:
+            self.left(chat_id, message.left_chat_member.id)
+        for user in message.new_chat_members or ():
+            self.seen(chat_id, user)
+        if message.from_user and not message.left_chat_member:
+            self.seen(chat_id, message.from_user)
+
+    def on_member_update(self, update: types.ChatMemberUpdated):
+        member = update.new_chat_member
+        if member.status in LEFT_STATUSES:
+            self.left(update.chat.id, member.user.id)
+        else:
+            self.seen(update.chat.id, member.user)
+
+    def forget_chat(self, chat_id):
+        if self._chats.pop(chat_id, None) is not None:
+            self._dirty = True
+
+    # ---------- خواندن ----------
+    def members(self, chat_id):
+        return self._chats.get(chat_id, {})
+
+    def stats(self):
+        return {"chats": len(self._chats), "members": sum(len(m) for m in self._chats.values())}
+
+
+class RosterMiddleware(BaseMiddleware):
+    """هر پیامی که به ربات می‌رسد، قبل از هندلرها roster را بروز می‌کند"""
+
+    def __init__(self, roster: GroupRoster):
+        super().__init__()
+        self.roster = roster
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self.roster.on_message(message)
+
+
+def mention_chunks(members, header="", per_message=MENTIONS_PER_MESSAGE, max_length=MAX_MESSAGE_LENGTH):
+    """
+    members: [(user_id, name)] → متن پیام‌ها؛ هر پیام حداکثر per_message منشن
+    و حداکثر max_length کاراکتر (طول HTML، که همیشه از متن نهایی بلندتر است).
+    """
+    chunks = []
+    parts, length = [], len(header)
+    for uid, name in members:
+        mention = f"<a href='tg://user?id={uid}'>{html.escape(name)}</a>"
+        if parts and (len(parts) >= per_message or length + 1 + len(mention) > max_length):
+            chunks.append(header + " ".join(parts))
+            parts, length = [], len(header)
+        parts.append(mention)
+        length += len(mention) + 1
+    if parts:
+        chunks.append(header + " ".join(parts))
+    return chunks
+
+
+roster = GroupRoster()
@@ -0,0 +1,177 @@
+import inspect
+import logging
+import time
+
+from aiogram import Dispatcher, types
+
+from codec import MARKER, InvalidCallback, callback_codec
+
+# ======================
+# مسیریابی callbackها
+# ======================
+class CallbackRouter:
+    """
+    یک هندلر واحد برای همه callback_queryها.
+    - دکمه‌های ثابت (data == "...") در یک dict با O(1) پیدا می‌شوند
+    - دکمه‌های پیشوندی (data.startswith("...")) با طولانی‌ترین پیشوند منطبق
+      پیدا می‌شوند، پس "challenge_request_" دیگر زیر "challenge_" گم نمی‌شود
+    - ثبت تکراری یک action موقع بالا آمدن ربات خطا می‌دهد
+    - زمان اجرای هر action ثبت می‌شود (stats)
+    پارامترها بر اساس نام تزریق می‌شوند (نه تعدادشان):
+        async def h(callback, args)              # args پارس‌شده
+        async def h(callback, state: FSMContext) # FSMContext همان کاربر در همان چت
+    """
+
+    def __init__(self, separator="_", codec=None):
+        self.separator = separator
+        self.codec = codec    # برای callback_dataهای کدشده (codec.CallbackCodec)
+        self._exact = {}      # {data: handler}
+        self._prefix = {}     # {prefix: handler}
+        self._timings = {}    # {action: [count, total, max]}
+        self._params = {}     # {handler: (آیا args می‌گیرد، آیا state می‌گیرد)}
+        self._encoded = set() # actionهای codec؛ data خام با این نام‌ها نمی‌آید
+        self.unrouted = 0
+        self.rejected = 0
+
+    # ---------- ثبت ----------
+    def exact(self, *names):
+        """@router.exact("start_turn")"""
+        def decorator(handler):
+            for name in names:
+                self._register(self._exact, name, handler)
+            return handler
+        return decorator
+
+    def encoded(self, *names):
+        """
+        @router.encoded("do_replace") → برای دکمه‌هایی که با codec ساخته می‌شوند؛
+        handler(callback, args) آرگومان‌های عددی decodeشده را می‌گیرد.
+        """
+        def decorator(handler):
+            for name in names:
+                self.codec.action(name)
+                self._encoded.add(name)
+                self._register(self._exact, name, handler)
+            return handler
+        return decorator
+
+    def prefix(self, *prefixes):
+        """@router.prefix("slot_") → handler برای slot_1، slot_2، ..."""
+        def decorator(handler):
+            for prefix in prefixes:
+                self._register(self._prefix, prefix, handler)
+            return handler
+        return decorator
+
+    def _register(self, table, key, handler):
+        if key in table:
+            raise ValueError(
+                f"callback «{key}» دو بار ثبت شده: {table[key].__name__} و {handler.__name__}"
+            )
+        table[key] = handler
+        params = inspect.signature(handler).parameters
+        self._params[handler] = ("args" in params, "state" in params)
+
+    # ---------- بررسی ----------
+    def check(self):
+        """
+        گزارش همپوشانی‌ها: دکمه ثابتی که پیشوند هم دارد یا پیشوندی که داخل پیشوند کوتاه‌تری است.
+        ترتیب ثبت دیگر مهم نیست (ثابت و بعد طولانی‌ترین پیشوند برنده است) ولی لاگ می‌شود تا دیده شود.
+        """
+        overlaps = []
+        for name in self._exact:
+            if name in self._encoded:
+                continue
+            prefix = self._longest_prefix(name)
+            if prefix is not None:
+                overlaps.append((name, prefix))
+        for prefix in self._prefix:
+            shorter = self._longest_prefix(prefix, end=len(prefix) - 1)
+            if shorter is not None:
+                overlaps.append((prefix, shorter))
+        for longer, shorter in overlaps:
+            logging.info("callback router: «%s» overrides prefix «%s»", longer, shorter)
+        return overlaps
+
+    # ---------- پیدا کردن ----------
+    def _longest_prefix(self, data, end=None):
+        # فقط مرزهای separator بررسی می‌شوند: برای "a_b_3" → "a_b_" و بعد "a_"
+        end = len(data) if end is None else end
+        while True:
+            cut = data.rfind(self.separator, 0, end)
+            if cut < 0:
+                return None
+            candidate = data[:cut + 1]
+            if candidate in self._prefix:
+                return candidate
+            end = cut
+
+    def resolve(self, data):
+        """
+        (action, args, handler) — args بخش بعد از پیشوند، جدا شده با separator.
+        داده‌ی کدشده (شروع با MARKER) یک‌جا decode و با نام action در جدول ثابت پیدا می‌شود.
+        """
+        if self.codec is not None and data.startswith(MARKER):
+            action, args = self.codec.decode(data)
+            return action, args, self._exact.get(action)
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, (), handler
+        prefix = self._longest_prefix(data)
+        if prefix is None:
+            return None, (), None
+        rest = data[len(prefix):]
+        return prefix, tuple(rest.split(self.separator)) if rest else (), self._prefix[prefix]
+
+    # ---------- اجرا ----------
+    async def dispatch(self, callback: types.CallbackQuery):
+        try:
+            action, args, handler = self.resolve(callback.data or "")
+        except InvalidCallback as e:
+            return await self._reject(callback, e)
+        if handler is None:
+            self.unrouted += 1
+            logging.warning("callback router: no handler for %r", callback.data)
+            await callback.answer()
+            return
+        started = time.perf_counter()
+        try:
+            with_args, with_state = self._params[handler]
+            kwargs = {}
+            if with_args:
+                kwargs["args"] = args
+            if with_state:
+                chat = callback.message.chat.id if callback.message else None
+                kwargs["state"] = Dispatcher.get_current().current_state(chat=chat, user=callback.from_user.id)
+            return await handler(callback, **kwargs)
+        except InvalidCallback as e:
+            # id داخل دکمه دیگر معتبر نیست (مثلا scenario_ids.lookup بعد از ری‌استارت یا حذف سناریو)
+            return await self._reject(callback, e)
+        finally:
+            elapsed = time.perf_counter() - started
+            timing = self._timings.get(action)
+            if timing is None:
+                self._timings[action] = [1, elapsed, elapsed]
+            else:
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    async def _reject(self, callback, error):
+        self.rejected += 1
+        logging.warning("callback router: rejected %r (%s)", callback.data, error)
+        await callback.answer("⚠️ این دکمه نامعتبر یا قدیمی است.", show_alert=True)
+
+    def register(self, dp):
+        """ثبت router به عنوان تنها هندلر callback_query در dispatcher"""
+        self.check()
+        dp.register_callback_query_handler(self.dispatch)
+
+    def stats(self):
+        return {
+            action: {"count": c, "avg_ms": round(total / c * 1000, 2), "max_ms": round(mx * 1000, 2)}
+            for action, (c, total, mx) in sorted(self._timings.items())
+        }
+
+
+callback_router = CallbackRouter(codec=callback_codec)
@@ -0,0 +1,100 @@
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from codec import callback_codec, scenario_ids
+
+# ======================
+# کیبورد صفحه‌بندی‌شده انتخاب/حذف سناریو
+# ======================
+PAGE_SIZE = 8
+
+PICK, DELETE = 0, 1   # حالت کیبورد (داخل callback_data کد می‌شود)
+
+
+class ScenarioPicker:
+    """
+    صفحه‌های کیبورد سناریوها یک بار برای هر نسخه از کاتالوگ ساخته و کش می‌شوند.
+    با تغییر ScenarioStore (افزودن/حذف/ویرایش فایل) version عوض و کش خالی می‌شود.
+    players > 0 فقط سناریوهایی را نشان می‌دهد که برای آن تعداد بازیکن مناسب‌اند.
+    """
+
+    def __init__(self, store, page_size=PAGE_SIZE):
+        self.store = store
+        self.page_size = page_size
+        self._version = None
+        self._names = {}   # {players: [name]}
+        self._pages = {}   # {(mode, page, players, suggest): (markup, page, pages)}
+        self.hits = 0
+        self.builds = 0
+
+    def _sync(self):
+        if self._version != self.store.version:
+            self._version = self.store.version
+            self._names.clear()
+            self._pages.clear()
+
+    def names(self, players=0):
+        self._sync()
+        names = self._names.get(players)
+        if names is None:
+            names = []
+            for name in self.store:
+                summary = self.store.summary(name)
+                if not players or summary.min_players <= players <= summary.seats:
+                    names.append(name)
+            self._names[players] = names
+        return names
+
+    def keyboard(self, mode, page=0, players=0, suggest=0):
+        """
+        (markup، شماره صفحه واقعی، تعداد صفحه‌ها)
+        suggest: تعداد بازیکنان فعلی لابی؛ دکمه «فقط مناسب N نفر» را اضافه می‌کند
+        """
+        self._sync()
+        names = self.names(players)
+        pages = max(1, -(-len(names) // self.page_size))
+        page = min(max(page, 0), pages - 1)
+        key = (mode, page, players, suggest)
+        cached = self._pages.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.builds += 1
+        kb = InlineKeyboardMarkup(row_width=3)
+        for name in names[page * self.page_size:(page + 1) * self.page_size]:
+            sid = scenario_ids.intern(name)
+            if mode == DELETE:
+                kb.row(InlineKeyboardButton(f"❌ {name}", callback_data=callback_codec.encode("delete_scen", sid)))
+            else:
+                seats = self.store.summary(name).seats
+                kb.row(InlineKeyboardButton(f"{name} ({seats})", callback_data=callback_codec.encode("scenario", sid)))
+
+        if pages > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀️", callback_data=self._page_data(mode, page - 1, players, suggest)))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+            if page < pages - 1:
+                nav.append(InlineKeyboardButton("▶️", callback_data=self._page_data(mode, page + 1, players, suggest)))
+            kb.row(*nav)
+
+        if suggest:
+            if players:
+                kb.row(InlineKeyboardButton("📚 همه سناریوها", callback_data=self._page_data(mode, 0, 0, suggest)))
+            else:
+                kb.row(InlineKeyboardButton(f"👥 فقط مناسب {suggest} نفر",
+                                            callback_data=self._page_data(mode, 0, suggest, suggest)))
+
+        if mode == DELETE:
+            kb.row(InlineKeyboardButton("⬅ بازگشت", callback_data="manage_scenarios"))
+
+        result = (kb, page, pages)
+        self._pages[key] = result
+        return result
+
+    @staticmethod
+    def _page_data(mode, page, players, suggest):
+        return callback_codec.encode("scen_page", mode, page, players, suggest)
+
+    def stats(self):
+        return {"version": self._version, "cached_pages": len(self._pages), "builds": self.builds, "hits": self.hits}
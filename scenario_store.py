@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, namedtuple
+
+from roles import role_table
+
+# ======================
+# ذخیره و بارگذاری سناریوها
+# ======================
+SCENARIOS_FILE = os.getenv("SCENARIOS_FILE", "scenarios.json")
+RELOAD_CHECK_INTERVAL = 5     # ثانیه؛ فاصله بررسی تغییر فایل (ویرایش دستی)
+
+DEFAULT_SCENARIOS = {
+    "سناریو کلاسیک": {"min_players": 5, "max_players": 10, "roles": ["مافیا", "مافیا", "شهروند", "شهروند", "شهروند"]},
+    "سناریو ویژه": {"min_players": 6, "max_players": 12, "roles": ["مافیا", "مافیا", "شهروند", "شهروند", "شهروند", "کارآگاه"]}
+}
+
+# خلاصه‌ی کامپایل‌شده هر سناریو:
+# role_ids آرایه id نقش‌ها (roles.role_table)، role_counts {id: تعداد}،
+# faction_counts تعداد (شهروند، مافیا، مستقل)
+ScenarioSummary = namedtuple("ScenarioSummary", "seats min_players role_ids role_counts faction_counts")
+
+
+def summarize(data) -> ScenarioSummary:
+    role_ids, faction_counts = role_table.compile(data.get("roles", ()), data.get("factions"))
+    return ScenarioSummary(
+        seats=len(role_ids),
+        min_players=data.get("min_players", len(role_ids)),
+        role_ids=role_ids,
+        role_counts=Counter(role_ids),
+        faction_counts=faction_counts,
+    )
+
+
+class ScenarioStore:
+    """
+    سناریوها در حافظه: store[name] همان dict فایل است و store.summary(name) خلاصه‌ی آماده.
+    - نوشتن خارج از event loop و اتمیک (فایل موقت + fsync + os.replace)
+    - اگر فایل از بیرون عوض شود (mtime)، دوباره بارگذاری می‌شود
+    - listeners بعد از هر بارگذاری/تغییر با لیست نام‌ها صدا زده می‌شوند
+    """
+
+    def __init__(self, path=SCENARIOS_FILE):
+        self.path = path
+        self._data = {}
+        self._summaries = {}
+        self._mtime = None
+        self._lock = asyncio.Lock()
+        self._watcher = None
+        self.listeners = []
+        self.version = 0      # با هر تغییر کاتالوگ یکی زیاد می‌شود (برای کش‌ها)
+        self.reloads = 0
+        self.writes = 0
+
+    # ---------- خواندن (مثل dict) ----------
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, name, default=None):
+        return self._data.get(name, default)
+
+    def items(self):
+        return self._data.items()
+
+    def summary(self, name) -> ScenarioSummary:
+        return self._summaries[name]
+
+    def seats(self, name) -> int:
+        return self._summaries[name].seats
+
+    # ---------- بارگذاری ----------
+    def load(self):
+        """بارگذاری همزمان؛ فقط موقع بالا آمدن ربات (قبل از event loop)"""
+        try:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = dict(DEFAULT_SCENARIOS)
+        self._replace(data)
+
+    def _replace(self, data):
+        self._data = data
+        self._summaries = {name: summarize(scen) for name, scen in data.items()}
+        self._notify()
+
+    def _notify(self):
+        self.version += 1
+        for listener in self.listeners:
+            listener(list(self._data))
+
+    def start(self):
+        """در on_startup صدا زده می‌شود؛ تغییرات دستی فایل را دنبال می‌کند"""
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(RELOAD_CHECK_INTERVAL)
+            try:
+                await self.reload_if_changed()
+            except Exception as e:
+                logging.warning("scenarios: reload of %s failed: %s", self.path, e)
+
+    async def reload_if_changed(self):
+        async with self._lock:
+            try:
+                mtime = (await asyncio.to_thread(os.stat, self.path)).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime == self._mtime:
+                return False
+            data = await asyncio.to_thread(self._read)
+            self._mtime = mtime
+            self._replace(data)
+            self.reloads += 1
+            logging.info("scenarios: reloaded %s (%d scenarios)", self.path, len(data))
+            return True
+
+    def _read(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    # ---------- نوشتن ----------
+    async def put(self, name, roles, min_players):
+        async with self._lock:
+            self._data[name] = {
+                "roles": list(roles),
+                "min_players": min_players,
+                "max_players": len(roles),
+            }
+            self._summaries[name] = summarize(self._data[name])
+            await self._save()
+        self._notify()
+
+    async def remove(self, name):
+        async with self._lock:
+            if self._data.pop(name, None) is None:
+                return False
+            self._summaries.pop(name, None)
+            await self._save()
+        self._notify()
+        return True
+
+    async def _save(self):
+        # snapshot در همین thread گرفته می‌شود تا تغییرات بعدی وسط نوشتن اثر نگذارند
+        payload = json.dumps(self._data, ensure_ascii=False, indent=2)
+        self._mtime = await asyncio.to_thread(self._write, payload)
+        self.writes += 1
+
+    def _write(self, payload):
+        started = time.perf_counter()
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        logging.debug("scenarios: saved in %.1f ms", (time.perf_counter() - started) * 1000)
+        return os.stat(self.path).st_mtime_ns
+
+    def stats(self):
+        return {"scenarios": len(self._data), "reloads": self.reloads, "writes": self.writes}
+
+
+scenario_store = ScenarioStore()
@@ -0,0 +1,114 @@
+# ======================
+# نقشه صندلی‌ها (صندلی ⇄ بازیکن)
+# ======================
+class SeatMap:
+    """
+    نگهداری هم‌زمان دو نگاشت seat -> user_id و user_id -> seat.
+    هر بازیکن حداکثر یک صندلی و هر صندلی حداکثر یک بازیکن دارد و
+    همه عملیات (پیدا کردن، نشستن، جابجایی، آزاد کردن) O(1) هستند.
+    رابط خواندنی آن مثل dict قدیمی player_slots است.
+    """
+
+    __slots__ = ("_by_seat", "_by_user")
+
+    def __init__(self, slots=None):
+        self._by_seat = {}
+        self._by_user = {}
+        if slots:
+            for seat, uid in slots.items():
+                self[seat] = uid
+
+    # ---------- خواندن (مثل dict) ----------
+    def __getitem__(self, seat):
+        return self._by_seat[seat]
+
+    def __contains__(self, seat):
+        return seat in self._by_seat
+
+    def __len__(self):
+        return len(self._by_seat)
+
+    def __iter__(self):
+        return iter(self._by_seat)
+
+    def __bool__(self):
+        return bool(self._by_seat)
+
+    def __repr__(self):
+        return f"SeatMap({self._by_seat!r})"
+
+    def get(self, seat, default=None):
+        return self._by_seat.get(seat, default)
+
+    def keys(self):
+        return self._by_seat.keys()
+
+    def values(self):
+        return self._by_seat.values()
+
+    def items(self):
+        return self._by_seat.items()
+
+    def seat_of(self, user_id):
+        """صندلی بازیکن یا None"""
+        return self._by_user.get(user_id)
+
+    def has_player(self, user_id):
+        return user_id in self._by_user
+
+    # ---------- نوشتن ----------
+    def __setitem__(self, seat, user_id):
+        """
+        نشاندن بازیکن روی صندلی. صندلی قبلی بازیکن آزاد می‌شود و
+        اگر کسی روی این صندلی بود، از نقشه بیرون می‌رود.
+        """
+        old_seat = self._by_user.pop(user_id, None)
+        if old_seat is not None:
+            del self._by_seat[old_seat]
+        old_uid = self._by_seat.get(seat)
+        if old_uid is not None:
+            del self._by_user[old_uid]
+        self._by_seat[seat] = user_id
+        self._by_user[user_id] = seat
+
+    def __delitem__(self, seat):
+        uid = self._by_seat.pop(seat)
+        del self._by_user[uid]
+
+    def pop(self, seat, *default):
+        if seat not in self._by_seat:
+            if default:
+                return default[0]
+            raise KeyError(seat)
+        uid = self._by_seat.pop(seat)
+        del self._by_user[uid]
+        return uid
+
+    def free_player(self, user_id):
+        """آزاد کردن صندلی یک بازیکن؛ شماره صندلی آزاد شده یا None"""
+        seat = self._by_user.pop(user_id, None)
+        if seat is not None:
+            del self._by_seat[seat]
+        return seat
+
+    def move(self, user_id, seat):
+        """انتقال بازیکن به صندلی خالی دیگر؛ اگر صندلی پر باشد False"""
+        if seat in self._by_seat and self._by_seat[seat] != user_id:
+            return False
+        self[seat] = user_id
+        return True
+
+    def swap(self, seat_a, seat_b):
+        """جابجایی بازیکن‌های دو صندلی (صندلی خالی هم مجاز است)"""
+        uid_a = self._by_seat.pop(seat_a, None)
+        uid_b = self._by_seat.pop(seat_b, None)
+        if uid_a is not None:
+            self._by_seat[seat_b] = uid_a
+            self._by_user[uid_a] = seat_b
+        if uid_b is not None:
+            self._by_seat[seat_a] = uid_b
+            self._by_user[uid_b] = seat_a
+
+    def clear(self):
+        self._by_seat.clear()
+        self._by_user.clear()
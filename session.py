@@ -0,0 +1,135 @@
+from seats import SeatMap
+from timers import turn_timers
+from tasks import session_tasks
+
+# ======================
+# وضعیت هر بازی (به ازای هر گروه)
+# ======================
+DEFAULT_TURN_DURATION = 120  # مقدار پیش‌فرض نوبت اصلی (در صورت تمایل تغییر بده)
+
+# chat_id بازی‌هایی که از آخرین ذخیره شاید عوض شده‌اند (storage.SessionStore فقط این‌ها را سریالایز می‌کند).
+# با مقداردهی هر فیلد (__setattr__) و با mark_dirty بعد از تغییر درجا علامت می‌خورد؛ خواندن علامت نمی‌زند.
+dirty_sessions = set()
+
+
+class GameSession:
+    """
+    تمام وضعیت یک لابی/بازی در یک گروه.
+    هر گروه یک GameSession جدا دارد تا یک پروسه بتواند چند بازی هم‌زمان را اجرا کند.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.players = {}                # بازیکنان: {user_id: name}
+        self.moderator_id = None         # آیدی گرداننده
+        self.selected_scenario = None    # سناریوی انتخابی
+        self.game_message_id = None
+        self.lobby_message_id = None     # پیام لابی
+        self.admins = set()
+        self.game_running = False        # وقتی بازی واقعاً شروع شده است (نقش‌ها ارسال شدند)
+        self.lobby_active = False        # وقتی لابی فعال است (انتخاب سناریو و گرداننده)
+        self.round_active = False
+        self.turn_order = []             # ترتیب نوبت‌ها
+        self.current_turn_index = 0      # اندیس نوبت فعلی
+        self.current_turn_message_id = None  # پیام پین شده برای نوبت
+        self.turn_timer = None           # تایمر نوبت (timers.Timer)
+        self.turn_state = None           # (صندلی، پایان نوبت با time.time، چالش؟) برای بازیابی بعد از ری‌استارت
+        self.current_head_seat = None
+        self.current_speaker = None
+        self.player_slots = SeatMap()    # صندلی ⇄ بازیکن (seats.SeatMap)
+        self.challenge_requests = {}
+        self.pending_challenges = {}
+        self.active_challenger_seats = set()
+        self.challenge_mode = False      # آیا الان در حالت نوبت چالش هستیم؟
+        self.paused_main_player = None   # اگر چالش "قبل" ثبت شد، اینجا id نوبت اصلی ذخیره می‌شود تا بعد از چالش resume شود
+        self.paused_main_duration = None # (اختیاری) مدت زمان نوبت اصلی برای resume — معمولا 120
+        self.challenges = {}             # {player_id: {"type": "before"/"after", "challenger": user_id}}
+        self.challenge_active = True
+        self.post_challenge_advance = False  # وقتی اجرای چالش 'بعد' باشه، بعد از چالش به نوبت بعدی می‌رویم
+        self.substitute_list = {}        # {user_id: {"id": user_id, "name": name}}
+        self.removed_players = {}        # {seat_number: {"id": user_id, "name": name}}
+        self.last_role_map = {}          # {user_id: role}
+        self.max_seats = 0               # تعداد صندلی‌ها، بعد از انتخاب سناریو مقداردهی میشه
+        self.waiting_message_id = None
+        self.waiting_list = []           # لیست انتظار جایگزین
+        self.extra_turns = []            # لیست بازیکن‌هایی که باید بعد از پایان دور یک ترن اضافه بگیرن
+
+    # =======================
+    # داده های ریست در شروع روز
+    # =======================
+    def reset_round(self):
+        self.current_turn_index = 0
+        self.turn_order = []
+        self.challenge_requests = {}
+        self.active_challenger_seats = set()
+        self.paused_main_player = None
+        self.paused_main_duration = None
+        self.post_challenge_advance = False
+        self.pending_challenges = {}
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # تغییرهای تایمر و تسک‌های پس‌زمینه که session را مستقیم نگه داشته‌اند
+        dirty_sessions.add(self.chat_id)
+
+    def mark_dirty(self):
+        """برای تغییرهای درجا (dict/list/set) که از __setattr__ رد نمی‌شوند"""
+        dirty_sessions.add(self.chat_id)
+
+    def cancel_timer(self):
+        # تایمر نوبت این گروه در زمان‌بند مرکزی
+        turn_timers.cancel(self.chat_id)
+        self.turn_timer = None
+        self.turn_state = None
+
+    def is_manager(self, user_id: int) -> bool:
+        """گرداننده یا یکی از مدیران گروه"""
+        return user_id == self.moderator_id or user_id in self.admins
+
+
+# ======================
+# رجیستری بازی‌ها: {chat_id: GameSession}
+# ======================
+sessions = {}
+
+
+def get_session(chat_id: int):
+    return sessions.get(chat_id)
+
+
+def open_session(chat_id: int) -> GameSession:
+    """بازی گروه را برمی‌گرداند و اگر وجود نداشت یکی می‌سازد."""
+    session = sessions.get(chat_id)
+    if session is None:
+        session = sessions[chat_id] = GameSession(chat_id)
+    return session
+
+
+def close_session(chat_id: int):
+    session = sessions.pop(chat_id, None)
+    if session:
+        session.cancel_timer()
+    # تسک‌های پس‌زمینه‌ی این بازی هم لغو می‌شوند
+    session_tasks.cancel(chat_id)
+    return session
+
+
+def find_session_for_manager(user_id: int):
+    """
+    برای دکمه‌های پیوی: آخرین بازی‌ای که کاربر در آن گرداننده یا مدیر است.
+    گرداننده بودن بر مدیر بودن اولویت دارد.
+    """
+    fallback = None
+    for session in reversed(list(sessions.values())):
+        if session.moderator_id == user_id:
+            return session
+        if fallback is None and user_id in session.admins:
+            fallback = session
+    return fallback
+
+
+def find_session_for_player(user_id: int):
+    for session in reversed(list(sessions.values())):
+        if user_id in session.players:
+            return session
+    return None
@@ -0,0 +1,254 @@
+"""
+شبیه‌ساز مونت‌کارلو برای بررسی تعادل سناریوها.
+
+    python simulate.py                          # همه سناریوهای scenarios.json
+    python simulate.py زودیاک کاپو -n 2000000   # فقط چند سناریو
+    python simulate.py --players 10 --seed 1
+
+ابزار آفلاین است و numpy فقط برای آن لازم است: pip install -r requirements-sim.txt
+
+هر دسته از بازی‌ها (batch) با آرایه‌های NumPy و بدون حلقه روی تک‌تک بازی‌ها اجرا می‌شود؛
+فقط روی شب/روزها حلقه داریم. مدل ساده است و برای مقایسه سناریوها با هم ساخته شده،
+نه پیش‌بینی دقیق بازی واقعی.
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+from roles import role_table, base_role, MAFIA, FILLER_ROLE_ID
+from scenario_store import ScenarioStore, SCENARIOS_FILE
+
+# ======================
+# توانایی‌های مدل‌شده (بر اساس نام پایه نقش)
+# ======================
+DOCTOR = 1        # هر شب یک نفر را نجات می‌دهد
+DETECTIVE = 2     # هر شب یک نفر را استعلام می‌کند؛ مافیای پیدا شده روز بعد بیرون می‌رود
+SNIPER = 4        # یک تیر در کل بازی؛ اگر شهروند بزند خودش می‌میرد
+ARMORED = 8       # شلیک شب اول به او اثر نمی‌کند
+KILLER = 16       # مستقل قاتل؛ هر شب یک نفر را می‌کشد
+HIDDEN = 32       # استعلامش منفی است (پدرخوانده)
+
+ABILITIES = {
+    "دکتر": DOCTOR, "دکتر واتسون": DOCTOR, "دکتر بریجیت": DOCTOR, "پزشک": DOCTOR,
+    "کاراگاه": DETECTIVE, "کارآگاه": DETECTIVE, "شرلوک": DETECTIVE,
+    "اسنایپر": SNIPER, "لئون": SNIPER, "حرفه ای": SNIPER, "حرفه‌ای": SNIPER,
+    "روئین تن": ARMORED, "زره ساز": ARMORED,
+    "زودیاک": KILLER,
+    "پدرخوانده": HIDDEN, "رئیس مافیا": HIDDEN, "دن مافیا": HIDDEN, "آل کاپون": HIDDEN,
+}
+
+SNIPER_SHOT_CHANCE = 0.35   # احتمال شلیک تک‌تیرانداز در هر شب
+DEFAULT_GAMES = 1_000_000
+DEFAULT_BATCH = 100_000
+Z_95 = 1.959964
+
+TOWN_WIN, MAFIA_WIN, INDEPENDENT_WIN, DRAW = 0, 1, 2, 3
+
+
+def role_layout(summary, data, players):
+    """نقش‌های یک بازی n نفره دقیقا مثل distribute_roles: n نقش اول سناریو + شهروند اضافه"""
+    ids = list(summary.role_ids[:players])
+    ids += [FILLER_ROLE_ID] * (players - len(ids))
+    factions = np.array(role_table.factions(ids, data.get("factions")), dtype=np.int8)
+    abilities = np.array([ABILITIES.get(base_role(role_table.name(rid)), 0) for rid in ids], dtype=np.int8)
+    return factions, abilities
+
+
+# ======================
+# انتخاب تصادفی برداری
+# ======================
+def pick(rng, mask):
+    """
+    برای هر سطر یک ستون تصادفی از بین ستون‌هایی که mask آن‌ها True است.
+    خروجی: (اندیس، آیا انتخابی وجود داشت)
+    """
+    keys = rng.random(mask.shape)
+    keys[~mask] = -1.0
+    choice = keys.argmax(axis=1)
+    return choice, mask.any(axis=1)
+
+
+def kill(alive, rows, seats):
+    alive[rows, seats[rows]] = False
+
+
+def simulate_batch(rng, factions, abilities, games):
+    """
+    games بازی با چیدمان یکسان نقش ولی ترتیب تصادفی.
+    خروجی: (آرایه برنده هر بازی، تعداد دور هر بازی)
+    """
+    players = len(factions)
+    rows = np.arange(games)
+    # هر بازی چیدمان خودش را دارد (جایگشت تصادفی صندلی‌ها)
+    order = rng.random((games, players)).argsort(axis=1)
+    faction = factions[order]
+    ability = abilities[order]
+
+    alive = np.ones((games, players), dtype=bool)
+    is_mafia = faction == MAFIA
+    killer = (ability & KILLER) != 0
+    armor = (ability & ARMORED) != 0
+    bullet = (ability & SNIPER) != 0
+    checked = np.zeros((games, players), dtype=bool)
+    suspect = np.full(games, -1)
+    winner = np.full(games, DRAW, dtype=np.int8)
+    rounds = np.zeros(games, dtype=np.int16)
+    active = np.ones(games, dtype=bool)
+
+    def settle():
+        mafia_alive = (alive & is_mafia).sum(axis=1)
+        killer_alive = (alive & killer).any(axis=1)
+        others = alive.sum(axis=1) - mafia_alive
+        town = active & (mafia_alive == 0) & ~killer_alive
+        indep = active & killer_alive & (alive.sum(axis=1) <= 2) & (mafia_alive == 0)
+        mafia = active & ~killer_alive & (mafia_alive > 0) & (mafia_alive >= others)
+        winner[town] = TOWN_WIN
+        winner[indep] = INDEPENDENT_WIN
+        winner[mafia] = MAFIA_WIN
+        active[town | indep | mafia] = False
+
+    for _ in range(players):
+        if not active.any():
+            break
+        rounds[active] += 1
+        live = alive & active[:, None]
+
+        # ---------- شب ----------
+        mafia_up = (live & is_mafia).any(axis=1)
+        shot, has_shot = pick(rng, live & ~is_mafia)
+        has_shot &= mafia_up
+
+        killer_up = (live & killer).any(axis=1)
+        stab, has_stab = pick(rng, live & ~killer)
+        has_stab &= killer_up
+
+        doctor_up = (live & ((ability & DOCTOR) != 0)).any(axis=1)
+        save, _ = pick(rng, live)
+        saved = doctor_up
+
+        # شلیک مافیا: نجات دکتر یا زره جلویش را می‌گیرد
+        blocked = saved & (save == shot)
+        shielded = armor[rows, shot]
+        armor[rows[has_shot & shielded & ~blocked], shot[has_shot & shielded & ~blocked]] = False
+        victims = has_shot & ~blocked & ~shielded
+
+        stab_blocked = saved & (save == stab)
+        stab_victims = has_stab & ~stab_blocked
+
+        # تک‌تیرانداز
+        sniper_ready = live & bullet
+        sniper_up = sniper_ready.any(axis=1) & (rng.random(games) < SNIPER_SHOT_CHANCE)
+        sniper = sniper_ready.argmax(axis=1)
+        snipe_mask = live.copy()
+        snipe_mask[rows, sniper] = False
+        snipe, has_snipe = pick(rng, snipe_mask)
+        has_snipe &= sniper_up
+        bullet[rows[has_snipe], sniper[has_snipe]] = False
+        hit_bad = is_mafia[rows, snipe] | killer[rows, snipe]
+        snipe_kills = has_snipe & hit_bad
+        sniper_dies = has_snipe & ~hit_bad
+
+        # استعلام کارآگاه
+        detective_up = (live & ((ability & DETECTIVE) != 0)).any(axis=1)
+        probe, has_probe = pick(rng, live & ~checked & ((ability & DETECTIVE) == 0))
+        has_probe &= detective_up
+        checked[rows[has_probe], probe[has_probe]] = True
+        found = has_probe & is_mafia[rows, probe] & ((ability[rows, probe] & HIDDEN) == 0)
+        suspect[found & (suspect < 0)] = probe[found & (suspect < 0)]
+
+        kill(alive, rows[victims], shot)
+        kill(alive, rows[stab_victims], stab)
+        kill(alive, rows[snipe_kills], snipe)
+        kill(alive, rows[sniper_dies], sniper)
+        settle()
+
+        # ---------- روز (رای‌گیری) ----------
+        live = alive & active[:, None]
+        vote, has_vote = pick(rng, live)
+        known = has_vote & (suspect >= 0)
+        known &= alive[rows, np.where(suspect >= 0, suspect, 0)]
+        vote[known] = suspect[known]
+        suspect[known] = -1
+        kill(alive, rows[has_vote], vote)
+        settle()
+
+    return winner, rounds
+
+
+def wilson(successes, total, z=Z_95):
+    """فاصله اطمینان ویلسون برای نسبت"""
+    if total == 0:
+        return 0.0, 0.0
+    p = successes / total
+    denom = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denom
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denom
+    return center - half, center + half
+
+
+def run(store, names, games, batch, seed, only_players=None):
+    rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+    total = 0
+    results = []
+    for name in names:
+        summary = store.summary(name)
+        data = store[name]
+        counts = range(max(1, summary.min_players), max(summary.seats, summary.min_players) + 1)
+        if only_players:
+            counts = [n for n in counts if n == only_players] or [only_players]
+        for players in counts:
+            factions, abilities = role_layout(summary, data, players)
+            wins = np.zeros(4, dtype=np.int64)
+            rounds_sum = 0
+            done = 0
+            while done < games:
+                size = min(batch, games - done)
+                winner, rounds = simulate_batch(rng, factions, abilities, size)
+                wins += np.bincount(winner, minlength=4)
+                rounds_sum += int(rounds.sum())
+                done += size
+            total += done
+            results.append((name, players, done, wins, rounds_sum / done))
+    return results, total, time.perf_counter() - started
+
+
+def print_report(results, total, elapsed):
+    header = f"{'سناریو':<22}{'نفر':>4}{'بازی':>10}  {'شهر':>18}  {'مافیا':>18}  {'مستقل':>18}  {'دور':>5}"
+    print(header)
+    print("-" * len(header))
+    for name, players, games, wins, avg_rounds in results:
+        cells = []
+        for outcome in (TOWN_WIN, MAFIA_WIN, INDEPENDENT_WIN):
+            low, high = wilson(int(wins[outcome]), games)
+            cells.append(f"{wins[outcome] / games * 100:6.2f}% ±{(high - low) / 2 * 100:5.2f}")
+        print(f"{name:<22}{players:>4}{games:>10}  " + "  ".join(f"{c:>18}" for c in cells) + f"  {avg_rounds:5.2f}")
+    rate = total / elapsed * 60 if elapsed else 0
+    print(f"\n{total:,} بازی در {elapsed:.1f} ثانیه (~{rate:,.0f} بازی در دقیقه)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="شبیه‌سازی تعادل سناریوهای مافیا")
+    parser.add_argument("scenarios", nargs="*", help="نام سناریوها (پیش‌فرض: همه)")
+    parser.add_argument("-f", "--file", default=SCENARIOS_FILE, help="فایل سناریوها")
+    parser.add_argument("-n", "--games", type=int, default=DEFAULT_GAMES, help="تعداد بازی برای هر سناریو و تعداد نفر")
+    parser.add_argument("-b", "--batch", type=int, default=DEFAULT_BATCH, help="تعداد بازی در هر دسته NumPy")
+    parser.add_argument("-p", "--players", type=int, help="فقط همین تعداد بازیکن")
+    parser.add_argument("--seed", type=int, help="seed برای تکرارپذیری")
+    args = parser.parse_args(argv)
+
+    store = ScenarioStore(args.file)
+    store.load()
+    names = args.scenarios or list(store)
+    unknown = [name for name in names if name not in store]
+    if unknown:
+        parser.error("سناریوی ناشناخته: " + "، ".join(unknown))
+
+    results, total, elapsed = run(store, names, args.games, args.batch, args.seed, args.players)
+    print_report(results, total, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from roles import role_name, role_table
+from seats import SeatMap
+from session import GameSession, dirty_sessions
+
+# ======================
+# ذخیره‌ی دائمی وضعیت بازی‌ها (SQLite در حالت WAL)
+# ======================
+STATE_DB = os.getenv("STATE_DB", "mafia_state.db")
+FLUSH_INTERVAL = 1.0            # ثانیه؛ تغییرات هر بازه در یک تراکنش نوشته می‌شوند
+FULL_SWEEP_INTERVAL = 30.0      # ثانیه؛ احتیاطا همه بازی‌ها (نه فقط dirty) مقایسه می‌شوند
+TRANSIENT_FIELDS = {"turn_timer"}   # قابل ذخیره نیستند و بعد از ری‌استارت دوباره ساخته می‌شوند
+# id نقش به ترتیب intern بستگی دارد و بعد از ری‌استارت (یا تغییر scenarios.json) عوض می‌شود؛
+# این فیلدها با نام نقش ذخیره و موقع بارگذاری دوباره intern می‌شوند
+ROLE_MAP_FIELDS = {"last_role_map"}
+# آپدیت‌های عقب‌افتاده (رسیده در زمان خاموشی) قدیمی‌تر از این (ثانیه) اجرا نمی‌شوند؛ 0 یعنی همه اجرا شوند
+UPDATE_MAX_AGE = int(os.getenv("UPDATE_MAX_AGE", "60"))
+
+
+# ---------- تبدیل وضعیت به JSON ----------
+def _encode(value):
+    # JSON کلید عددی و set ندارد؛ این‌ها با یک برچسب نگه‌داری می‌شوند
+    if isinstance(value, SeatMap):
+        return {"__seats__": [[seat, uid] for seat, uid in value.items()]}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": [_encode(v) for v in value]}
+    if isinstance(value, dict):
+        return {"__dict__": [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        if "__seats__" in value:
+            return SeatMap({seat: uid for seat, uid in value["__seats__"]})
+        if "__set__" in value:
+            return {_decode(v) for v in value["__set__"]}
+        if "__dict__" in value:
+            return {_decode_key(k): _decode(v) for k, v in value["__dict__"]}
+    return value
+
+
+def _decode_key(key):
+    # کلیدهای چندتایی به صورت list ذخیره شده‌اند
+    return tuple(_decode_key(k) for k in key) if isinstance(key, list) else key
+
+
+def _role_names(role_map):
+    return {uid: role_name(rid) for uid, rid in role_map.items()}
+
+
+def _role_ids(role_map):
+    # ردیف‌های قدیمی id خام دارند که دیگر معنی ندارد؛ کنار گذاشته می‌شوند
+    return {uid: role_table.intern(name) for uid, name in role_map.items() if isinstance(name, str)}
+
+
+def dump_session(session: GameSession) -> str:
+    state = {}
+    for key, value in vars(session).items():
+        if key in TRANSIENT_FIELDS:
+            continue
+        if key in ROLE_MAP_FIELDS:
+            value = _role_names(value)
+        state[key] = _encode(value)
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_session(chat_id: int, payload: str) -> GameSession:
+    session = GameSession(chat_id)
+    for key, value in json.loads(payload).items():
+        # فیلدهای حذف‌شده از نسخه‌های قبلی نادیده گرفته می‌شوند
+        if hasattr(session, key) and key not in TRANSIENT_FIELDS:
+            value = _decode(value)
+            if key in ROLE_MAP_FIELDS:
+                value = _role_ids(value)
+            setattr(session, key, value)
+    session.chat_id = chat_id
+    return session
+
+
+class SessionStore:
+    """
+    وضعیت هر GameSession یک ردیف JSON در SQLite است.
+    به جای صدا زدن save در صدها جای کد، هر FLUSH_INTERVAL ثانیه فقط از بازی‌هایی که
+    session.dirty_sessions علامت زده snapshot گرفته می‌شود و آن‌هایی که واقعا عوض شده‌اند
+    (یا بسته شده‌اند) در یک تراکنش نوشته/حذف می‌شوند. هر FULL_SWEEP_INTERVAL ثانیه یک بار
+    همه بازی‌ها مقایسه می‌شوند تا تغییری که علامت نخورده گم نشود.
+    خود نوشتن در thread جدا انجام می‌شود تا event loop معطل نشود.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._conn = None
+        self._registry = None
+        self._written = {}     # {chat_id: آخرین payload نوشته‌شده}
+        self.update_offset = None      # آخرین update_id پردازش‌شده
+        self.offset_saved_at = None    # زمان (time.time) آخرین ذخیره offset
+        self._offset_written = None
+        # اگر آپدیت‌ها خارج از ترتیب تمام شوند (UpdatePipeline) offset از اینجا خوانده می‌شود
+        self.offset_source = None      # callable → update_id یا None
+        self._lock = asyncio.Lock()
+        self._runner = None
+        self._writing = None   # نوشتن در thread؛ با cancel شدن flush متوقف نمی‌شود
+        self._swept_at = 0.0
+        self.commits = 0
+        self.serialized = 0
+        self.rows_written = 0
+
+    # ---------- راه‌اندازی ----------
+    def open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")   # در WAL فقط checkpoint را fsync می‌کند
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " chat_id INTEGER PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        if "update_offset" in meta:
+            self.update_offset = self._offset_written = int(meta["update_offset"])
+            self.offset_saved_at = float(meta.get("offset_saved_at", 0))
+
+    def load_all(self):
+        """همه بازی‌های ذخیره‌شده؛ یک بار موقع بالا آمدن ربات"""
+        restored = []
+        for chat_id, payload in self._conn.execute("SELECT chat_id, state FROM sessions"):
+            try:
+                restored.append(load_session(chat_id, payload))
+                self._written[chat_id] = payload
+            except Exception as e:
+                logging.warning("storage: could not restore session %s: %s", chat_id, e)
+        return restored
+
+    def start(self, registry):
+        """registry: همان dict بازی‌ها (session.sessions)"""
+        self._registry = registry
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.warning("storage: flush failed: %s", e)
+
+    def note_update(self, update_id):
+        if self.update_offset is None or update_id > self.update_offset:
+            self.update_offset = update_id
+
+    def current_offset(self):
+        """
+        offset قابل ذخیره. با offset_source (watermark صف آپدیت‌ها) آپدیت‌هایی که هنوز در lane کندتری
+        منتظرند زیر offset نمی‌افتند و بعد از crash دوباره از تلگرام گرفته می‌شوند.
+        """
+        if self.offset_source is not None:
+            offset = self.offset_source()
+            if offset is not None:
+                return offset
+            # از شروع ربات آپدیتی نیامده؛ همان offset ذخیره‌شده
+            return self._offset_written
+        return self.update_offset
+
+    # ---------- نوشتن ----------
+    def _changes(self, full=False):
+        now = time.monotonic()
+        if full or now - self._swept_at >= FULL_SWEEP_INTERVAL:
+            self._swept_at = now
+            candidates = list(self._registry)
+        else:
+            candidates = list(dirty_sessions)
+        dirty_sessions.clear()
+        changed = []
+        for chat_id in candidates:
+            session = self._registry.get(chat_id)
+            if session is None:
+                continue
+            payload = dump_session(session)
+            self.serialized += 1
+            if self._written.get(chat_id) != payload:
+                changed.append((chat_id, payload))
+        removed = [chat_id for chat_id in self._written if chat_id not in self._registry]
+        return changed, removed
+
+    async def flush(self):
+        if self._conn is None or self._registry is None:
+            return
+        async with self._lock:
+            changed, removed = self._changes()
+            offset = self.current_offset()
+            if not changed and not removed and offset == self._offset_written:
+                return
+            self._writing = asyncio.ensure_future(asyncio.to_thread(self._commit, changed, removed, offset))
+            try:
+                await asyncio.shield(self._writing)
+            except Exception:
+                # دفعه بعد دوباره امتحان می‌شوند
+                dirty_sessions.update(chat_id for chat_id, _ in changed)
+                raise
+            self._remember(changed, removed, offset)
+
+    def _remember(self, changed, removed, offset):
+        self._offset_written = offset
+        for chat_id, payload in changed:
+            self._written[chat_id] = payload
+        for chat_id in removed:
+            self._written.pop(chat_id, None)
+
+    def _commit(self, changed, removed, offset):
+        now = time.time()
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO sessions (chat_id, state, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                [(chat_id, payload, now) for chat_id, payload in changed],
+            )
+            conn.executemany("DELETE FROM sessions WHERE chat_id = ?", [(chat_id,) for chat_id in removed])
+            if offset is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("update_offset", str(offset)), ("offset_saved_at", repr(now))],
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.commits += 1
+        self.rows_written += len(changed)
+
+    async def close(self):
+        """در on_shutdown: آخرین تغییرات همزمان نوشته و اتصال بسته می‌شود"""
+        if self._conn is None:
+            return
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
+        # تراکنش نیمه‌کاره thread باید قبل از استفاده از همان اتصال تمام شود
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+        if self._registry is not None:
+            changed, removed = self._changes(full=True)
+            offset = self.current_offset()
+            # همیشه نوشته می‌شود تا offset_saved_at زمان خاموش شدن باشد
+            self._commit(changed, removed, offset)
+            self._remember(changed, removed, offset)
+        self._conn.close()
+        self._conn = None
+
+    def stats(self):
+        return {"sessions": len(self._written), "commits": self.commits, "rows_written": self.rows_written,
+                "serialized": self.serialized,
+                "update_offset": self.current_offset()}
+
+
+class UpdateOffsetMiddleware(BaseMiddleware):
+    """
+    update_id پردازش‌شده را برای SessionStore ثبت می‌کند تا polling بعد از ری‌استارت
+    از همان‌جا ادامه دهد (به جای skip_updates که دکمه‌های زمان ری‌استارت را دور می‌ریزد).
+    آپدیت‌های عقب‌افتاده‌ای که از max_age قدیمی‌ترند اجرا نمی‌شوند:
+    دکمه‌ها با «دوباره بزنید» جواب می‌گیرند و پیام‌ها نادیده گرفته می‌شوند.
+    """
+
+    def __init__(self, store: SessionStore, max_age=UPDATE_MAX_AGE):
+        super().__init__()
+        self.store = store
+        self.max_age = max_age
+        self.backlog_end = None    # آخرین update_id که در زمان خاموشی رسیده بود
+        self.downtime = 0.0
+        self.stale = 0
+
+    async def resume(self, bot):
+        """
+        در on_startup: آپدیت‌های از قبل پردازش‌شده را در تلگرام تایید می‌کند
+        و مرز آپدیت‌های عقب‌افتاده را پیدا می‌کند.
+        """
+        offset = self.store.update_offset
+        if offset is None:
+            return
+        pending = await bot.get_updates(offset=offset + 1, limit=100, timeout=0)
+        if pending:
+            self.backlog_end = pending[-1].update_id
+            self.downtime = time.time() - (self.store.offset_saved_at or time.time())
+            logging.info("resuming after update %s; %d+ pending updates, down for %.0fs",
+                         offset, len(pending), self.downtime)
+
+    def _is_stale(self, update: types.Update):
+        if not self.max_age or self.backlog_end is None or update.update_id > self.backlog_end:
+            return False
+        if update.message:
+            return time.time() - update.message.date.timestamp() > self.max_age
+        if update.callback_query:
+            message = update.callback_query.message
+            if message is None:
+                # دکمه inline بدون پیام؛ زمان کلیک معلوم نیست و حداکثرش مدت خاموشی است
+                return self.downtime > self.max_age
+            # کلیک بعد از آخرین ارسال/ویرایش پیام دکمه بوده؛ هر callback با سن پیام خودش سنجیده می‌شود
+            changed_at = message.edit_date or message.date
+            return time.time() - changed_at.timestamp() > self.max_age
+        return False
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if not self._is_stale(update):
+            return
+        self.stale += 1
+        self.store.note_update(update.update_id)
+        if update.callback_query:
+            try:
+                await update.callback_query.answer("⏳ ربات در حال راه‌اندازی بود؛ لطفا دوباره بزنید.", show_alert=True)
+            except Exception:
+                pass
+        raise CancelHandler()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        self.store.note_update(update.update_id)
+
+
+state_store = SessionStore()
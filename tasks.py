@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+# ======================
+# تسک‌های پس‌زمینه هر بازی
+# ======================
+class TaskSupervisor:
+    """
+    تسک‌های پس‌زمینه را به ازای key (معمولا chat_id گروه) نگه می‌دارد.
+    - خطای هر تسک لاگ می‌شود و گم نمی‌شود
+    - با تمام شدن بازی، cancel(key) همه تسک‌های آن بازی را لغو می‌کند
+    """
+
+    def __init__(self):
+        self._tasks = {}   # {key: set[asyncio.Task]}
+        self.spawned = 0
+        self.failed = 0
+
+    def spawn(self, key, coro, name=None):
+        task = asyncio.create_task(coro)
+        self.spawned += 1
+        self._tasks.setdefault(key, set()).add(task)
+        task.add_done_callback(lambda t: self._finished(key, t, name or getattr(coro, "__name__", "task")))
+        return task
+
+    def _finished(self, key, task, name):
+        tasks = self._tasks.get(key)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del self._tasks[key]
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            self.failed += 1
+            logging.error("background task %s for %s failed", name, key, exc_info=exc)
+
+    def cancel(self, key):
+        """لغو همه تسک‌های یک بازی؛ تسک جاری (اگر خودش صدا زده) لغو نمی‌شود"""
+        current = asyncio.current_task()
+        for task in list(self._tasks.get(key, ())):
+            if task is not current and not task.done():
+                task.cancel()
+
+    def running(self, key=None):
+        if key is not None:
+            return len(self._tasks.get(key, ()))
+        return sum(len(t) for t in self._tasks.values())
+
+    def stats(self):
+        return {"running": self.running(), "spawned": self.spawned, "failed": self.failed}
+
+
+session_tasks = TaskSupervisor()
@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+
+# ======================
+# حذف زمان‌بندی‌شده پیام‌های موقت
+# ======================
+TEMP_MESSAGES_FILE = os.getenv("TEMP_MESSAGES_FILE", "temp_messages.json")
+DELETE_BATCH_SIZE = 100   # حداکثر پیام در هر deleteMessages
+SAVE_DELAY = 1.0          # ثانیه؛ تغییرات این بازه با یک نوشتن (در thread جدا) ذخیره می‌شوند
+
+
+class DeletionScheduler:
+    """
+    به جای یک coroutine خوابیده برای هر پیام موقت، همه پیام‌ها با زمان حذفشان
+    (chat_id, message_id, delete_at) در یک heap نگه‌داری می‌شوند.
+    - یک تسک، پیام‌های منقضی را دسته‌ای (به ازای هر گروه) پاک می‌کند
+    - لیست در فایل ذخیره می‌شود تا بعد از ری‌استارت هم پیام‌ها پاک شوند
+    - wipe_chat همه پیام‌های موقت یک گروه را یک‌جا پاک می‌کند
+    delete_at زمان واقعی (time.time) است چون باید بعد از ری‌استارت معتبر بماند.
+    """
+
+    def __init__(self, path=TEMP_MESSAGES_FILE):
+        self.path = path
+        self._heap = []          # [(delete_at, chat_id, message_id)]
+        self._pending = set()    # {(chat_id, message_id)} برای حذف lazy
+        self._bot = None
+        self._wakeup = None
+        self._runner = None
+        self._dirty = False
+        self._saver = None
+        self._deleting = set()   # تسک‌های حذف در جریان (یکی به ازای هر گروه در هر دور)
+        self.deleted = 0
+        self.saves = 0
+
+    # ---------- راه‌اندازی ----------
+    def start(self, bot):
+        """در on_startup صدا زده می‌شود؛ لیست ذخیره‌شده را لود و تسک حذف را اجرا می‌کند."""
+        self._bot = bot
+        for chat_id, message_id, delete_at in self._load():
+            self._push(chat_id, message_id, delete_at)
+        self._wakeup = asyncio.Event()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return [tuple(item) for item in json.load(f)]
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            logging.warning("temp messages: could not load %s: %s", self.path, e)
+            return []
+
+    def _snapshot(self):
+        return [[c, m, t] for t, c, m in self._heap if (c, m) in self._pending]
+
+    def _write(self, items):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(items, f)
+            os.replace(tmp, self.path)
+            self.saves += 1
+        except Exception as e:
+            logging.warning("temp messages: could not save %s: %s", self.path, e)
+
+    def _save(self):
+        """ذخیره با تاخیر؛ چند تغییر پشت سر هم یک بار و خارج از event loop نوشته می‌شوند"""
+        self._dirty = True
+        if self._saver is None or self._saver.done():
+            self._saver = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        while self._dirty:
+            await asyncio.sleep(SAVE_DELAY)
+            self._dirty = False
+            await asyncio.to_thread(self._write, self._snapshot())
+
+    def save(self):
+        """در on_shutdown: نوشتن همزمان تغییرات ذخیره‌نشده"""
+        if self._saver is not None:
+            self._saver.cancel()
+        if self._dirty or self._saver is not None:
+            self._dirty = False
+            self._write(self._snapshot())
+
+    # ---------- API ----------
+    def schedule(self, chat_id, message_id, delay):
+        self._push(chat_id, message_id, time.time() + delay)
+        self._save()
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _push(self, chat_id, message_id, delete_at):
+        key = (chat_id, message_id)
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        heapq.heappush(self._heap, (delete_at, chat_id, message_id))
+
+    async def wipe_chat(self, chat_id):
+        """حذف فوری همه پیام‌های موقت یک گروه (مثلا با پایان بازی)"""
+        ids = [m for c, m in self._pending if c == chat_id]
+        if not ids:
+            return
+        for message_id in ids:
+            self._pending.discard((chat_id, message_id))
+        self._save()
+        await self._delete(chat_id, ids)
+
+    def pending(self, chat_id=None):
+        if chat_id is None:
+            return len(self._pending)
+        return sum(1 for c, _ in self._pending if c == chat_id)
+
+    # ---------- داخلی ----------
+    async def _run(self):
+        while True:
+            # ورودی‌هایی که قبلا (با wipe_chat) پاک شده‌اند
+            while self._heap and (self._heap[0][1], self._heap[0][2]) not in self._pending:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                # asyncio.wait (نه wait_for) تا cancel هم‌زمان با set شدن wakeup گم نشود
+                waiter = asyncio.ensure_future(self._wakeup.wait())
+                try:
+                    await asyncio.wait({waiter}, timeout=delay)
+                finally:
+                    waiter.cancel()
+                continue
+
+            # همه پیام‌های منقضی را جمع کن و به ازای هر گروه یک‌جا پاک کن
+            now = time.time()
+            due = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, chat_id, message_id = heapq.heappop(self._heap)
+                if (chat_id, message_id) in self._pending:
+                    self._pending.discard((chat_id, message_id))
+                    due.setdefault(chat_id, []).append(message_id)
+            self._save()
+            # حلقه فقط پخش می‌کند؛ گروهی که حذفش کند است (RetryAfter، صف outbound) بقیه را معطل نمی‌کند
+            for chat_id, ids in due.items():
+                task = asyncio.create_task(self._delete(chat_id, ids))
+                self._deleting.add(task)
+                task.add_done_callback(self._deleting.discard)
+
+    async def _delete(self, chat_id, message_ids):
+        for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            batch = message_ids[i:i + DELETE_BATCH_SIZE]
+            try:
+                # deleteMessages (Bot API 7.0) چند پیام را با یک تماس پاک می‌کند
+                await self._bot.request("deleteMessages", {"chat_id": chat_id, "message_ids": json.dumps(batch)})
+                self.deleted += len(batch)
+            except Exception:
+                for message_id in batch:
+                    try:
+                        await self._bot.delete_message(chat_id, message_id)
+                        self.deleted += 1
+                    except Exception:
+                        pass
+
+
+temp_messages = DeletionScheduler()
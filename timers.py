@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+# ======================
+# زمان‌بند مرکزی تایمرها (heap بر اساس deadline)
+# ======================
+DEFAULT_REFRESH = 5  # فاصله پیش‌فرض بروزرسانی نمایش تایمر (ثانیه)
+
+# ریتم بروزرسانی تایمر نوبت: (اگر باقیمانده بیشتر از ... ثانیه بود، هر ... ثانیه یک ویرایش)
+COUNTDOWN_CADENCE = (
+    (60, 20),
+    (20, 10),
+    (0, 5),
+)
+# تلگرام حدود ۲۰ پیام در دقیقه برای هر گروه اجازه می‌دهد؛ تایمر حداکثر این تعداد را مصرف می‌کند
+TIMER_EDITS_PER_MINUTE = 8
+
+
+class Timer:
+    """
+    یک تایمر فعال (مثلا نوبت یک بازیکن).
+    deadline بر اساس time.monotonic است، پس زمان باقیمانده هیچ‌وقت drift نمی‌کند.
+    """
+
+    __slots__ = ("key", "deadline", "on_tick", "on_expire", "cadence",
+                 "next_at", "cancelled", "fired", "_ticking")
+
+    def __init__(self, key, deadline, on_tick, on_expire, cadence):
+        self.key = key
+        self.deadline = deadline
+        self.on_tick = on_tick        # async (timer, remaining) -> None
+        self.on_expire = on_expire    # async (timer) -> None
+        self.cadence = cadence        # (timer, remaining) -> ثانیه تا بروزرسانی بعدی
+        self.next_at = deadline
+        self.cancelled = False
+        self.fired = False
+        self._ticking = None
+
+    def remaining(self, now=None):
+        return max(0.0, self.deadline - (now if now is not None else time.monotonic()))
+
+    def done(self):
+        return self.cancelled or self.fired
+
+    def cancel(self):
+        self.cancelled = True
+        if self._ticking and not self._ticking.done():
+            self._ticking.cancel()
+
+
+class TimerScheduler:
+    """
+    یک زمان‌بند برای کل پروسه: همه تایمرهای همه بازی‌ها در یک heap.
+    - schedule / cancel / reschedule در O(log n)
+    - حذف‌ها lazy هستند: ورودی‌های کهنه موقع pop نادیده گرفته می‌شوند
+    - بروزرسانی نمایش (on_tick) در تسک جدا اجرا می‌شود تا کندی تلگرام
+      زمان‌بندی بقیه تایمرها را عقب نیندازد
+    """
+
+    def __init__(self):
+        self._heap = []                 # [(when, seq, timer)]
+        self._timers = {}               # {key: Timer}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._runner = None
+
+    # ---------- API ----------
+    def schedule(self, key, duration, on_tick=None, on_expire=None, cadence=None):
+        """تایمر جدید برای key؛ تایمر قبلی همان key لغو می‌شود."""
+        self.cancel(key)
+        now = time.monotonic()
+        timer = Timer(key, now + duration, on_tick, on_expire,
+                      cadence or (lambda t, remaining: DEFAULT_REFRESH))
+        self._timers[key] = timer
+        self._plan(timer, now)
+        self._ensure_runner()
+        return timer
+
+    def reschedule(self, key, duration):
+        """تغییر deadline یک تایمر فعال (مثلا افزودن وقت)"""
+        timer = self._timers.get(key)
+        if not timer or timer.done():
+            return None
+        now = time.monotonic()
+        timer.deadline = now + duration
+        self._plan(timer, now)
+        return timer
+
+    def cancel(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        return timer
+
+    def get(self, key):
+        timer = self._timers.get(key)
+        return timer if timer and not timer.done() else None
+
+    def __len__(self):
+        return len(self._timers)
+
+    # ---------- داخلی ----------
+    def _plan(self, timer, now):
+        if timer.on_tick:
+            step = max(0.5, float(timer.cadence(timer, timer.remaining(now))))
+            timer.next_at = min(now + step, timer.deadline)
+        else:
+            timer.next_at = timer.deadline
+        heapq.heappush(self._heap, (timer.next_at, next(self._seq), timer))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _ensure_runner(self):
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            # ورودی‌های لغو شده یا کهنه
+            while self._heap:
+                when, _, timer = self._heap[0]
+                if timer.done() or when != timer.next_at or self._timers.get(timer.key) is not timer:
+                    heapq.heappop(self._heap)
+                    continue
+                break
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            when, _, timer = self._heap[0]
+            delay = when - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            now = time.monotonic()
+            if now >= timer.deadline:
+                self._fire(timer)
+            else:
+                self._tick(timer, now)
+                self._plan(timer, now)
+
+    def _fire(self, timer):
+        timer.fired = True
+        if self._timers.get(timer.key) is timer:
+            del self._timers[timer.key]
+        if timer._ticking and not timer._ticking.done():
+            timer._ticking.cancel()
+        if timer.on_expire:
+            asyncio.create_task(self._guard(timer.on_expire(timer), timer.key))
+
+    def _tick(self, timer, now):
+        # اگر بروزرسانی قبلی هنوز تمام نشده، این یکی را رد کن
+        if timer._ticking and not timer._ticking.done():
+            return
+        timer._ticking = asyncio.create_task(self._guard(timer.on_tick(timer, timer.remaining(now)), timer.key))
+
+    @staticmethod
+    async def _guard(coro, key):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.warning("timer %s callback failed: %s", key, e)
+
+
+turn_timers = TimerScheduler()
+
+
+# ======================
+# بودجه ویرایش تایمر برای هر گروه
+# ======================
+class EditBudget:
+    """
+    شمارش ویرایش‌های تایمر هر گروه در پنجره لغزان ۶۰ ثانیه‌ای،
+    به‌همراه توقف کامل بعد از RetryAfter.
+    تایمر فقط سهم خودش را مصرف می‌کند تا پیام‌های اصلی بازی جا داشته باشند.
+    """
+
+    def __init__(self, per_minute: int = TIMER_EDITS_PER_MINUTE, window: float = 60.0):
+        self.per_minute = per_minute
+        self.window = window
+        self._edits = {}        # {chat_id: deque[monotonic]}
+        self._paused_until = {} # {chat_id: monotonic}
+
+    def _recent(self, chat_id, now):
+        q = self._edits.get(chat_id)
+        if q is None:
+            q = self._edits[chat_id] = deque()
+        while q and now - q[0] >= self.window:
+            q.popleft()
+        return q
+
+    def record(self, chat_id):
+        now = time.monotonic()
+        self._recent(chat_id, now).append(now)
+
+    def pause(self, chat_id, seconds):
+        """بعد از RetryAfter: تا این مدت هیچ ویرایش تایمری در این گروه"""
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0), time.monotonic() + seconds)
+
+    def wait_time(self, chat_id):
+        """چند ثانیه باید صبر کرد تا ویرایش بعدی داخل بودجه باشد (۰ یعنی آزاد)"""
+        now = time.monotonic()
+        wait = max(0.0, self._paused_until.get(chat_id, 0) - now)
+        q = self._recent(chat_id, now)
+        if len(q) >= self.per_minute:
+            wait = max(wait, q[len(q) - self.per_minute] + self.window - now)
+        return wait
+
+    def forget(self, chat_id):
+        self._edits.pop(chat_id, None)
+        self._paused_until.pop(chat_id, None)
+
+
+timer_edit_budget = EditBudget()
+
+
+def countdown_cadence(chat_id, budget=timer_edit_budget):
+    """
+    تابع cadence برای TimerScheduler:
+    اول نوبت کم ویرایش می‌کند و نزدیک پایان بیشتر؛
+    اگر بودجه گروه تمام شده یا RetryAfter گرفته‌ایم، عقب می‌کشد.
+    """
+    def cadence(timer, remaining):
+        step = COUNTDOWN_CADENCE[-1][1]
+        for threshold, every in COUNTDOWN_CADENCE:
+            if remaining > threshold:
+                step = every
+                break
+        # بروزرسانی را روی عدد رُند بنشان (مثلا ۱۰۰، ۸۰، ۶۰ ...)
+        aligned = remaining % step or step
+        if remaining - aligned > 0:
+            step = aligned
+        return max(step, budget.wait_time(chat_id))
+    return cadence
@@ -0,0 +1,145 @@
+"""
+اجرای ربات با webhook (aiohttp) به جای long polling.
+
+    WEBHOOK_URL=https://example.com WEBHOOK_SECRET=... python webhook.py
+    python webhook.py --post updates.jsonl     # ارسال آپدیت‌های ضبط‌شده به سرور محلی برای تست
+
+متغیرها:
+    WEBHOOK_URL          آدرس عمومی؛ اگر خالی باشد setWebhook صدا زده نمی‌شود (تست محلی)
+    WEBHOOK_PATH         مسیر دریافت آپدیت (پیش‌فرض /webhook)
+    WEBHOOK_SECRET       با هدر X-Telegram-Bot-Api-Secret-Token مقایسه می‌شود
+    WEBHOOK_HOST/PORT    آدرس گوش دادن (پیش‌فرض 0.0.0.0:8080 یا PORT)
+    UPDATE_LANES         تعداد laneهای پردازش (pipeline.py)
+    LANE_QUEUE_SIZE      ظرفیت صف هر lane؛ اگر پر باشد 503 برمی‌گردد و تلگرام دوباره می‌فرستد
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+import time
+
+from aiohttp import web, ClientSession
+
+from aiogram import Bot, Dispatcher, types
+
+from outbound import outbound
+from pipeline import update_pipeline
+
+# ======================
+# تنظیمات
+# ======================
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    آپدیت‌ها را با POST می‌گیرد، به lane چت خودش در update_pipeline می‌دهد و فوراً 200 برمی‌گرداند.
+    """
+
+    def __init__(self, dp: Dispatcher, pipeline=update_pipeline, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.dp = dp
+        self.pipeline = pipeline
+        self.path = path
+        self.secret = secret
+        self.started_at = time.monotonic()
+        self.received = 0
+        self.rejected = 0
+        self.overflow = 0
+
+    # ---------- aiohttp ----------
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        return app
+
+    async def handle_update(self, request: web.Request):
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = types.Update(**await request.json())
+        except Exception:
+            self.rejected += 1
+            return web.Response(status=400)
+        if not self.pipeline.offer(update):
+            # صف lane این چت پر است؛ تلگرام آپدیت را بعدا دوباره می‌فرستد
+            self.overflow += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.Response(status=200)
+
+    async def handle_health(self, request: web.Request):
+        return web.json_response({
+            "ok": True,
+            "uptime": round(time.monotonic() - self.started_at),
+            "received": self.received,
+            "rejected": self.rejected,
+            "overflow": self.overflow,
+            "pipeline": self.pipeline.stats(),
+            "outbound": outbound.stats(),
+        })
+
+    # ---------- راه‌اندازی ----------
+    async def _on_startup(self, app):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        import main
+        # laneهای pipeline هم در start_services راه می‌افتند
+        await main.start_services()
+        if WEBHOOK_URL:
+            await self.dp.bot.set_webhook(
+                WEBHOOK_URL + self.path,
+                secret_token=self.secret or None,
+                allowed_updates=types.AllowedUpdates.all(),
+                max_connections=40,
+            )
+            logging.info("webhook set to %s%s", WEBHOOK_URL, self.path)
+        logging.info("webhook: listening on %s", self.path)
+
+    async def _on_shutdown(self, app):
+        import main
+        # main.on_shutdown اول صف pipeline را خالی می‌کند
+        await main.on_shutdown(self.dp)
+        session = await self.dp.bot.get_session()
+        await session.close()
+
+
+async def post_recorded(path, url):
+    """آپدیت‌های ضبط‌شده (هر خط یک JSON) را به سرور محلی می‌فرستد"""
+    headers = {SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    async with ClientSession() as http:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                async with http.post(url, data=line.encode("utf-8"), headers={**headers, "Content-Type": "application/json"}) as resp:
+                    print(json.loads(line).get("update_id"), resp.status)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="اجرای ربات با webhook")
+    parser.add_argument("--post", metavar="FILE", help="ارسال آپدیت‌های ضبط‌شده (jsonl) به سرور در حال اجرا")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    args = parser.parse_args()
+
+    if args.post:
+        asyncio.run(post_recorded(args.post, args.url))
+        return
+    # main توکن می‌خواهد و هندلرها را ثبت می‌کند؛ --post به آن نیازی ندارد
+    import main
+    server = WebhookServer(main.dp)
+    web.run_app(server.app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+
+if __name__ == "__main__":
+    run()